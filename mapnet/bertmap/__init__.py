@@ -1 +1,4 @@
+from .cache import *
 from .utils import *
+from .corpus import *
+from .runner import *
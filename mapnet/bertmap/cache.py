@@ -0,0 +1,121 @@
+"""
+On disk caches of ontology annotations for bertmap.
+Annotation indexes are stored as parquet next to the obo file of each (prefix, version, subset), so later runs
+neither re-parse the obo file nor start the owl api jvm just to extract labels and synonyms.
+"""
+
+import hashlib
+import json
+import os
+
+import polars as pl
+import logging
+
+logger = logging.getLogger(__name__)
+
+ANNOTATION_SCHEMA = pl.Schema([("identifier", pl.String), ("label", pl.String)])
+
+
+def get_annotation_cache_path(onto_fname: str, name: str = "annotations", **settings):
+    """returns the path of an annotation cache for an ontology file, settings that change the index are part of the name"""
+    if settings:
+        key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        name = f"{name}_{key[:12]}"
+    stem = os.path.splitext(os.path.basename(onto_fname))[0]
+    return os.path.join(os.path.dirname(onto_fname), f"{stem}.{name}.parquet")
+
+
+def is_cache_fresh(cache_path: str, onto_fname: str):
+    """a cache is fresh if it is newer than the ontology file it was built from"""
+    return os.path.exists(cache_path) and os.path.getmtime(
+        cache_path
+    ) >= os.path.getmtime(onto_fname)
+
+
+def write_annotation_cache(cache_path: str, annotations: dict):
+    """write an annotation index (class to list of labels) as parquet, keeping the order of the labels"""
+    pl.DataFrame(
+        [
+            (identifier, label)
+            for identifier, labels in annotations.items()
+            for label in labels
+        ],
+        schema=ANNOTATION_SCHEMA,
+        orient="row",
+    ).write_parquet(cache_path)
+
+
+def read_annotation_cache(cache_path: str):
+    """read an annotation index written by write_annotation_cache"""
+    df = pl.read_parquet(cache_path)
+    return {
+        identifier: labels
+        for identifier, labels in df.group_by("identifier", maintain_order=True)
+        .agg(pl.col("label"))
+        .iter_rows()
+    }
+
+
+class LazyOntology:
+    """
+    stand in for a deeponto Ontology that only loads the ontology in the jvm when it is needed.
+    The annotation index is served from an on disk cache, every other attribute loads the ontology.
+    """
+
+    def __init__(self, onto_fname: str, **onto_args):
+        self.onto_fname = onto_fname
+        self.onto_args = onto_args
+        self._onto = None
+
+    @property
+    def onto(self):
+        if self._onto is None:
+            from deeponto.onto import Ontology
+
+            logger.info(f"loading {self.onto_fname} in the owl api")
+            self._onto = Ontology(self.onto_fname, **self.onto_args)
+        return self._onto
+
+    def build_annotation_index(
+        self,
+        annotation_property_iris: list = None,
+        entity_type: str = "Classes",
+        apply_lowercasing: bool = False,
+        **kwargs,
+    ):
+        """cached version of Ontology.build_annotation_index, returns the index and the annotation properties used"""
+        cache_path = get_annotation_cache_path(
+            self.onto_fname,
+            name="deeponto_annotations",
+            annotation_property_iris=sorted(annotation_property_iris or []),
+            entity_type=entity_type,
+            apply_lowercasing=apply_lowercasing,
+            **kwargs,
+        )
+        properties_path = cache_path.replace(".parquet", ".json")
+        if is_cache_fresh(cache_path, self.onto_fname) and os.path.exists(
+            properties_path
+        ):
+            logger.info(f"found cached annotation index at {cache_path}")
+            with open(properties_path, "r") as f:
+                used_iris = json.load(f)
+            index = read_annotation_cache(cache_path)
+            return {x: set(labels) for x, labels in index.items()}, used_iris
+        index, used_iris = self.onto.build_annotation_index(
+            annotation_property_iris=annotation_property_iris,
+            entity_type=entity_type,
+            apply_lowercasing=apply_lowercasing,
+            **kwargs,
+        )
+        write_annotation_cache(
+            cache_path, {x: sorted(labels) for x, labels in index.items()}
+        )
+        with open(properties_path, "w") as f:
+            json.dump(list(used_iris), f)
+        return index, used_iris
+
+    def __getattr__(self, name: str):
+        ## private attributes are never forwarded, so a partially built instance can not recurse
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.onto, name)
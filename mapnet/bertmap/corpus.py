@@ -0,0 +1,289 @@
+"""
+Bounded training corpus for fine-tuning the bertmap synonym classifier.
+Synonym pairs (labels of the same class and labels of known mappings) and non-synonym pairs (random and
+sibling classes) are deduplicated on normalized labels and sampled up to a budget, stratified by the kind
+of pair and the top level branch of the class it came from. Sampled corpora are cached as parquet.
+"""
+
+import hashlib
+import json
+import os
+import random
+
+import polars as pl
+
+from mapnet.bertmap.utils import (
+    get_annotations,
+    get_known_maps,
+    normalize_resource_def,
+)
+from mapnet.utils import (
+    get_hierarchy_graph,
+    get_network_graph,
+    normalize_label,
+    parse_identifier,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+CORPUS_SCHEMA = pl.Schema(
+    [
+        ("left", pl.String),
+        ("right", pl.String),
+        ("label", pl.Int64),
+        ("kind", pl.String),
+        ("branch", pl.String),
+    ]
+)
+## share of the budget given to each kind of pair
+KIND_SHARES = {
+    "synonym": 0.25,
+    "known_mapping": 0.25,
+    "random_negative": 0.25,
+    "sibling_negative": 0.25,
+}
+
+
+def get_branch_map(graph):
+    """
+    returns the top level branch (child of a root) of every class, roots are their own branch.
+    graph is an is_a hierarchy with edges from parent to child, see get_hierarchy_graph
+    """
+    branches = {}
+    for root in [node for node in graph.nodes if graph.in_degree(node) == 0]:
+        branches.setdefault(root, root)
+        for branch in graph.successors(root):
+            stack = [branch]
+            while stack:
+                node = stack.pop()
+                if node in branches:
+                    continue
+                branches[node] = branch
+                stack += list(graph.successors(node))
+    return branches
+
+
+def get_synonym_pairs(annotations: dict, branches: dict):
+    """pairs of labels of the same class"""
+    return [
+        (left, right, 1, "synonym", branches.get(identifier, ""))
+        for identifier, labels in annotations.items()
+        for i, left in enumerate(labels)
+        for right in labels[i + 1 :]
+    ]
+
+
+def get_known_mapping_pairs(
+    known_maps_path: str,
+    source_annotations: dict,
+    target_annotations: dict,
+    branches: dict,
+):
+    """pairs of labels of classes with a known mapping between the two resources"""
+    known_maps = pl.read_csv(known_maps_path, separator="\t")
+    pairs = []
+    for source_iri, target_iri in known_maps.select("SrcEntity", "TgtEntity").iter_rows():
+        source, target = parse_identifier(source_iri), parse_identifier(target_iri)
+        if source not in source_annotations or target not in target_annotations:
+            continue
+        pairs += [
+            (left, right, 1, "known_mapping", branches.get(source, ""))
+            for left in source_annotations[source]
+            for right in target_annotations[target]
+        ]
+    return pairs
+
+
+def get_negative_pairs(annotations: dict, graph, branches: dict, n: int, seed: int = 0):
+    """names of random classes and of sibling classes (sharing a parent) as non-synonym pairs"""
+    rng = random.Random(seed)
+    identifiers = list(annotations)
+    pairs = []
+    for _ in range(n):
+        left, right = rng.sample(identifiers, 2)
+        pairs.append(
+            (
+                annotations[left][0],
+                annotations[right][0],
+                0,
+                "random_negative",
+                branches.get(left, ""),
+            )
+        )
+    for parent in graph.nodes:
+        children = [x for x in graph.successors(parent) if x in annotations]
+        for left, right in zip(children, children[1:]):
+            pairs.append(
+                (
+                    annotations[left][0],
+                    annotations[right][0],
+                    0,
+                    "sibling_negative",
+                    branches.get(left, ""),
+                )
+            )
+    return pairs
+
+
+def deduplicate_pairs(corpus: pl.DataFrame):
+    """drop pairs whose labels are the same after normalization, and pairs that are the same as another pair after normalization"""
+    return (
+        corpus.with_columns(
+            normalize_label(pl.col("left")).alias("left key"),
+            normalize_label(pl.col("right")).alias("right key"),
+        )
+        .filter(pl.col("left key") != pl.col("right key"))
+        .with_columns(
+            pl.min_horizontal("left key", "right key").alias("left key"),
+            pl.max_horizontal("left key", "right key").alias("right key"),
+        )
+        .unique(["left key", "right key", "label"], keep="first", maintain_order=True)
+        .drop("left key", "right key")
+    )
+
+
+def sample_corpus(corpus: pl.DataFrame, budget: int, seed: int = 0):
+    """
+    sample at most budget pairs. The budget is split between the kinds of pairs (see KIND_SHARES), unused shares
+    go to the other kinds, and within a kind every branch gets a share proportional to its size
+    """
+    sizes = dict(corpus.group_by("kind").len().iter_rows())
+    quotas = {}
+    left = budget
+    ## give small kinds all their pairs first and split what is left between the larger kinds
+    for kind in sorted(sizes, key=sizes.get):
+        share = sum(KIND_SHARES.get(x, 0) for x in sizes if x not in quotas)
+        quotas[kind] = min(
+            sizes[kind], int(left * KIND_SHARES.get(kind, 0) / share) if share else 0
+        )
+        left -= quotas[kind]
+    logger.info(f"sampling {quotas} from {sizes}")
+    return (
+        corpus.join(
+            pl.DataFrame(
+                {"kind": list(quotas), "quota": list(quotas.values())},
+                schema={"kind": pl.String, "quota": pl.Int64},
+            ),
+            on="kind",
+        )
+        .with_columns(
+            (pl.col("quota") * pl.len().over("kind", "branch") / pl.len().over("kind"))
+            .ceil()
+            .alias("branch quota")
+        )
+        .filter(
+            pl.int_range(pl.len()).shuffle(seed=seed).over("kind", "branch")
+            < pl.col("branch quota")
+        )
+        .drop("quota", "branch quota")
+        .sample(fraction=1.0, shuffle=True, seed=seed)
+        .head(budget)
+    )
+
+
+def build_training_corpus(
+    source_def: dict,
+    target_def: dict,
+    resources: dict,
+    meta: dict,
+    budget: int = 100000,
+    known_maps_path: str = None,
+    seed: int = 0,
+    cache_dir: str = None,
+):
+    """
+    build (or load from the cache) a bounded training corpus for a pair of resources.
+    The cache key covers the annotations, known mappings, budget and seed so a corpus is reused across reruns.
+    args:
+        budget: maximum number of pairs in the corpus
+        known_maps_path: bertmap formatted known mappings, built with get_known_maps if not given
+    returns the corpus with columns left, right, label (1 for synonyms), kind and branch
+    """
+    resource_path = meta.get("dataset_dir", "resources/")
+    resources = normalize_resource_def(resources=resources)
+    source_def = normalize_resource_def(resource_def=source_def.copy())
+    target_def = normalize_resource_def(resource_def=target_def.copy())
+    known_maps_path = known_maps_path or get_known_maps(
+        target_def=target_def, source_def=source_def, resources=resources, meta=meta
+    )
+    cache_dir = cache_dir or os.path.join(meta["known_mappings_path"], "corpora")
+    key = hashlib.sha256(
+        json.dumps(
+            {
+                "source": source_def,
+                "target": target_def,
+                "known_maps": [known_maps_path, os.path.getmtime(known_maps_path)],
+                "budget": budget,
+                "seed": seed,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    corpus_path = os.path.join(
+        cache_dir, f"{source_def['prefix']}-{target_def['prefix']}-{key[:12]}.parquet"
+    )
+    if os.path.exists(corpus_path):
+        logger.info(f"found training corpus at {corpus_path}")
+        return pl.read_parquet(corpus_path)
+    pairs = []
+    annotations = {}
+    branches = {}
+    for onto_def in [source_def, target_def]:
+        prefix = onto_def["prefix"]
+        annotations[prefix] = get_annotations(onto_def, resource_path, meta=meta)
+        ## pyobo graphs go from child to parent over every relation, branches and siblings follow is_a down
+        graph = get_hierarchy_graph(
+            get_network_graph(
+                resources={prefix: onto_def},
+                meta=meta | {"dataset_dir": resource_path},
+                prefix=prefix,
+            )
+        )
+        branches[prefix] = get_branch_map(graph)
+        pairs += get_synonym_pairs(annotations[prefix], branches[prefix])
+        pairs += get_negative_pairs(
+            annotations[prefix], graph, branches[prefix], n=budget, seed=seed
+        )
+    pairs += get_known_mapping_pairs(
+        known_maps_path,
+        source_annotations=annotations[source_def["prefix"]],
+        target_annotations=annotations[target_def["prefix"]],
+        branches=branches[source_def["prefix"]],
+    )
+    corpus = deduplicate_pairs(pl.DataFrame(pairs, schema=CORPUS_SCHEMA, orient="row"))
+    corpus = sample_corpus(corpus, budget=budget, seed=seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    corpus.write_parquet(corpus_path)
+    return corpus
+
+
+def train_bertmap_classifier(
+    corpus: pl.DataFrame,
+    output_path: str,
+    pretrained_path: str = "emilyalsentzer/Bio_ClinicalBERT",
+    num_epochs: int = 3,
+    batch_size: int = 32,
+    max_length: int = 128,
+    validation_fraction: float = 0.1,
+    seed: int = 0,
+):
+    """fine-tune the bertmap synonym classifier on a sampled corpus"""
+    from deeponto.align.bertmap.bert_classifier import BERTSynonymClassifier
+
+    corpus = corpus.sample(fraction=1.0, shuffle=True, seed=seed)
+    n_validation = int(len(corpus) * validation_fraction)
+    rows = list(corpus.select("left", "right", "label").iter_rows())
+    classifier = BERTSynonymClassifier(
+        loaded_path=pretrained_path,
+        output_path=output_path,
+        eval_mode=False,
+        max_length_for_input=max_length,
+        num_epochs_for_training=num_epochs,
+        batch_size_for_training=batch_size,
+        batch_size_for_prediction=batch_size,
+        training_data=rows[n_validation:],
+        validation_data=rows[:n_validation],
+    )
+    classifier.train()
+    return classifier
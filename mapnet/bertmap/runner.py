@@ -0,0 +1,201 @@
+"""
+Landscape level bertmap inference.
+The fine-tuned model is loaded once (per worker process) and ontology indexes are kept in an LRU cache, so an
+ontology shared by several pairs is only parsed and indexed once. Every pair writes its own output and a marker
+keyed on the checkpoint, the resource versions and the match arguments. Pairs with a matching marker are skipped, so
+an interrupted run can be resumed and changing any of those re-runs the pair.
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import combinations
+
+import torch
+
+from mapnet.bertmap.utils import (
+    find_bertmap_checkpoint,
+    get_bertmap_output_path,
+    get_onto_index,
+    load_bertmap_model,
+    match_bertmap_pair,
+    normalize_resource_def,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+## state of a worker process, set by init_bertmap_worker
+_worker = {}
+
+
+def init_bertmap_worker(
+    checkpoint_path: str,
+    model_dir: str,
+    resources: dict,
+    meta: dict,
+    cache_size: int = 4,
+    n_threads: int = None,
+):
+    """load the model once in this process and set up the cache of ontology indexes"""
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    model, tokenizer = load_bertmap_model(checkpoint_path, model_dir=model_dir)
+    resource_path = meta.get("dataset_dir", "resources/")
+
+    @lru_cache(maxsize=cache_size)
+    def get_cached_index(prefix: str):
+        return get_onto_index(
+            {"prefix": prefix} | resources[prefix], resource_path, tokenizer, meta=meta
+        )
+
+    _worker.update(
+        model=model,
+        tokenizer=tokenizer,
+        get_index=get_cached_index,
+        meta=meta,
+    )
+
+
+def get_bertmap_pair_key(
+    checkpoint_path: str, source_def: dict, target_def: dict, match_args: dict
+):
+    """returns a key for a pair output from the checkpoint (path and last change), both resources and the match arguments"""
+    checkpoint_files = glob.glob(os.path.join(checkpoint_path, "**"), recursive=True)
+    key = {
+        "checkpoint": os.path.abspath(checkpoint_path),
+        "checkpoint_mtime": max(
+            (os.path.getmtime(x) for x in checkpoint_files), default=None
+        ),
+        "source": source_def,
+        "target": target_def,
+        "match_args": match_args,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_bertmap_marker_path(output_path: str):
+    """returns the path of the completion marker of a pair output"""
+    return f"{os.path.splitext(output_path)[0]}_complete.json"
+
+
+def is_bertmap_pair_complete(output_path: str, key: str):
+    """check if a pair output was written for the given key"""
+    marker_path = get_bertmap_marker_path(output_path)
+    if not os.path.exists(output_path) or not os.path.exists(marker_path):
+        return False
+    with open(marker_path, "r") as f:
+        return json.load(f)["key"] == key
+
+
+def run_bertmap_pair(
+    source_prefix: str, target_prefix: str, output_path: str, key: str, **match_args
+):
+    """match one pair in a process set up by init_bertmap_worker, and mark its output complete for key"""
+    if is_bertmap_pair_complete(output_path, key):
+        logger.info(f"{output_path} is already complete skipping!")
+        return output_path
+    logger.info(f"matching {source_prefix} and {target_prefix}")
+    match_bertmap_pair(
+        _worker["model"],
+        _worker["tokenizer"],
+        source=_worker["get_index"](source_prefix),
+        target=_worker["get_index"](target_prefix),
+        source_prefix=source_prefix,
+        target_prefix=target_prefix,
+        output_path=output_path,
+        **match_args,
+    )
+    with open(get_bertmap_marker_path(output_path), "w") as f:
+        json.dump(
+            {"key": key, "finished": datetime.datetime.now().isoformat()}, f, indent=2
+        )
+    return output_path
+
+
+def run_bertmap_pairwise(
+    resources: dict,
+    meta: dict,
+    checkpoint_path: str = None,
+    model_dir: str = "bertmap",
+    target_resource_prefix: str = None,
+    output_dir: str = None,
+    n_workers: int = 1,
+    cache_size: int = 4,
+    **match_args,
+):
+    """
+    run bertmap inference for every pair of resources (or only pairs containing target_resource_prefix).
+    args:
+        output_dir: pair outputs are written to output_dir/<source>-<target>/bertmap_mappings.tsv,
+            defaults to output/bertmap/<landscape>
+        n_workers: number of worker processes, each loads the model once and gets an equal share of the cpus
+        cache_size: number of ontology indexes kept in memory by each worker
+        match_args: passed to match_bertmap_pair
+    returns the paths of the pair outputs
+    """
+    resources = normalize_resource_def(resources=resources)
+    checkpoint_path = checkpoint_path or find_bertmap_checkpoint(model_dir)
+    pairs = [
+        (source, target)
+        for source, target in combinations(resources, r=2)
+        if target_resource_prefix is None
+        or target_resource_prefix in [source, target]
+    ]
+    jobs = []
+    output_paths = []
+    for source, target in pairs:
+        output_path = (
+            os.path.join(output_dir, f"{source}-{target}", "bertmap_mappings.tsv")
+            if output_dir
+            else get_bertmap_output_path(source, target, meta)
+        )
+        output_paths.append(output_path)
+        key = get_bertmap_pair_key(
+            checkpoint_path, resources[source], resources[target], match_args
+        )
+        if is_bertmap_pair_complete(output_path, key):
+            logger.info(f"{output_path} is already complete skipping!")
+            continue
+        jobs.append((source, target, output_path, key))
+    logger.info(f"{len(jobs)} of {len(pairs)} pairs left to match")
+    if not jobs:
+        return output_paths
+    worker_args = dict(
+        checkpoint_path=checkpoint_path,
+        model_dir=model_dir,
+        resources=resources,
+        meta=meta,
+        cache_size=cache_size,
+    )
+    if n_workers == 1:
+        init_bertmap_worker(**worker_args)
+        for source, target, output_path, key in jobs:
+            run_bertmap_pair(source, target, output_path, key, **match_args)
+        return output_paths
+    ## pairs are sent in order, so pairs sharing a source tend to land on warm caches.
+    ## workers are spawned, forking a process that already initialized torch or cuda can deadlock
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=partial(
+            init_bertmap_worker,
+            n_threads=max(1, os.cpu_count() // n_workers),
+            **worker_args,
+        ),
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_bertmap_pair, source, target, output_path, key, **match_args
+            )
+            for source, target, output_path, key in jobs
+        ]
+        ## raise errors from failed pairs
+        for future in futures:
+            future.result()
+    return output_paths
@@ -3,22 +3,70 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import glob
+import hashlib
+import heapq
+import json
+import math
 import os
+from importlib.metadata import version
+from itertools import combinations
+
+import biomappings
+
+import numpy as np
+import pyobo
+import torch
 from deeponto.align.bertmap import DEFAULT_CONFIG_FILE, BERTMapPipeline
 from deeponto.onto import Ontology
 from huggingface_hub import snapshot_download
+from tqdm import tqdm
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-# import biomappings
 # from biomappings.resources import append_prediction_tuples
 
 from bioregistry import get_iri, normalize_prefix
 import polars as pl
-from mapnet.utils import load_biomappings_df, load_known_mappings_df
+from mapnet.utils import (
+    load_known_mappings_df,
+    make_undirected,
+    sssom_to_biomappings,
+)
+from mapnet.bertmap.cache import (
+    LazyOntology,
+    get_annotation_cache_path,
+    is_cache_fresh,
+    read_annotation_cache,
+    write_annotation_cache,
+)
 
 PREFIX_MAP = {
     "mesh": "http://id.nlm.nih.gov/mesh/",
 }
 
+## scores of a chunk of candidates, typed so that chunks without any candidates still have the right dtypes
+SCORED_SCHEMA = pl.Schema(
+    [
+        ("source identifier", pl.String),
+        ("target identifier", pl.String),
+        ("confidence", pl.Float64),
+    ]
+)
+BERTMAP_MAPPINGS_SCHEMA = pl.Schema(
+    [
+        ("source prefix", pl.String),
+        ("source identifier", pl.String),
+        ("source name", pl.String),
+        ("relation", pl.String),
+        ("target prefix", pl.String),
+        ("target identifier", pl.String),
+        ("target name", pl.String),
+        ("type", pl.String),
+        ("confidence", pl.Float64),
+        ("source", pl.String),
+    ]
+)
+
 
 def identifier_to_iri(x: str):
     """
@@ -43,51 +91,167 @@ def biomappings_format_to_bertmap(df: pl.DataFrame):
     ).select("SrcEntity", "TgtEntity", "score")
 
 
+def get_evidence_key(resources: dict, meta: dict, check_biomappings: bool = True):
+    """returns a key for the inputs of the evidence table: resource versions, known mapping files and biomappings"""
+    resource_path = meta.get("dataset_dir", "resources/")
+    key = {"biomappings": version("biomappings") if check_biomappings else None}
+    for prefix in sorted(resources):
+        resource_fname = os.path.join(
+            resource_path, prefix, resources[prefix]["version"], "mappings.tsv"
+        )
+        stat = os.stat(resource_fname) if os.path.exists(resource_fname) else None
+        key[prefix] = [
+            resources[prefix]["version"],
+            stat.st_size if stat else None,
+            stat.st_mtime_ns if stat else None,
+        ]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_evidence_table(
+    resources: dict, meta: dict, check_biomappings: bool = True, **_
+):
+    """
+    returns the evidence used for known mappings of every pair of a landscape, in bertmap format with
+    the origin (biomappings or known) and prefixes of each mapping. Iris are built once per identifier.
+    The table is cached in known_mappings_path and rebuilt only when its inputs change
+    """
+    resources = normalize_resource_def(resources=resources)
+    key = get_evidence_key(resources, meta, check_biomappings=check_biomappings)
+    os.makedirs(meta["known_mappings_path"], exist_ok=True)
+    table_path = os.path.join(meta["known_mappings_path"], f"evidence_{key[:12]}.parquet")
+    if os.path.exists(table_path):
+        logger.info(f"found evidence table at {table_path}")
+        return pl.read_parquet(table_path), key
+    evidence = []
+    if check_biomappings:
+        biomappings_df = sssom_to_biomappings(
+            pl.from_records(
+                biomappings.load_mappings(), strict=False, infer_schema_length=None
+            )
+        ).filter(
+            pl.col("source prefix").is_in(list(resources))
+            & pl.col("target prefix").is_in(list(resources))
+        )
+        ## same identifiers as load_biomappings_df
+        biomappings_df = make_undirected(
+            biomappings_df.with_columns(
+                (
+                    pl.col("source prefix")
+                    + ":"
+                    + pl.col("source identifier").str.split(":").list.get(-1)
+                ).alias("source identifier"),
+                (
+                    pl.col("target prefix")
+                    + ":"
+                    + pl.col("target identifier").str.split(":").list.get(-1)
+                ).alias("target identifier"),
+            )
+        )
+        evidence.append(biomappings_df.with_columns(pl.lit("biomappings").alias("origin")))
+    known_mappings_df = load_known_mappings_df(resources, meta, sssom=False)
+    if known_mappings_df is not None:
+        evidence.append(known_mappings_df.with_columns(pl.lit("known").alias("origin")))
+    evidence = pl.concat(
+        [
+            x.select(
+                "origin",
+                "source prefix",
+                "target prefix",
+                "source identifier",
+                "target identifier",
+            )
+            for x in evidence
+        ]
+    ).unique()
+    iris = (
+        pl.concat([evidence["source identifier"], evidence["target identifier"]])
+        .unique()
+        .to_frame("identifier")
+        .with_columns(
+            pl.col("identifier")
+            .map_elements(identifier_to_iri, return_dtype=pl.String)
+            .alias("iri")
+        )
+    )
+    evidence = (
+        evidence.join(
+            iris.rename({"identifier": "source identifier", "iri": "SrcEntity"}),
+            on="source identifier",
+        )
+        .join(
+            iris.rename({"identifier": "target identifier", "iri": "TgtEntity"}),
+            on="target identifier",
+        )
+        .with_columns(pl.lit(1.0).alias("score"))
+    )
+    evidence.write_parquet(table_path)
+    return evidence, key
+
+
 def get_known_maps(
     target_def: dict,
     source_def: dict,
     resources: dict,
     meta: dict,
     check_biomappings: bool = True,
+    evidence: tuple = None,
     **_,
 ):
     """
-    saves a file with known mappings parsed from the provided obo file, and also biomappings optionally
+    saves a file with known mappings parsed from the provided obo file, and also biomappings optionally.
+    The file is built from the shared evidence table (see get_evidence_table) and reused while its inputs do not change.
     """
-    evidence = None
-    if check_biomappings:
-        forward = load_biomappings_df(
-            target_prefix=target_def["prefix"],
-            source_prefix=source_def["prefix"],
-            undirected=True,
-        )
-        reverse = load_biomappings_df(
-            source_prefix=target_def["prefix"],
-            target_prefix=source_def["prefix"],
-            undirected=True,
-        )
-        evidence = forward.vstack(reverse).filter(
-            (pl.col("source prefix").eq(source_def["prefix"]))
-            & (pl.col("target prefix").eq(target_def["prefix"]))
-        )
-    known_mappings_df = load_known_mappings_df(resources, meta, sssom=False)
-    if evidence is None:
-        evidence = known_mappings_df
-    else:
-        evidence = evidence.vstack(known_mappings_df)
-    evidence = biomappings_format_to_bertmap(evidence).unique()
-    os.makedirs(meta["known_mappings_path"], exist_ok=True)
+    evidence, key = evidence or get_evidence_table(
+        resources=resources, meta=meta, check_biomappings=check_biomappings
+    )
     save_pth = os.path.join(
         meta["known_mappings_path"],
         f"{source_def['prefix']}-{source_def['version']}-{target_def['prefix']}-{target_def['version']}-known_maps.tsv",
     )
-    evidence.write_csv(
+    key_pth = save_pth.replace(".tsv", ".key")
+    if os.path.exists(save_pth) and os.path.exists(key_pth):
+        with open(key_pth, "r") as f:
+            if f.read() == key:
+                logger.info(f"found known maps at {save_pth}")
+                return save_pth
+    ## biomappings between the pair and all known mappings of the landscape
+    evidence.filter(
+        (
+            pl.col("origin").eq("biomappings")
+            & pl.col("source prefix").eq(source_def["prefix"])
+            & pl.col("target prefix").eq(target_def["prefix"])
+        )
+        | pl.col("origin").eq("known")
+    ).select("SrcEntity", "TgtEntity", "score").unique().write_csv(
         save_pth,
         separator="\t",
     )
+    with open(key_pth, "w") as f:
+        f.write(key)
     return save_pth
 
 
+def get_all_known_maps(
+    resources: dict, meta: dict, check_biomappings: bool = True, **_
+):
+    """write the known maps of every pair of resources in a landscape, sharing one evidence table"""
+    resources = normalize_resource_def(resources=resources)
+    evidence = get_evidence_table(
+        resources=resources, meta=meta, check_biomappings=check_biomappings
+    )
+    return [
+        get_known_maps(
+            target_def={"prefix": target} | resources[target],
+            source_def={"prefix": source} | resources[source],
+            resources=resources,
+            meta=meta,
+            evidence=evidence,
+        )
+        for source, target in combinations(resources, r=2)
+    ]
+
+
 def normalize_resource_def(resource_def: dict = None, resources: dict = None):
     """
     helper function for normalizing the prefix of a resource def
@@ -176,9 +340,14 @@ def load_bertmap(
     train_model: bool = False,
     global_matching: bool = True,
     use_auxiliary_mappings: bool = False,
+    lazy_ontologies: bool = True,
     **_,
 ):
-    """Load in the bertmap model (will download from hugging face if not present in ./bertmap)."""
+    """
+    Load in the bertmap model (will download from hugging face if not present in ./bertmap).
+    If lazy_ontologies, annotation indexes are read from an on disk cache and the ontologies are only loaded
+    in the jvm once bertmap needs them (e.g. for training or mapping refinement).
+    """
     if "dataset_dir" in meta:
         resource_path = meta["dataset_dir"]
     else:
@@ -216,13 +385,14 @@ def load_bertmap(
     source_fname = get_resource_file_name(
         resource_def=source_def, resource_path=resource_path
     )
-    logger.info("loading source onto")
-    source_onto = Ontology(source_fname)
-    logger.info("loading target onto")
     target_fname = get_resource_file_name(
         resource_def=target_def, resource_path=resource_path
     )
-    target_onto = Ontology(target_fname)
+    onto_class = LazyOntology if lazy_ontologies else Ontology
+    logger.info("loading source onto")
+    source_onto = onto_class(source_fname)
+    logger.info("loading target onto")
+    target_onto = onto_class(target_fname)
     logger.info("loading model")
     return BERTMapPipeline(source_onto, target_onto, config)
 
@@ -230,6 +400,288 @@ def load_bertmap(
 # # inference
 
 
-def bertmap_inference():
-    """Run inference on a single pair of ontologies using BertMap."""
-    ### TODO: Add functionality for using the model to infer matches
+def find_bertmap_checkpoint(model_dir: str = "bertmap"):
+    """returns the path of the fine-tuned bert in a bertmap output directory (the final model or the last checkpoint)"""
+    bert_dir = os.path.join(model_dir, "bert")
+    if os.path.isdir(os.path.join(bert_dir, "final")):
+        return os.path.join(bert_dir, "final")
+    checkpoints = sorted(
+        glob.glob(os.path.join(bert_dir, "checkpoint-*")),
+        key=lambda x: int(x.rsplit("-", 1)[-1]),
+    )
+    if not checkpoints:
+        raise FileNotFoundError(f"no bert checkpoint found in {bert_dir}")
+    return checkpoints[-1]
+
+
+def get_annotations(resource_def: dict, resource_path: str, meta: dict = None):
+    """returns the names and synonyms of every class in the obo file of a resource"""
+    resource_fname = get_resource_file_name(
+        resource_def=resource_def, resource_path=resource_path, meta=meta
+    )
+    cache_path = get_annotation_cache_path(resource_fname)
+    if is_cache_fresh(cache_path, resource_fname):
+        logger.info(f"found cached annotations at {cache_path}")
+        return read_annotation_cache(cache_path)
+    logger.info(f"reading annotations from {resource_fname}")
+    obo = pyobo.from_obo_path(
+        resource_fname,
+        prefix=resource_def["prefix"],
+        version=resource_def["version"],
+    )
+    annotations = {}
+    for term in obo:
+        labels = [term.name] if term.name else []
+        labels += [synonym.name for synonym in term.synonyms]
+        labels = list(dict.fromkeys(x for x in labels if x))
+        if labels:
+            annotations[f"{resource_def['prefix']}:{term.identifier}"] = labels
+    write_annotation_cache(cache_path, annotations)
+    return annotations
+
+
+def build_subword_index(annotations: dict, tokenizer):
+    """
+    build an inverted index from the sub-word tokens of the labels of each class to the classes.
+    returns the index, the idf of each token and the tokens of each class
+    """
+    identifiers = list(annotations)
+    class_tokens = {}
+    for identifier in identifiers:
+        token_ids = tokenizer(
+            [x.lower() for x in annotations[identifier]], add_special_tokens=False
+        )["input_ids"]
+        class_tokens[identifier] = {x for ids in token_ids for x in ids}
+    index = {}
+    for identifier, tokens in class_tokens.items():
+        for token in tokens:
+            index.setdefault(token, []).append(identifier)
+    idf = {
+        token: math.log(len(identifiers) / len(classes))
+        for token, classes in index.items()
+    }
+    return index, idf, class_tokens
+
+
+def retrieve_candidates(tokens: set, index: dict, idf: dict, num_candidates: int):
+    """returns the classes sharing the most informative sub-word tokens (by idf) with a set of tokens"""
+    scores = {}
+    for token in tokens:
+        for identifier in index.get(token, []):
+            scores[identifier] = scores.get(identifier, 0.0) + idf[token]
+    return heapq.nlargest(num_candidates, scores, key=scores.get)
+
+
+@torch.no_grad()
+def score_label_pairs(
+    model, tokenizer, label_pairs: list, batch_size: int = 512, max_length: int = 64
+):
+    """returns the synonym probability of each (source label, target label) pair"""
+    scores = []
+    for i in range(0, len(label_pairs), batch_size):
+        batch = label_pairs[i : i + batch_size]
+        inputs = tokenizer(
+            [x[0] for x in batch],
+            [x[1] for x in batch],
+            padding=True,
+            truncation=True,
+            max_length=max_length,
+            return_tensors="pt",
+        )
+        logits = model(**inputs).logits
+        scores.append(torch.softmax(logits, dim=-1)[:, 1].numpy())
+    return np.concatenate(scores) if scores else np.zeros(0)
+
+
+def score_candidates(
+    model,
+    tokenizer,
+    source_annotations: dict,
+    target_annotations: dict,
+    candidates: dict,
+    max_labels: int = 5,
+    batch_size: int = 512,
+):
+    """
+    score candidate class pairs as the mean synonym probability of their label pairs, like bertmap.
+    Pairs that share a label (ignoring case) get a score of 1 without running the model.
+    returns a list of (source identifier, target identifier, score)
+    """
+    label_pairs = []
+    owners = []
+    scored = []
+    for source, targets in candidates.items():
+        source_labels = source_annotations[source][:max_labels]
+        for target in targets:
+            target_labels = target_annotations[target][:max_labels]
+            if {x.lower() for x in source_labels} & {x.lower() for x in target_labels}:
+                scored.append((source, target, 1.0))
+                continue
+            for source_label in source_labels:
+                for target_label in target_labels:
+                    label_pairs.append((source_label, target_label))
+                    owners.append((source, target))
+    scores = score_label_pairs(model, tokenizer, label_pairs, batch_size=batch_size)
+    pair_scores = {}
+    for owner, score in zip(owners, scores):
+        pair_scores.setdefault(owner, []).append(score)
+    scored += [
+        (source, target, float(np.mean(pair_score)))
+        for (source, target), pair_score in pair_scores.items()
+    ]
+    return scored
+
+
+def load_bertmap_model(checkpoint_path: str = None, model_dir: str = "bertmap"):
+    """load a fine-tuned bertmap classifier and its tokenizer for inference"""
+    checkpoint_path = checkpoint_path or find_bertmap_checkpoint(model_dir)
+    logger.info(f"loading model from {checkpoint_path}")
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint_path)
+    model = AutoModelForSequenceClassification.from_pretrained(checkpoint_path)
+    model.eval()
+    return model, tokenizer
+
+
+def get_onto_index(resource_def: dict, resource_path: str, tokenizer, meta: dict = None):
+    """returns the annotations of a resource with its sub-word index (see build_subword_index)"""
+    annotations = get_annotations(resource_def, resource_path, meta=meta)
+    index, idf, class_tokens = build_subword_index(annotations, tokenizer)
+    return {
+        "annotations": annotations,
+        "index": index,
+        "idf": idf,
+        "class_tokens": class_tokens,
+    }
+
+
+def match_bertmap_pair(
+    model,
+    tokenizer,
+    source: dict,
+    target: dict,
+    source_prefix: str,
+    target_prefix: str,
+    output_path: str,
+    num_candidates: int = 200,
+    num_best: int = 10,
+    min_score: float = 0.9,
+    max_labels: int = 5,
+    batch_size: int = 512,
+    chunk_size: int = 1000,
+    **_,
+):
+    """
+    match the source and target ontology indexes (see get_onto_index) with a loaded model.
+    Mappings are streamed to a temporary file which is moved to output_path once the pair is done
+    """
+    sources = list(source["annotations"])
+    source_names = {x: labels[0] for x, labels in source["annotations"].items()}
+    target_names = {x: labels[0] for x, labels in target["annotations"].items()}
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(f"{output_path}.tmp", "w") as f:
+        ## the header is written once up front, so a source ontology without classes still gives a valid file
+        pl.DataFrame(schema=BERTMAP_MAPPINGS_SCHEMA).write_csv(f, separator="\t")
+        for i in tqdm(range(0, len(sources), chunk_size), desc="bertmap inference"):
+            candidates = {
+                x: retrieve_candidates(
+                    source["class_tokens"][x],
+                    target["index"],
+                    target["idf"],
+                    num_candidates,
+                )
+                for x in sources[i : i + chunk_size]
+            }
+            scored = score_candidates(
+                model,
+                tokenizer,
+                source_annotations=source["annotations"],
+                target_annotations=target["annotations"],
+                candidates=candidates,
+                max_labels=max_labels,
+                batch_size=batch_size,
+            )
+            df = (
+                pl.DataFrame(scored, schema=SCORED_SCHEMA, orient="row")
+                .filter(pl.col("confidence") >= min_score)
+                .filter(
+                    pl.col("confidence")
+                    .rank("ordinal", descending=True)
+                    .over("source identifier")
+                    <= num_best
+                )
+                .with_columns(
+                    pl.lit(source_prefix).alias("source prefix"),
+                    pl.col("source identifier")
+                    .replace_strict(source_names, return_dtype=pl.String)
+                    .alias("source name"),
+                    pl.lit("skos:exactMatch").alias("relation"),
+                    pl.lit(target_prefix).alias("target prefix"),
+                    pl.col("target identifier")
+                    .replace_strict(target_names, return_dtype=pl.String)
+                    .alias("target name"),
+                    pl.lit("semapv:SemanticSimilarityThresholdMatching").alias("type"),
+                    pl.lit("bertmap").alias("source"),
+                )
+                .select(BERTMAP_MAPPINGS_SCHEMA.names())
+            )
+            df.write_csv(f, separator="\t", include_header=False)
+    os.replace(f"{output_path}.tmp", output_path)
+    logger.info(f"wrote bertmap mappings to {output_path}")
+    return output_path
+
+
+def get_bertmap_output_path(source_prefix: str, target_prefix: str, meta: dict):
+    """returns the default path of the inference output of a pair"""
+    return os.path.join(
+        os.getcwd(),
+        "output",
+        "bertmap",
+        meta["landscape"],
+        f"{source_prefix}-{target_prefix}",
+        "bertmap_mappings.tsv",
+    )
+
+
+def bertmap_inference(
+    target_def: dict,
+    source_def: dict,
+    meta: dict,
+    checkpoint_path: str = None,
+    model_dir: str = "bertmap",
+    output_path: str = None,
+    n_threads: int = None,
+    **match_args,
+):
+    """
+    Run inference on a single pair of ontologies using a trained BertMap model.
+    Candidates for every source class are retrieved from a sub-word inverted index of the target labels
+    and scored on cpu in large batches. Mappings are streamed to a biomappings formatted tsv file.
+    args:
+        checkpoint_path: fine-tuned bert to use, defaults to the one in model_dir (see find_bertmap_checkpoint)
+        match_args: passed to match_bertmap_pair
+            num_candidates: number of candidates retrieved for each source class
+            num_best: number of best scoring targets kept for each source class
+            min_score: minimum score of a kept mapping
+            max_labels: maximum number of labels of a class used for scoring
+            chunk_size: number of source classes scored and written at a time
+    returns the path of the mappings file
+    """
+    resource_path = meta.get("dataset_dir", "resources/")
+    source_def = normalize_resource_def(resource_def=source_def.copy())
+    target_def = normalize_resource_def(resource_def=target_def.copy())
+    output_path = output_path or get_bertmap_output_path(
+        source_def["prefix"], target_def["prefix"], meta
+    )
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    model, tokenizer = load_bertmap_model(checkpoint_path, model_dir=model_dir)
+    return match_bertmap_pair(
+        model,
+        tokenizer,
+        source=get_onto_index(source_def, resource_path, tokenizer, meta=meta),
+        target=get_onto_index(target_def, resource_path, tokenizer, meta=meta),
+        source_prefix=source_def["prefix"],
+        target_prefix=target_def["prefix"],
+        output_path=output_path,
+        **match_args,
+    )
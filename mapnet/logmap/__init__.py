@@ -1 +1,8 @@
 from .utils import *
+from .scheduler import *
+from .session import *
+from .jobs import *
+from .work_queue import *
+from .sharding import *
+from .hub import *
+from .incremental import *
@@ -0,0 +1,267 @@
+"""
+Hub and spoke landscape matching. Every resource is matched against one or more hub ontologies (e.g. MONDO)
+and spoke to spoke mappings are inferred by composing mappings through the hub. Direct logmap runs are
+only used for spoke pairs where a spoke is poorly covered by the hub.
+"""
+
+import os
+from itertools import combinations
+
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.logmap.scheduler import run_logmap_jobs
+from mapnet.logmap.utils import logmap_arg_factory, merge_logmap_mappings
+from mapnet.utils import get_hierarchy_graph, get_network_graph, get_prefix_classes
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def run_logmap_for_pairs(
+    pairs: set,
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    tag: str,
+    dataset_dir: str = None,
+    output_dir: str = None,
+    singularity: bool = False,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    mode: str = "matcher",
+    **_,
+):
+    """run logmap concurrently for a given set of (unordered) resource pairs"""
+    pairs = {frozenset(pair) for pair in pairs}
+    logmap_args = [
+        logmap_arg
+        for logmap_arg in logmap_arg_factory(
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=tag,
+            dataset_dir=dataset_dir,
+            output_dir=output_dir,
+            singularity=singularity,
+            mode=mode,
+        )
+        if frozenset(
+            [logmap_arg["source_def"]["prefix"], logmap_arg["target_def"]["prefix"]]
+        )
+        in pairs
+    ]
+    run_logmap_jobs(
+        logmap_args,
+        max_memory_gb=max_memory_gb,
+        max_cpus=max_cpus,
+        cpus_per_job=cpus_per_job,
+    )
+
+
+def compose_through_hub(mapping_df: pl.DataFrame, hub_prefixes: list):
+    """
+    infer spoke to spoke mappings by chaining spoke -> hub -> spoke mappings.
+    The confidence of an inferred mapping is the product of the two confidences, and when a pair of spoke classes
+    is connected through several hub classes the most confident chain is kept. The hub class is kept as provenance.
+    args:
+        mapping_df: undirected mappings in the format of merge_logmap_mappings
+        hub_prefixes: prefixes of the hub ontologies
+    """
+    to_hub = mapping_df.filter(
+        ~pl.col("source prefix").is_in(hub_prefixes)
+        & pl.col("target prefix").is_in(hub_prefixes)
+    ).select(
+        "source prefix",
+        "source identifier",
+        "source name",
+        pl.col("target identifier").alias("hub identifier"),
+        pl.col("confidence").alias("source confidence"),
+    )
+    from_hub = to_hub.rename(
+        {
+            "source prefix": "target prefix",
+            "source identifier": "target identifier",
+            "source name": "target name",
+            "source confidence": "target confidence",
+        }
+    )
+    return (
+        to_hub.join(from_hub, on="hub identifier")
+        .filter(pl.col("source prefix") != pl.col("target prefix"))
+        .with_columns(
+            (pl.col("source confidence") * pl.col("target confidence")).alias(
+                "confidence"
+            ),
+            pl.lit("skos:exactMatch").alias("relation"),
+            pl.lit("semapv:MappingChaining").alias("type"),
+            pl.lit("logmap-hub").alias("source"),
+        )
+        .sort("confidence", descending=True)
+        .unique(["source identifier", "target identifier"], keep="first")
+        .select(
+            [
+                "source prefix",
+                "source identifier",
+                "source name",
+                "relation",
+                "target prefix",
+                "target identifier",
+                "target name",
+                "type",
+                "confidence",
+                "source",
+                "hub identifier",
+            ]
+        )
+    )
+
+
+def get_class_count(resources: dict, meta: dict, prefix: str):
+    """number of classes of a resource in the ontology that was matched (its subset if it has one)"""
+    graph = get_hierarchy_graph(
+        get_network_graph(resources=resources, meta=meta, prefix=prefix)
+    )
+    return len(get_prefix_classes(graph, prefix))
+
+
+def get_hub_coverage(
+    mapping_df: pl.DataFrame,
+    resources: dict,
+    meta: dict,
+    hub_prefixes: list,
+    **_,
+):
+    """returns the fraction of classes of each spoke that have a mapping to each hub"""
+    spoke_prefixes = [x for x in resources if x not in hub_prefixes]
+    n_classes = pl.DataFrame(
+        {
+            "source prefix": spoke_prefixes,
+            "n_classes": [
+                get_class_count(resources=resources, meta=meta, prefix=prefix)
+                for prefix in spoke_prefixes
+            ],
+        },
+        schema={"source prefix": pl.String, "n_classes": pl.Int64},
+    )
+    return (
+        mapping_df.filter(
+            ~pl.col("source prefix").is_in(hub_prefixes)
+            & pl.col("target prefix").is_in(hub_prefixes)
+        )
+        .group_by("source prefix", "target prefix")
+        .agg(pl.col("source identifier").n_unique().alias("n_mapped"))
+        .join(n_classes, on="source prefix")
+        .with_columns((pl.col("n_mapped") / pl.col("n_classes")).alias("coverage"))
+        .rename({"source prefix": "prefix", "target prefix": "hub prefix"})
+    )
+
+
+def select_direct_pairs(
+    coverage: pl.DataFrame, spoke_prefixes: list, min_coverage: float = 0.5
+):
+    """returns the spoke pairs that need a direct logmap run since one of the spokes is poorly covered by every hub"""
+    best_coverage = dict(
+        coverage.group_by("prefix").agg(pl.col("coverage").max()).iter_rows()
+    )
+    poorly_covered = {
+        prefix
+        for prefix in spoke_prefixes
+        if best_coverage.get(prefix, 0.0) < min_coverage
+    }
+    logger.info(f"spokes poorly covered by the hub(s): {sorted(poorly_covered)}")
+    return {
+        (source, target)
+        for source, target in combinations(spoke_prefixes, r=2)
+        if source in poorly_covered or target in poorly_covered
+    }
+
+
+def run_logmap_hub_and_spoke(
+    hub_prefixes: list,
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    tag: str,
+    min_coverage: float = 0.5,
+    additional_namespaces: dict = None,
+    output_dir: str = None,
+    **run_args,
+):
+    """
+    match every resource against the hub ontologies, run logmap directly only for spoke pairs with poor hub coverage,
+    then infer the remaining spoke to spoke mappings through the hubs.
+    Direct and inferred mappings are written to full_analysis/full_mappings.tsv and full_analysis/hub_inferred_mappings.tsv
+    returns the merged direct mappings and the inferred mappings
+    """
+    resources = {normalize_prefix(prefix): resources[prefix] for prefix in resources}
+    hub_prefixes = [normalize_prefix(x) for x in hub_prefixes]
+    spoke_prefixes = [x for x in resources if x not in hub_prefixes]
+    hub_pairs = {
+        (hub, prefix)
+        for hub in hub_prefixes
+        for prefix in resources
+        if prefix != hub
+    }
+    logger.info(f"running {len(hub_pairs)} hub pairs")
+    run_logmap_for_pairs(
+        pairs=hub_pairs,
+        analysis_name=analysis_name,
+        resources=resources,
+        meta=meta,
+        tag=tag,
+        output_dir=output_dir,
+        **run_args,
+    )
+    mapping_df = merge_logmap_mappings(
+        meta=meta,
+        analysis_name=analysis_name,
+        output_dir=output_dir,
+        resources=resources,
+        additional_namespaces=additional_namespaces,
+    )
+    coverage = get_hub_coverage(
+        mapping_df=mapping_df,
+        resources=resources,
+        meta=meta,
+        hub_prefixes=hub_prefixes,
+    )
+    direct_pairs = select_direct_pairs(
+        coverage=coverage, spoke_prefixes=spoke_prefixes, min_coverage=min_coverage
+    )
+    if direct_pairs:
+        logger.info(f"running {len(direct_pairs)} direct spoke pairs")
+        run_logmap_for_pairs(
+            pairs=direct_pairs,
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=tag,
+            output_dir=output_dir,
+            **run_args,
+        )
+        mapping_df = merge_logmap_mappings(
+            meta=meta,
+            analysis_name=analysis_name,
+            output_dir=output_dir,
+            resources=resources,
+            additional_namespaces=additional_namespaces,
+        )
+    inferred_df = compose_through_hub(mapping_df=mapping_df, hub_prefixes=hub_prefixes)
+    ## keep direct matches where we have them
+    inferred_df = inferred_df.join(
+        mapping_df, on=["source identifier", "target identifier"], how="anti"
+    )
+    write_dir = os.path.join(
+        output_dir
+        or meta.get(
+            "output_dir", os.path.join(os.getcwd(), "output", "logmap", analysis_name)
+        ),
+        "full_analysis",
+    )
+    coverage.write_csv(os.path.join(write_dir, "hub_coverage.tsv"), separator="\t")
+    inferred_df.write_csv(
+        os.path.join(write_dir, "hub_inferred_mappings.tsv"), separator="\t"
+    )
+    return mapping_df, inferred_df
@@ -0,0 +1,338 @@
+"""
+Incremental re-matching when a resource moves to a new version.
+The term tables of the old and new versions are compared (added, removed, renamed and re-parented classes),
+mappings of unchanged classes are carried forward from the previous logmap output and only the changed
+classes and their neighborhood are matched again.
+The new version is expected to be downloaded (and subset) in the dataset directory like any other resource.
+"""
+
+import datetime
+import json
+import os
+import shutil
+
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.logmap.jobs import (
+    LOGMAP_MODES,
+    get_job_key,
+    get_onto_file,
+    make_logmap_job,
+)
+from mapnet.logmap.scheduler import run_logmap_jobs
+from mapnet.logmap.utils import (
+    LOGMAP_MAPPINGS_SCHEMA,
+    logmap_arg_factory,
+    parse_logmap_identifiers,
+)
+from mapnet.utils import (
+    ancestors_within_distance,
+    descendants_within_distance,
+    get_name_from_curie,
+    get_hierarchy_graph,
+    get_name_maps,
+    get_network_graph,
+    get_onto_subset_from_file,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+TERM_TABLE_SCHEMA = pl.Schema(
+    [
+        ("identifier", pl.String),
+        ("name", pl.String),
+        ("parents", pl.List(pl.String)),
+    ]
+)
+
+
+def get_term_table(prefix: str, resources: dict, meta: dict):
+    """
+    returns the classes of a resource with their name and direct parents.
+    The table is cached as terms.parquet next to the ontology file
+    """
+    onto_def = {
+        "prefix": prefix,
+        "version": resources[prefix]["version"],
+        "subset": resources[prefix]["subset"],
+        "subset_name": meta["subset_dir"],
+    }
+    table_path = os.path.join(
+        meta["dataset_dir"], os.path.dirname(get_onto_file(onto_def)), "terms.parquet"
+    )
+    if os.path.exists(table_path):
+        return pl.read_parquet(table_path)
+    graph = get_hierarchy_graph(
+        get_network_graph(resources=resources, meta=meta, prefix=prefix)
+    )
+    name_maps = get_name_maps(resources={prefix: resources[prefix]})
+    identifiers = set(graph.nodes) | {
+        f"{prefix}:{identifier}" for identifier in name_maps[prefix]
+    }
+    ## the hierarchy has the is_a edges of the pyobo graph flipped to go from parent to child
+    terms = pl.DataFrame(
+        [
+            (
+                identifier,
+                get_name_from_curie(identifier, name_maps=name_maps),
+                sorted(graph.predecessors(identifier)) if identifier in graph else [],
+            )
+            for identifier in sorted(identifiers)
+        ],
+        schema=TERM_TABLE_SCHEMA,
+        orient="row",
+    )
+    terms.write_parquet(table_path)
+    return terms
+
+
+def diff_term_tables(old_terms: pl.DataFrame, new_terms: pl.DataFrame):
+    """
+    compare the term tables of two versions of a resource.
+    returns a df with the identifier, old and new name and parents and the change of every class,
+    one of added, removed, renamed, reparented (renamed wins if both changed) or unchanged
+    """
+    return (
+        old_terms.join(new_terms, on="identifier", how="full", suffix=" new", coalesce=True)
+        .rename({"name": "name old", "parents": "parents old"})
+        .with_columns(
+            pl.when(pl.col("name old").is_null() & pl.col("parents old").is_null())
+            .then(pl.lit("added"))
+            .when(pl.col("name new").is_null() & pl.col("parents new").is_null())
+            .then(pl.lit("removed"))
+            .when(pl.col("name old") != pl.col("name new"))
+            .then(pl.lit("renamed"))
+            .when(pl.col("parents old") != pl.col("parents new"))
+            .then(pl.lit("reparented"))
+            .otherwise(pl.lit("unchanged"))
+            .alias("change")
+        )
+    )
+
+
+def get_rematch_classes(diff: pl.DataFrame, graph, radius: int = 1):
+    """returns the added, renamed and re-parented classes and their parents and children within radius"""
+    changed = diff.filter(pl.col("change").is_in(["added", "renamed", "reparented"]))[
+        "identifier"
+    ].to_list()
+    rematch = set(changed)
+    for identifier in changed:
+        if identifier not in graph:
+            continue
+        rematch |= descendants_within_distance(graph, identifier, max_distance=radius)
+        rematch |= ancestors_within_distance(graph, identifier, max_distance=radius)
+    return rematch
+
+
+def read_pair_mappings(output_path: str, mode: str = "matcher"):
+    """read the raw logmap mappings of a pair with the parsed curies of both entities"""
+    mappings_path = os.path.join(output_path, LOGMAP_MODES[mode]["mappings_file"])
+    if not os.path.exists(mappings_path):
+        return None
+    return parse_logmap_identifiers(
+        pl.scan_csv(
+            mappings_path,
+            separator="\t",
+            has_header=False,
+            schema=LOGMAP_MAPPINGS_SCHEMA,
+        ),
+        keep_iris=True,
+    ).collect()
+
+
+def filter_pair_mappings(mappings: pl.DataFrame, prefix: str, identifiers: set):
+    """keep the mappings whose class from prefix is one of identifiers"""
+    identifiers = list(identifiers)
+    return mappings.filter(
+        (
+            pl.col("source identifier").str.starts_with(f"{prefix}:")
+            & pl.col("source identifier").is_in(identifiers)
+        )
+        | (
+            pl.col("target identifier").str.starts_with(f"{prefix}:")
+            & pl.col("target identifier").is_in(identifiers)
+        )
+    )
+
+
+def run_logmap_incremental(
+    prefix: str,
+    new_version: str,
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    tag: str,
+    radius: int = 1,
+    dataset_dir: str = None,
+    output_dir: str = None,
+    incremental_dir: str = None,
+    singularity: bool = False,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    mode: str = "matcher",
+    report_path: str = None,
+    **_,
+):
+    """
+    move one resource of an analysis to a new version without re-matching every pair.
+    The changed classes of the new version and their neighborhood (within radius) are extracted with their ancestors
+    as context and matched against each partner. Mappings of unchanged classes are carried forward from the
+    previous output of each pair, and the combined mappings replace it (marked complete for the new version)
+    so they are picked up by merge_logmap_mappings.
+    args:
+        prefix: the resource that changed version
+        new_version: its new version
+        resources: the resources of the analysis at their previous versions
+    returns the diff of the term tables
+    """
+    resources = {normalize_prefix(x): resources[x] for x in resources}
+    prefix = normalize_prefix(prefix)
+    old_version = resources[prefix]["version"]
+    new_resources = resources | {prefix: resources[prefix] | {"version": new_version}}
+    meta = meta | {"dataset_dir": dataset_dir or meta.get("dataset_dir", "resources")}
+    incremental_dir = incremental_dir or os.path.join(
+        os.getcwd(), "output", "logmap_incremental", analysis_name
+    )
+    os.makedirs(incremental_dir, exist_ok=True)
+    ## find what changed between the versions
+    diff = diff_term_tables(
+        get_term_table(prefix, resources=resources, meta=meta),
+        get_term_table(prefix, resources=new_resources, meta=meta),
+    )
+    diff.with_columns(
+        pl.col("parents old").list.join("|"), pl.col("parents new").list.join("|")
+    ).write_csv(
+        os.path.join(incremental_dir, f"{prefix}_{old_version}_{new_version}_diff.tsv"),
+        separator="\t",
+    )
+    logger.info(
+        f"{prefix} {old_version} -> {new_version}: {dict(diff['change'].value_counts().iter_rows())}"
+    )
+    graph = get_hierarchy_graph(
+        get_network_graph(resources=new_resources, meta=meta, prefix=prefix)
+    )
+    rematch = get_rematch_classes(diff, graph=graph, radius=radius)
+    carry = set(
+        diff.filter(pl.col("change") == "unchanged")["identifier"].to_list()
+    ) - rematch
+    logger.info(f"rematching {len(rematch)} classes, carrying forward {len(carry)}")
+    ## extract the classes to rematch with their ancestors as context
+    new_onto_file = get_onto_file(
+        {
+            "prefix": prefix,
+            "version": new_version,
+            "subset": resources[prefix]["subset"],
+            "subset_name": meta["subset_dir"],
+        }
+    )
+    delta_file = os.path.join(
+        os.path.dirname(new_onto_file), f"delta_{old_version}", f"{prefix}.obo"
+    )
+    if rematch:
+        os.makedirs(
+            os.path.join(meta["dataset_dir"], os.path.dirname(delta_file)), exist_ok=True
+        )
+        get_onto_subset_from_file(
+            prefix=prefix,
+            onto_path=os.path.join(meta["dataset_dir"], new_onto_file),
+            subset_identifiers=[x.split(":", 1)[-1] for x in sorted(rematch)],
+            method="ancestor",
+            output_path=os.path.join(meta["dataset_dir"], delta_file),
+            report_path=report_path,
+        )
+    ## match the changed classes against each partner
+    pairs = []
+    delta_args = []
+    for logmap_arg in logmap_arg_factory(
+        analysis_name=analysis_name,
+        resources=new_resources,
+        meta=meta,
+        tag=tag,
+        dataset_dir=meta["dataset_dir"],
+        output_dir=output_dir,
+        singularity=singularity,
+        mode=mode,
+    ):
+        side = [
+            x for x in ["source", "target"] if logmap_arg[f"{x}_def"]["prefix"] == prefix
+        ]
+        if not side:
+            continue
+        pair_name = os.path.basename(os.path.normpath(logmap_arg["output_path"]))
+        delta_output = os.path.join(incremental_dir, pair_name, new_version)
+        pairs.append((logmap_arg, delta_output))
+        if rematch:
+            delta_args.append(
+                logmap_arg
+                | {f"{side[0]}_onto_file": delta_file, "output_path": delta_output}
+            )
+    run_logmap_jobs(
+        delta_args,
+        max_memory_gb=max_memory_gb,
+        max_cpus=max_cpus,
+        cpus_per_job=cpus_per_job,
+    )
+    ## combine the carried forward and new mappings of every pair
+    for logmap_arg, delta_output in pairs:
+        previous = read_pair_mappings(logmap_arg["output_path"], mode=mode)
+        if previous is None:
+            logger.warning(
+                f"no previous output for {logmap_arg['output_path']}, run the pair in full"
+            )
+            continue
+        combined = [filter_pair_mappings(previous, prefix=prefix, identifiers=carry)]
+        if rematch:
+            combined.append(
+                filter_pair_mappings(
+                    read_pair_mappings(delta_output, mode=mode),
+                    prefix=prefix,
+                    identifiers=rematch,
+                )
+            )
+        combined = (
+            pl.concat(combined)
+            .group_by("TgtEntity", "SrcEntity")
+            .agg(pl.col("Score").max())
+            .select(LOGMAP_MAPPINGS_SCHEMA.names())
+        )
+        mappings_path = os.path.join(
+            logmap_arg["output_path"], LOGMAP_MODES[mode]["mappings_file"]
+        )
+        ## the previous output is only replaced once the combined mappings are fully written
+        combined.write_csv(
+            f"{mappings_path}.tmp", separator="\t", include_header=False
+        )
+        os.makedirs(delta_output, exist_ok=True)
+        shutil.copyfile(
+            mappings_path,
+            os.path.join(
+                delta_output,
+                f"previous_{old_version}_{os.path.basename(mappings_path)}",
+            ),
+        )
+        os.replace(f"{mappings_path}.tmp", mappings_path)
+        job = make_logmap_job(**logmap_arg)
+        with open(
+            os.path.join(logmap_arg["output_path"], LOGMAP_MODES[mode]["marker"]), "w"
+        ) as f:
+            json.dump(
+                {
+                    "key": get_job_key(job),
+                    "job": job._asdict(),
+                    "finished": datetime.datetime.now().isoformat(),
+                    "incremental": {
+                        "prefix": prefix,
+                        "old_version": old_version,
+                        "new_version": new_version,
+                        "rematched": len(rematch),
+                        "carried": len(carry),
+                    },
+                },
+                f,
+                indent=2,
+            )
+        logger.info(f"wrote {len(combined)} mappings to {logmap_arg['output_path']}")
+    return diff
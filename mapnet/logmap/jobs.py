@@ -0,0 +1,307 @@
+"""Content addressed, resumable logmap jobs"""
+
+import datetime
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+from functools import lru_cache
+from typing import NamedTuple
+
+from mapnet.utils.accounting import run_accounted
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOGMAP_JAR = "/package/logmap-matcher-4.0.jar"
+SIF_PATH = "mapnet/logmap/container/logmap.sif"
+## jvm options other than the heap, the heap does not change the result so it is not part of the job key
+JVM_OPTIONS = ["--add-opens", "java.base/java.lang=ALL-UNNAMED"]
+## the full matcher, and the lexical only logmap-lite matcher (no reasoning or repair) shipped in the same jar
+LOGMAP_LITE_CLASS = "uk.ac.ox.krr.logmap_lite.LogMap_Lite"
+LOGMAP_MODES = {
+    "matcher": {
+        "mappings_file": "logmap2_mappings.tsv",
+        "marker": "logmap_complete.json",
+        "log": "logmap.log",
+    },
+    "lite": {
+        "mappings_file": "logmap_lite_mappings.tsv",
+        "marker": "logmap_lite_complete.json",
+        "log": "logmap_lite.log",
+    },
+}
+
+
+class LogMapJob(NamedTuple):
+    """immutable specification of a single logmap run"""
+
+    source_prefix: str
+    target_prefix: str
+    source_onto_file: str  ## relative to dataset_dir
+    target_onto_file: str  ## relative to dataset_dir
+    output_path: str
+    dataset_dir: str
+    tag: str = "0.01"
+    singularity: bool = False
+    heap: str = "32g"
+    report_path: str = None
+    mode: str = "matcher"
+
+
+def parse_heap_gb(heap: str):
+    """parse a jvm heap size (e.g. "32g", "512m" or "1024k") into GB"""
+    units = {"k": 1 / 1024**2, "m": 1 / 1024, "g": 1, "t": 1024}
+    heap = heap.strip().lower()
+    if heap[-1] in units:
+        return float(heap[:-1]) * units[heap[-1]]
+    ## a heap without a unit is in bytes
+    return float(heap) / 1024**3
+
+
+def format_heap(heap_gb: float):
+    """format a heap size in GB as a jvm option, in MB if it is not a whole number of GB"""
+    if heap_gb == int(heap_gb):
+        return f"{int(heap_gb)}g"
+    return f"{int(heap_gb * 1024)}m"
+
+
+def get_onto_file(onto_def: dict):
+    """returns the path of an ontology relative to the dataset directory from its definition"""
+    onto_name = (
+        onto_def["prefix"] + ".obo"
+        if not onto_def["subset"]
+        else os.path.join(onto_def["subset_name"], onto_def["prefix"] + ".obo")
+    )
+    return os.path.join(onto_def["prefix"], onto_def["version"], onto_name)
+
+
+def make_logmap_job(
+    output_path: str,
+    dataset_dir: str = "resources/",
+    target_onto_file: str = None,
+    source_onto_file: str = None,
+    target_def: dict = None,
+    source_def: dict = None,
+    tag: str = "0.01",
+    singularity: bool = False,
+    heap: str = "32g",
+    report_path: str = None,
+    mode: str = "matcher",
+    **_,
+):
+    """make a logmap job from the keyword arguments of run_logmap"""
+    if mode not in LOGMAP_MODES:
+        raise ValueError(f"mode must be one of {list(LOGMAP_MODES)}, got {mode}")
+    if target_onto_file is None:
+        if target_def is None:
+            raise ValueError("must define either target_onto_file or target_def")
+        target_onto_file = get_onto_file(target_def)
+    if source_onto_file is None:
+        if source_def is None:
+            raise ValueError("must define either source_onto_file or source_def")
+        source_onto_file = get_onto_file(source_def)
+    return LogMapJob(
+        source_prefix=source_def["prefix"] if source_def else None,
+        target_prefix=target_def["prefix"] if target_def else None,
+        source_onto_file=source_onto_file,
+        target_onto_file=target_onto_file,
+        output_path=output_path,
+        dataset_dir=dataset_dir,
+        tag=tag,
+        singularity=singularity,
+        heap=heap,
+        report_path=report_path,
+        mode=mode,
+    )
+
+
+@lru_cache(maxsize=None)
+def _hash_file(pth: str, size: int, mtime_ns: int):
+    """hash the content of a file, cached on its size and modification time"""
+    sha = hashlib.sha256()
+    with open(pth, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_file(pth: str):
+    """returns the sha256 of a file, only reading it again if it changed"""
+    stat = os.stat(pth)
+    return _hash_file(pth, stat.st_size, stat.st_mtime_ns)
+
+
+def get_job_key(job: LogMapJob):
+    """returns a key for a job from the content of both input ontologies, the logmap image and jvm options"""
+    image = SIF_PATH if job.singularity else f"logmap:{job.tag}"
+    key = {
+        "source": hash_file(os.path.join(job.dataset_dir, job.source_onto_file)),
+        "target": hash_file(os.path.join(job.dataset_dir, job.target_onto_file)),
+        "image": image,
+        "jar": LOGMAP_JAR,
+        "jvm_options": JVM_OPTIONS,
+        "mode": job.mode,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def is_job_complete(job: LogMapJob, key: str = None):
+    """check if a job finished for the current inputs"""
+    marker_path = os.path.join(job.output_path, LOGMAP_MODES[job.mode]["marker"])
+    if not os.path.exists(marker_path) or not os.path.exists(
+        os.path.join(job.output_path, LOGMAP_MODES[job.mode]["mappings_file"])
+    ):
+        return False
+    with open(marker_path, "r") as f:
+        marker = json.load(f)
+    return marker["key"] == (key or get_job_key(job))
+
+
+def write_job_marker(job: LogMapJob, key: str = None, **extra):
+    """mark a job as complete for its current inputs, extra fields are saved in the marker as is"""
+    marker_path = os.path.join(job.output_path, LOGMAP_MODES[job.mode]["marker"])
+    with open(marker_path, "w") as f:
+        json.dump(
+            {
+                "key": key or get_job_key(job),
+                "job": job._asdict(),
+                "finished": datetime.datetime.now().isoformat(),
+            }
+            | extra,
+            f,
+            indent=2,
+        )
+
+
+def get_logmap_cmd(job: LogMapJob):
+    """returns the container command to run a logmap job"""
+    if job.mode == "lite":
+        java_cmd = [
+            "java",
+            f"-Xmx{job.heap}",
+            *JVM_OPTIONS,
+            "-cp",
+            LOGMAP_JAR,
+            LOGMAP_LITE_CLASS,
+            f"file:///package/resources/{shlex.quote(job.target_onto_file)}",
+            f"file:///package/resources/{shlex.quote(job.source_onto_file)}",
+            f"/package/output/{LOGMAP_MODES['lite']['mappings_file']}",
+        ]
+    else:
+        java_cmd = [
+            "java",
+            "-jar",
+            f"-Xmx{job.heap}",
+            *JVM_OPTIONS,
+            LOGMAP_JAR,
+            "MATCHER",
+            f"file:///package/resources/{shlex.quote(job.target_onto_file)}",
+            f"file:///package/resources/{shlex.quote(job.source_onto_file)}",
+            "/package/output/",
+            "true",  # classify input ontology as well as map
+        ]
+    if job.singularity:
+        return [
+            "apptainer",
+            "run",
+            "-B",
+            f"{shlex.quote(job.output_path)}:/package/output",  # Mount where output will be written
+            "-B",
+            f"{shlex.quote(job.dataset_dir)}:/package/resources/",  ## mount directory with resources
+            SIF_PATH,
+            "sh",
+            "-c",
+            shlex.join(java_cmd),  ## add the java command as a string
+        ]
+    return [
+        "docker",
+        "run",
+        "--rm",
+        "-v",
+        f"{shlex.quote(job.output_path)}:/package/output",  # Mount where output will be written
+        "-v",
+        f"{shlex.quote(job.dataset_dir)}:/package/resources/",  ## mount directory with resources
+        f"logmap:{shlex.quote(job.tag)}",  ## specify the image and tag
+        "sh",
+        "-c",
+        shlex.join(java_cmd),  ## add the java command as a string
+    ]
+
+
+def is_out_of_memory(returncode: int, log_path: str):
+    """check if a failed logmap run ran out of memory"""
+    ## 137 is the exit code of a process killed by the oom killer
+    if returncode == 137:
+        return True
+    if os.path.exists(log_path):
+        with open(log_path, "r", errors="ignore") as f:
+            return any("OutOfMemoryError" in line for line in f)
+    return False
+
+
+def run_logmap_job(
+    job: LogMapJob,
+    max_retries: int = 2,
+    max_heap_gb: int = 64,
+    adopt_existing: bool = False,
+):
+    """
+    run a logmap job unless it already completed for the same inputs.
+    Runs that fail because they ran out of memory are retried with double the heap (up to max_heap_gb).
+    args:
+        job : job to run
+        max_retries : number of times to retry a run that ran out of memory
+        max_heap_gb : the largest heap to retry with
+        adopt_existing : mark output from before completion markers existed as complete instead of re-running it
+    """
+    key = get_job_key(job)
+    marker_path = os.path.join(job.output_path, LOGMAP_MODES[job.mode]["marker"])
+    mappings_path = os.path.join(
+        job.output_path, LOGMAP_MODES[job.mode]["mappings_file"]
+    )
+    if is_job_complete(job, key=key):
+        logger.info(f"{job.output_path} is already complete skipping!")
+        return job
+    if adopt_existing and os.path.exists(mappings_path) and not os.path.exists(marker_path):
+        logger.info(f"adopting existing output at {job.output_path}")
+    else:
+        ## remove stale output so it can not be mistaken for a result of this run
+        for pth in [marker_path, mappings_path]:
+            if os.path.exists(pth):
+                logger.info(f"removing stale {pth}")
+                os.remove(pth)
+        os.makedirs(job.output_path, exist_ok=True)
+        log_path = os.path.join(job.output_path, LOGMAP_MODES[job.mode]["log"])
+        for attempt in range(max_retries + 1):
+            try:
+                run_accounted(
+                    get_logmap_cmd(job),
+                    job_name=f"logmap_{job.mode}:{os.path.basename(os.path.normpath(job.output_path))}",
+                    report_path=job.report_path,
+                    inputs=[
+                        os.path.join(job.dataset_dir, job.source_onto_file),
+                        os.path.join(job.dataset_dir, job.target_onto_file),
+                    ],
+                    outputs=[job.output_path],
+                    mappings_path=mappings_path,
+                    log_path=log_path,
+                    heap=job.heap,
+                    attempt=attempt,
+                )
+                break
+            except subprocess.CalledProcessError as err:
+                heap_gb = parse_heap_gb(job.heap)
+                if (
+                    attempt == max_retries
+                    or heap_gb >= max_heap_gb
+                    or not is_out_of_memory(err.returncode, log_path)
+                ):
+                    raise
+                job = job._replace(heap=format_heap(min(heap_gb * 2, max_heap_gb)))
+                logger.warning(
+                    f"{job.output_path} ran out of memory, retrying with heap {job.heap}"
+                )
+    write_job_marker(job, key=key)
+    return job
@@ -0,0 +1,181 @@
+"""Size aware scheduling of logmap runs over a set of resource pairs"""
+
+import os
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mapnet.logmap.jobs import LOGMAP_MODES, format_heap, is_out_of_memory, parse_heap_gb
+from mapnet.logmap.utils import get_onto_file, run_logmap
+import logging
+
+logger = logging.getLogger(__name__)
+
+## rough cost model for logmap, heap grows about linearly with the size of the input ontologies
+MIN_HEAP_GB = 4
+MAX_HEAP_GB = 32
+HEAP_GB_PER_100MB = 6
+## memory used by the jvm and container on top of the heap
+OVERHEAD_GB = 1
+
+
+def get_pair_size_mb(logmap_arg: dict):
+    """returns the combined size in MB of the two ontologies of a logmap run"""
+    size = 0
+    for side in ["source", "target"]:
+        onto_file = logmap_arg.get(f"{side}_onto_file") or get_onto_file(
+            logmap_arg[f"{side}_def"]
+        )
+        onto_path = os.path.join(logmap_arg["dataset_dir"], onto_file)
+        if os.path.exists(onto_path):
+            size += os.path.getsize(onto_path)
+        else:
+            logger.warning(f"could not find {onto_path} to estimate its size")
+    return size / 1e6
+
+
+def estimate_heap_gb(
+    size_mb: float,
+    min_heap_gb: int = MIN_HEAP_GB,
+    max_heap_gb: int = MAX_HEAP_GB,
+    heap_gb_per_100mb: float = HEAP_GB_PER_100MB,
+):
+    """estimate the heap (in GB) logmap needs to match ontologies with a combined size of size_mb"""
+    heap_gb = min_heap_gb + int(size_mb * heap_gb_per_100mb / 100 + 0.5)
+    return max(min_heap_gb, min(heap_gb, max_heap_gb))
+
+
+def plan_logmap_jobs(
+    logmap_args: list,
+    max_memory_gb: int,
+    min_heap_gb: int = MIN_HEAP_GB,
+    max_heap_gb: int = MAX_HEAP_GB,
+    heap_gb_per_100mb: float = HEAP_GB_PER_100MB,
+):
+    """
+    estimate the cost of each logmap run and return them ordered largest first.
+    Each job gets a heap sized to its inputs which is never larger than the memory budget.
+    """
+    if max_memory_gb < min_heap_gb + OVERHEAD_GB:
+        raise ValueError(
+            f"a memory budget of {max_memory_gb}GB can not fit a logmap run, "
+            f"at least {min_heap_gb + OVERHEAD_GB}GB ({min_heap_gb}GB heap and {OVERHEAD_GB}GB overhead) is needed"
+        )
+    max_heap_gb = min(max_heap_gb, max_memory_gb - OVERHEAD_GB)
+    jobs = []
+    for logmap_arg in logmap_args:
+        size_mb = get_pair_size_mb(logmap_arg)
+        heap_gb = estimate_heap_gb(
+            size_mb,
+            min_heap_gb=min_heap_gb,
+            max_heap_gb=max_heap_gb,
+            heap_gb_per_100mb=heap_gb_per_100mb,
+        )
+        jobs.append(
+            {
+                "size_mb": size_mb,
+                "memory_gb": heap_gb + OVERHEAD_GB,
+                "max_heap_gb": max_heap_gb,
+                "attempt": 0,
+                ## retries after running out of memory go back through the scheduler (see get_oom_retry)
+                ## so that the larger heap is reserved from the budget
+                "logmap_arg": logmap_arg | {"heap": f"{heap_gb}g", "max_retries": 0},
+            }
+        )
+    ## longest job first, so that small jobs can fill in the gaps at the end
+    return sorted(jobs, key=lambda x: x["size_mb"], reverse=True)
+
+
+def get_oom_retry(job: dict, err: subprocess.CalledProcessError, max_retries: int):
+    """returns the job with double the heap (up to its max heap) if it ran out of memory and can be retried"""
+    logmap_arg = job["logmap_arg"]
+    log_path = os.path.join(
+        logmap_arg["output_path"],
+        LOGMAP_MODES[logmap_arg.get("mode", "matcher")]["log"],
+    )
+    heap_gb = parse_heap_gb(logmap_arg["heap"])
+    if (
+        job["attempt"] >= max_retries
+        or heap_gb >= job["max_heap_gb"]
+        or not is_out_of_memory(err.returncode, log_path)
+    ):
+        return None
+    heap_gb = min(heap_gb * 2, job["max_heap_gb"])
+    return job | {
+        "attempt": job["attempt"] + 1,
+        "memory_gb": heap_gb + OVERHEAD_GB,
+        "logmap_arg": logmap_arg | {"heap": format_heap(heap_gb)},
+    }
+
+
+def run_logmap_jobs(
+    logmap_args: list,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    max_retries: int = 2,
+    **heap_args,
+):
+    """
+    run a set of logmap jobs concurrently under a global memory and cpu budget.
+    A failed job does not stop the others, once every job has finished an error is raised listing the failed jobs.
+    args:
+        logmap_args : list of keyword arguments for run_logmap
+        max_memory_gb : total memory that can be used by all running jobs, defaults to the memory of the node
+        max_cpus : total cpus that can be used by all running jobs, defaults to the cpus of the node
+        cpus_per_job : number of cpus to reserve for each job (logmap and the jvm garbage collector)
+        max_retries : number of times a job that ran out of memory is queued again with double the heap
+        heap_args : passed to plan_logmap_jobs to tune the heap estimates
+    """
+    max_memory_gb = max_memory_gb or int(
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    )
+    max_cpus = max_cpus or os.cpu_count()
+    max_workers = max(1, max_cpus // cpus_per_job)
+    pending = plan_logmap_jobs(logmap_args, max_memory_gb=max_memory_gb, **heap_args)
+    logger.info(
+        f"running {len(pending)} logmap jobs with {max_memory_gb}GB and {max_workers} workers"
+    )
+    free_memory_gb = max_memory_gb
+    running = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ## start the largest pending jobs that fit in what is left of the budget
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if job["memory_gb"] <= free_memory_gb:
+                    pending.remove(job)
+                    free_memory_gb -= job["memory_gb"]
+                    logmap_arg = job["logmap_arg"]
+                    logger.info(
+                        f"starting {logmap_arg['output_path']} with heap {logmap_arg['heap']}"
+                    )
+                    running[executor.submit(run_logmap, **logmap_arg)] = job
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                free_memory_gb += job["memory_gb"]
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as err:
+                    retry = get_oom_retry(job, err, max_retries=max_retries)
+                    if retry is None:
+                        logger.error(f"{job['logmap_arg']['output_path']} failed: {err}")
+                        failed.append((job, err))
+                        continue
+                    logger.warning(
+                        f"{job['logmap_arg']['output_path']} ran out of memory, "
+                        f"queueing it again with heap {retry['logmap_arg']['heap']}"
+                    )
+                    pending = sorted(
+                        pending + [retry], key=lambda x: x["size_mb"], reverse=True
+                    )
+                except Exception as err:
+                    logger.error(f"{job['logmap_arg']['output_path']} failed: {err}")
+                    failed.append((job, err))
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} logmap jobs failed: "
+            + ", ".join(job["logmap_arg"]["output_path"] for job, _ in failed)
+        ) from failed[0][1]
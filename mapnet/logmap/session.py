@@ -0,0 +1,209 @@
+"""Run logmap in process through JPype, parsing each ontology once and reusing the parse across pairs"""
+
+import csv
+import glob
+import hashlib
+import json
+import os
+import subprocess
+from collections import Counter
+
+import jpype
+from bioregistry import normalize_prefix
+
+from mapnet.logmap.jobs import (
+    LOGMAP_MODES,
+    get_job_key,
+    is_job_complete,
+    make_logmap_job,
+    write_job_marker,
+)
+from mapnet.logmap.utils import get_onto_file, logmap_arg_factory
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOGMAP_URL = "https://github.com/ernestojimenezruiz/logmap-matcher/releases/download/logmap-matcher-july-2021/logmap-matcher-standalone-july-2021.zip"
+LOGMAP_DIR = os.path.join("mapnet", "logmap", "java")
+## backend recorded in the job key of session outputs, so they are never taken for container outputs and vice versa
+SESSION_BACKEND = "jpype"
+
+
+def get_logmap_jar(logmap_dir: str = LOGMAP_DIR):
+    """download and unzip the standalone logmap release (the same one used in the container) if not already present"""
+    jar_path = os.path.join(logmap_dir, "logmap-matcher-4.0.jar")
+    if not os.path.exists(jar_path):
+        os.makedirs(logmap_dir, exist_ok=True)
+        zip_path = os.path.join(logmap_dir, "logmap.zip")
+        cmd = ["wget", "-O", zip_path, LOGMAP_URL]
+        logger.info(f"running {cmd}")
+        subprocess.check_call(cmd)
+        cmd = ["unzip", "-o", zip_path, "-d", logmap_dir]
+        logger.info(f"running {cmd}")
+        subprocess.check_call(cmd)
+        os.remove(zip_path)
+    return jar_path
+
+
+def start_logmap_jvm(logmap_dir: str = LOGMAP_DIR, heap: str = "32g"):
+    """start a jvm with logmap and its dependencies on the class path, the jvm can only be started once per process"""
+    if jpype.isJVMStarted():
+        logger.info("jvm already started, reusing it")
+        return
+    get_logmap_jar(logmap_dir=logmap_dir)
+    class_path = glob.glob(os.path.join(logmap_dir, "**", "*.jar"), recursive=True)
+    jpype.startJVM(
+        f"-Xmx{heap}",
+        "--add-opens",
+        "java.base/java.lang=ALL-UNNAMED",
+        classpath=class_path,
+    )
+
+
+def get_session_job_key(job, logmap_dir: str = LOGMAP_DIR):
+    """returns the key of a job run in a session, the container job key with the session backend and logmap jar"""
+    key = {
+        "job": get_job_key(job),
+        "backend": SESSION_BACKEND,
+        "jar": os.path.basename(get_logmap_jar(logmap_dir=logmap_dir)),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class LogMapSession:
+    """
+    A long lived logmap session. Ontologies are parsed once into OWL API objects
+    and kept in memory so they can be matched against every partner without re-parsing.
+    Only the parse is shared: logmap builds its lexical indexes and classifies both ontologies again for every pair.
+    Outputs are marked complete with a session job key (see get_session_job_key), so sessions skip their own
+    finished pairs while run_logmap re-runs them in the container.
+    """
+
+    def __init__(
+        self,
+        dataset_dir: str = "resources/",
+        logmap_dir: str = LOGMAP_DIR,
+        heap: str = "32g",
+        tag: str = "0.01",
+    ):
+        start_logmap_jvm(logmap_dir=logmap_dir, heap=heap)
+        self.dataset_dir = dataset_dir
+        self.logmap_dir = logmap_dir
+        self.tag = tag
+        self.ontologies = {}
+        self._owl_manager = jpype.JClass(
+            "org.semanticweb.owlapi.apibinding.OWLManager"
+        )
+        self._matcher = jpype.JClass("uk.ac.ox.krr.logmap2.LogMap2_Matcher")
+        self._file = jpype.JClass("java.io.File")
+
+    def load_ontology(self, onto_file: str):
+        """parse an ontology (path relative to the dataset dir), or return it if it is already loaded"""
+        if onto_file not in self.ontologies:
+            onto_path = os.path.join(self.dataset_dir, onto_file)
+            logger.info(f"loading {onto_path}")
+            ## use a manager per ontology so ontologies sharing an iri do not clash
+            manager = self._owl_manager.createOWLOntologyManager()
+            self.ontologies[onto_file] = manager.loadOntologyFromOntologyDocument(
+                self._file(onto_path)
+            )
+        else:
+            logger.info(f"reusing loaded {onto_file}")
+        return self.ontologies[onto_file]
+
+    def release_ontology(self, onto_file: str):
+        """drop a loaded ontology so the jvm can reclaim its memory"""
+        self.ontologies.pop(onto_file, None)
+
+    def match(self, target_onto_file: str, source_onto_file: str, output_path: str):
+        """match two ontologies and write the mappings in the same format as the logmap container"""
+        job = make_logmap_job(
+            output_path=output_path,
+            dataset_dir=self.dataset_dir,
+            target_onto_file=target_onto_file,
+            source_onto_file=source_onto_file,
+            tag=self.tag,
+        )
+        key = get_session_job_key(job, logmap_dir=self.logmap_dir)
+        mappings_path = os.path.join(output_path, LOGMAP_MODES[job.mode]["mappings_file"])
+        if is_job_complete(job, key=key):
+            logger.info(f"{output_path} is already complete skipping!")
+            return mappings_path
+        os.makedirs(output_path, exist_ok=True)
+        matcher = self._matcher(
+            self.load_ontology(target_onto_file), self.load_ontology(source_onto_file)
+        )
+        ## write to a temporary file first so a crash does not leave a partial result behind
+        tmp_path = mappings_path + ".tmp"
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            for mapping in matcher.getLogmap2_Mappings():
+                writer.writerow(
+                    [
+                        str(mapping.getIRIStrEnt1()),
+                        str(mapping.getIRIStrEnt2()),
+                        float(mapping.getConfidence()),
+                    ]
+                )
+        os.replace(tmp_path, mappings_path)
+        write_job_marker(job, key=key)
+        return mappings_path
+
+
+def run_logmap_session_pairwise(
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    target_resource_prefix: str = None,
+    dataset_dir: str = None,
+    output_dir: str = None,
+    logmap_dir: str = LOGMAP_DIR,
+    heap: str = "32g",
+    tag: str = "0.01",
+    **_,
+):
+    """
+    runs logmap pairwise over a set of resources in a single jvm, each ontology is parsed once
+    and released after its last pair. If target_resource_prefix is given only pairs containing it are run.
+    Output is written to the same directories as run_logmap_pairwise, marked with a session job key.
+    """
+    resources = {normalize_prefix(prefix): resources[prefix] for prefix in resources}
+    logmap_args = [
+        logmap_arg
+        for logmap_arg in logmap_arg_factory(
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=None,
+            dataset_dir=dataset_dir,
+            output_dir=output_dir,
+        )
+        if target_resource_prefix is None
+        or target_resource_prefix
+        in [logmap_arg["source_def"]["prefix"], logmap_arg["target_def"]["prefix"]]
+    ]
+    ## count the pairs each ontology is in, so it can be released after its last one
+    remaining = Counter()
+    for logmap_arg in logmap_args:
+        remaining[get_onto_file(logmap_arg["source_def"])] += 1
+        remaining[get_onto_file(logmap_arg["target_def"])] += 1
+    session = LogMapSession(
+        dataset_dir=logmap_args[0]["dataset_dir"] if logmap_args else dataset_dir,
+        logmap_dir=logmap_dir,
+        heap=heap,
+        tag=tag,
+    )
+    for logmap_arg in logmap_args:
+        target_onto_file = get_onto_file(logmap_arg["target_def"])
+        source_onto_file = get_onto_file(logmap_arg["source_def"])
+        logger.info(f"matching {source_onto_file} and {target_onto_file}")
+        session.match(
+            target_onto_file=target_onto_file,
+            source_onto_file=source_onto_file,
+            output_path=logmap_arg["output_path"],
+        )
+        for onto_file in [target_onto_file, source_onto_file]:
+            remaining[onto_file] -= 1
+            if remaining[onto_file] == 0:
+                session.release_ontology(onto_file)
+    return session
@@ -0,0 +1,254 @@
+"""
+Sharded logmap matching for ontologies too large to match in one run.
+A large ontology is split into branch shards using its hierarchy, each shard also keeps the
+ancestors of its branch roots as context. Every shard is matched against the partner ontology
+with a bounded heap and the results are merged back into the normal pair output.
+"""
+
+import os
+
+import networkx as nx
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.logmap.jobs import (
+    LOGMAP_MODES,
+    get_job_key,
+    get_onto_file,
+    make_logmap_job,
+    write_job_marker,
+)
+from mapnet.logmap.scheduler import run_logmap_jobs
+from mapnet.logmap.utils import LOGMAP_MAPPINGS_SCHEMA, logmap_arg_factory
+from mapnet.utils import (
+    get_hierarchy_graph,
+    get_network_graph,
+    get_onto_subset_from_file,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def plan_shards(graph: nx.DiGraph, max_shard_size: int):
+    """
+    split a hierarchy (edges from parent to child, see get_hierarchy_graph) into shards of at most max_shard_size
+    classes (plus context).
+    Branches that are too large are split into the branches of their children, the split
+    class itself is kept as context of those shards. Small branches are packed together.
+    returns a list of shards, each a list of branch root nodes
+    """
+    branches = []
+    stack = [node for node in graph.nodes if graph.in_degree(node) == 0]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        size = len(nx.descendants(graph, node)) + 1
+        children = list(graph.successors(node))
+        if size <= max_shard_size or not children:
+            branches.append((size, node))
+        else:
+            stack += children
+    ## pack the branches into shards, largest first
+    shards = []
+    for size, node in sorted(branches, reverse=True):
+        for shard in shards:
+            if shard["size"] + size <= max_shard_size:
+                shard["roots"].append(node)
+                shard["size"] += size
+                break
+        else:
+            shards.append({"roots": [node], "size": size})
+    logger.info(
+        f"split {graph.number_of_nodes()} classes into {len(shards)} shards from {len(branches)} branches"
+    )
+    return [shard["roots"] for shard in shards]
+
+
+def write_shards(
+    prefix: str,
+    resources: dict,
+    meta: dict,
+    max_shard_size: int,
+    report_path: str = None,
+):
+    """
+    write an obo file for every shard of an ontology with robot (the descendants and ancestors of the shard roots).
+    Shards are written once next to the ontology and reused.
+    returns the paths of the shard files relative to the dataset dir
+    """
+    onto_def = {
+        "prefix": prefix,
+        "version": resources[prefix]["version"],
+        "subset": resources[prefix]["subset"],
+        "subset_name": meta["subset_dir"],
+    }
+    onto_file = get_onto_file(onto_def)
+    shard_dir = os.path.join(os.path.dirname(onto_file), f"shards_{max_shard_size}")
+    shard_list_path = os.path.join(meta["dataset_dir"], shard_dir, "shards.tsv")
+    if os.path.exists(shard_list_path):
+        logger.info(f"found {prefix} shards at {shard_list_path}")
+        return pl.read_csv(shard_list_path, separator="\t")["shard_file"].to_list()
+    graph = get_hierarchy_graph(
+        get_network_graph(resources=resources, meta=meta, prefix=prefix)
+    )
+    shard_files = []
+    for i, roots in enumerate(plan_shards(graph, max_shard_size=max_shard_size)):
+        shard_file = os.path.join(shard_dir, f"shard_{i}", f"{prefix}.obo")
+        os.makedirs(
+            os.path.join(meta["dataset_dir"], os.path.dirname(shard_file)),
+            exist_ok=True,
+        )
+        ## shards are extracted one after another since robot writes intermediate files next to the input
+        get_onto_subset_from_file(
+            prefix=prefix,
+            onto_path=os.path.join(meta["dataset_dir"], onto_file),
+            subset_identifiers=[root.split(":", 1)[-1] for root in roots],
+            method="full",
+            output_path=os.path.join(meta["dataset_dir"], shard_file),
+            report_path=report_path,
+        )
+        shard_files.append(shard_file)
+    pl.DataFrame({"shard_file": shard_files}).write_csv(shard_list_path, separator="\t")
+    return shard_files
+
+
+def merge_shard_mappings(shard_outputs: list, output_path: str, mode: str = "matcher"):
+    """
+    merge the mappings of each shard into the pair output, keeping the max score of mappings found in several shards.
+    The shard(s) each mapping came from are saved in shard_provenance.tsv
+    """
+    mappings_file = LOGMAP_MODES[mode]["mappings_file"]
+    shard_mappings = pl.concat(
+        [
+            pl.read_csv(
+                os.path.join(shard_output, mappings_file),
+                separator="\t",
+                has_header=False,
+                schema=LOGMAP_MAPPINGS_SCHEMA,
+            ).with_columns(pl.lit(os.path.basename(shard_output)).alias("shard"))
+            for shard_output in shard_outputs
+        ]
+    )
+    os.makedirs(output_path, exist_ok=True)
+    provenance = shard_mappings.group_by("TgtEntity", "SrcEntity").agg(
+        pl.col("Score").max(),
+        pl.col("shard").unique().sort().str.join(",").alias("shards"),
+    )
+    provenance.write_csv(
+        os.path.join(output_path, "shard_provenance.tsv"), separator="\t"
+    )
+    provenance.select(LOGMAP_MAPPINGS_SCHEMA.names()).write_csv(
+        os.path.join(output_path, mappings_file), separator="\t", include_header=False
+    )
+    return provenance
+
+
+def run_logmap_sharded(
+    shard_prefix: str,
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    tag: str,
+    partner_prefixes: list = None,
+    max_shard_size: int = 20000,
+    max_heap_gb: int = 16,
+    dataset_dir: str = None,
+    output_dir: str = None,
+    shard_output_dir: str = None,
+    singularity: bool = False,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    mode: str = "matcher",
+    **_,
+):
+    """
+    match a large resource against its partners (all other resources by default) by sharding it.
+    Shards of all pairs are run concurrently with a heap of at most max_heap_gb, and the merged result of each pair
+    is written to the same place as run_logmap_pairwise so it is picked up by merge_logmap_mappings.
+    The merged output is marked complete for the inputs of the pair (with the keys of its shard jobs), so
+    run_logmap_pairwise keeps it instead of re-running the pair unsharded until an input ontology changes.
+    """
+    resources = {normalize_prefix(prefix): resources[prefix] for prefix in resources}
+    shard_prefix = normalize_prefix(shard_prefix)
+    partner_prefixes = (
+        [normalize_prefix(x) for x in partner_prefixes]
+        if partner_prefixes
+        else [x for x in resources if x != shard_prefix]
+    )
+    meta = meta | {"dataset_dir": dataset_dir or meta.get("dataset_dir", "resources")}
+    shard_output_dir = shard_output_dir or os.path.join(
+        os.getcwd(), "output", "logmap_shards", analysis_name
+    )
+    shard_files = write_shards(
+        prefix=shard_prefix,
+        resources=resources,
+        meta=meta,
+        max_shard_size=max_shard_size,
+        report_path=os.path.join(shard_output_dir, "job_report.jsonl"),
+    )
+    pairs = {}
+    shard_args = []
+    for logmap_arg in logmap_arg_factory(
+        analysis_name=analysis_name,
+        resources=resources,
+        meta=meta,
+        tag=tag,
+        dataset_dir=meta["dataset_dir"],
+        output_dir=output_dir,
+        singularity=singularity,
+        mode=mode,
+    ):
+        sides = {"source": logmap_arg["source_def"], "target": logmap_arg["target_def"]}
+        shard_side = [x for x in sides if sides[x]["prefix"] == shard_prefix]
+        partner_side = [x for x in sides if sides[x]["prefix"] in partner_prefixes]
+        if not shard_side or not partner_side:
+            continue
+        pair_name = os.path.basename(os.path.normpath(logmap_arg["output_path"]))
+        pairs[pair_name] = {
+            "job": make_logmap_job(**logmap_arg),
+            "output_path": logmap_arg["output_path"],
+            "shards": [],
+            "shard_keys": [],
+        }
+        for i, shard_file in enumerate(shard_files):
+            shard_output = os.path.join(shard_output_dir, pair_name, f"shard_{i}")
+            shard_args.append(
+                logmap_arg
+                | {
+                    f"{shard_side[0]}_onto_file": shard_file,
+                    f"{partner_side[0]}_onto_file": get_onto_file(
+                        sides[partner_side[0]]
+                    ),
+                    "output_path": shard_output,
+                    "report_path": os.path.join(shard_output_dir, "job_report.jsonl"),
+                }
+            )
+            pairs[pair_name]["shards"].append(shard_output)
+            pairs[pair_name]["shard_keys"].append(
+                get_job_key(make_logmap_job(**shard_args[-1]))
+            )
+    logger.info(
+        f"matching {len(shard_files)} {shard_prefix} shards against {len(pairs)} partners"
+    )
+    run_logmap_jobs(
+        shard_args,
+        max_memory_gb=max_memory_gb,
+        max_cpus=max_cpus,
+        cpus_per_job=cpus_per_job,
+        max_heap_gb=max_heap_gb,
+    )
+    for pair_name, pair in pairs.items():
+        logger.info(f"merging shards of {pair_name}")
+        merge_shard_mappings(
+            shard_outputs=pair["shards"], output_path=pair["output_path"], mode=mode
+        )
+        write_job_marker(
+            pair["job"],
+            sharded={"max_shard_size": max_shard_size, "shard_keys": pair["shard_keys"]},
+        )
+    return pairs
@@ -1,18 +1,33 @@
 """Utility functions for matching with logmap"""
 
+import json
 import shlex
-import subprocess
 import os
 from itertools import combinations
 from bioregistry import normalize_prefix
 import re
 import polars as pl
-from mapnet.utils import format_mappings
+from mapnet.utils import format_mappings, get_name_from_curie, get_name_maps, parse_identifier
+from mapnet.utils.accounting import run_accounted
+from mapnet.logmap.jobs import (
+    LOGMAP_MODES,
+    get_onto_file,
+    make_logmap_job,
+    run_logmap_job,
+)
 import logging
 logger = logging.getLogger(__name__)
 
+LOGMAP_MAPPINGS_SCHEMA = pl.Schema(
+    [
+        ("TgtEntity", pl.String),
+        ("SrcEntity", pl.String),
+        ("Score", pl.Float64),
+    ]
+)
 
-def build_image(tag: str = "0.01", singularity:bool = False, **_):
+
+def build_image(tag: str = "0.01", singularity:bool = False, report_path: str = None, **_):
     """build the logmap image with a specfied tag"""
     if not singularity:
         cmd = [
@@ -32,8 +47,7 @@ def build_image(tag: str = "0.01", singularity:bool = False, **_):
             "mapnet/logmap/container/logmap.sif",
             "docker://buzgalbraith/mapnet-logmap" , ## just pulls latest tag. from dockerhub 
         ]
-    logger.info(f"running, {cmd}")
-    subprocess.check_call(cmd)
+    run_accounted(cmd, job_name=f"build_image:{tag}", report_path=report_path)
 
 
 def run_logmap(
@@ -45,86 +59,39 @@ def run_logmap(
     target_def: dict = None,
     source_def: dict = None,
     singularity: bool = False,
+    heap: str = "32g",
+    report_path: str = None,
+    max_retries: int = 2,
+    max_heap_gb: int = 64,
+    adopt_existing: bool = False,
+    mode: str = "matcher",
     **_,
 ):
+    """
+    run logmap on a pair of ontologies, skipping the pair if it already completed for the same inputs.
+    mode is either "matcher" for full logmap or "lite" for the lexical only logmap-lite screening matcher.
+    see mapnet.logmap.jobs.run_logmap_job
+    """
     output_path = output_path or os.path.join(os.getcwd(), "mapnet", "logmap", "output")
-    if os.path.exists(os.path.join(output_path, 'logmap2_mappings.tsv')):
-        logging.info(f"{os.path.join(output_path, 'logmap2_mappings.tsv')} already exists skipping!")
-    else:
-        os.makedirs(output_path, exist_ok=True)
-        if target_onto_file == None:
-            if target_def == None:
-                raise ValueError("must define either target_onto_file or target_def")
-            else:
-                target_name = (
-                    target_def["prefix"] + ".obo"
-                    if not target_def["subset"]
-                    else os.path.join(
-                        target_def["subset_name"], target_def["prefix"] + ".obo"
-                    )
-                )
-                target_onto_file = os.path.join(
-                    target_def["prefix"], target_def["version"], target_name
-                )
-        if source_onto_file == None:
-            if source_def == None:
-                raise ValueError("must define either source_onto_file or source_def")
-            else:
-                source_name = (
-                    source_def["prefix"] + ".obo"
-                    if not source_def["subset"]
-                    else os.path.join(
-                        source_def["subset_name"], source_def["prefix"] + ".obo"
-                    )
-                )
-                source_onto_file = os.path.join(
-                    source_def["prefix"], source_def["version"], source_name
-                )
-        # ## define the java command to run
-        java_cmd = [
-            "java",
-            "-jar",
-            "-Xmx32g",
-            "--add-opens",
-            "java.base/java.lang=ALL-UNNAMED",
-            "/package/logmap-matcher-4.0.jar",
-            "MATCHER",
-            f"file:///package/resources/{shlex.quote(target_onto_file)}",
-            f"file:///package/resources/{shlex.quote(source_onto_file)}",
-            "/package/output/",
-            "true",  # classify input ontology as well as map
-        ]
-        ##  define the command to run
-        if singularity:
-            cmd = [
-                "apptainer",
-                "run",
-                "-B",
-                f"{shlex.quote(output_path)}:/package/output",  # Mount where output will be written
-                "-B",
-                f"{shlex.quote(dataset_dir)}:/package/resources/",  ## mount directory with resources  
-                "mapnet/logmap/container/logmap.sif",
-                "sh",
-                "-c",
-                shlex.join(java_cmd),  ## add the java command as a string
-            ]
-        else:
-            cmd = [
-                "docker",
-                "run",
-                "--rm",
-                "-v",
-                f"{shlex.quote(output_path)}:/package/output",  # Mount where output will be written
-                "-v",
-                f"{shlex.quote(dataset_dir)}:/package/resources/",  ## mount directory with resources
-                f"logmap:{shlex.quote(tag)}",  ## specify the image and tag
-                "sh",
-                "-c",
-                shlex.join(java_cmd),  ## add the java command as a string
-            ]
-        logger.info(cmd)
-        # run the command
-        subprocess.check_call(cmd)
+    job = make_logmap_job(
+        target_onto_file=target_onto_file,
+        source_onto_file=source_onto_file,
+        output_path=output_path,
+        dataset_dir=dataset_dir,
+        tag=tag,
+        target_def=target_def,
+        source_def=source_def,
+        singularity=singularity,
+        heap=heap,
+        report_path=report_path,
+        mode=mode,
+    )
+    return run_logmap_job(
+        job,
+        max_retries=max_retries,
+        max_heap_gb=max_heap_gb,
+        adopt_existing=adopt_existing,
+    )
 
 
 def logmap_arg_factory(
@@ -135,6 +102,7 @@ def logmap_arg_factory(
     dataset_dir: str = None,
     output_dir: str = None,
     singularity:bool = False,
+    mode: str = "matcher",
     **_,
 ):
     """returns a generator of args for running logmap pairwise on a dataset"""
@@ -151,22 +119,28 @@ def logmap_arg_factory(
     else:
         output_dir = os.path.join(os.getcwd(), "output", "logmap", analysis_name)
         os.makedirs(output_dir, exist_ok=True)
-    logmap_args = {"tag": tag, "dataset_dir": dataset_dir, "singularity":singularity}
     for source, target in combinations(resources, r=2):
-        logmap_args["output_path"] = os.path.join(output_dir, f"{source}-{target}")
-        logmap_args["source_def"] = {
-            "prefix": source,
-            "version": resources[source]["version"],
-            "subset": resources[source]["subset"],
-            "subset_name": meta["subset_dir"],
+        ## yield a new dict for each pair so the args can safely be used concurrently
+        yield {
+            "tag": tag,
+            "dataset_dir": dataset_dir,
+            "singularity": singularity,
+            "mode": mode,
+            "report_path": os.path.join(output_dir, "job_report.jsonl"),
+            "output_path": os.path.join(output_dir, f"{source}-{target}"),
+            "source_def": {
+                "prefix": source,
+                "version": resources[source]["version"],
+                "subset": resources[source]["subset"],
+                "subset_name": meta["subset_dir"],
+            },
+            "target_def": {
+                "prefix": target,
+                "version": resources[target]["version"],
+                "subset": resources[target]["subset"],
+                "subset_name": meta["subset_dir"],
+            },
         }
-        logmap_args["target_def"] = {
-            "prefix": target,
-            "version": resources[target]["version"],
-            "subset": resources[target]["subset"],
-            "subset_name": meta["subset_dir"],
-        }
-        yield logmap_args
 
 
 def run_logmap_pairwise(
@@ -178,28 +152,49 @@ def run_logmap_pairwise(
     dataset_dir: str = None,
     output_dir: str = None,
     singularity: bool = False,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    mode: str = "matcher",
+    adopt_existing: bool = False,
     **_,
 ):
-    """runs logmap pairwise over a set of resources"""
+    """
+    runs logmap pairwise over a set of resources, running pairs concurrently under a memory and cpu budget.
+    adopt_existing marks output from before completion markers existed as complete instead of re-running it
+    """
+    from mapnet.logmap.scheduler import run_logmap_jobs
+
     version_mappings = {
         normalize_prefix(prefix): resources[prefix] for prefix in resources
     }
     resources = version_mappings
+    logmap_args = [
+        logmap_arg | {"adopt_existing": adopt_existing}
+        for logmap_arg in logmap_arg_factory(
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=tag,
+            dataset_dir=dataset_dir,
+            output_dir=output_dir,
+            singularity=singularity,
+            mode=mode,
+        )
+    ]
     if build:
         logger.info(f"building image with tag {tag}")
-        build_image(tag=tag, singularity=singularity)
-    for logmap_arg in logmap_arg_factory(
-        analysis_name=analysis_name,
-        resources=resources,
-        meta=meta,
-        tag=tag,
-        dataset_dir=dataset_dir,
-        output_dir=output_dir,
-        singularity=singularity,
-    ):
-
-        os.makedirs(logmap_arg["output_path"], exist_ok=True)
-        run_logmap(**logmap_arg)
+        build_image(
+            tag=tag,
+            singularity=singularity,
+            report_path=logmap_args[0]["report_path"] if logmap_args else None,
+        )
+    run_logmap_jobs(
+        logmap_args,
+        max_memory_gb=max_memory_gb,
+        max_cpus=max_cpus,
+        cpus_per_job=cpus_per_job,
+    )
 
 
 def run_logmap_for_target_pairs(
@@ -212,31 +207,53 @@ def run_logmap_for_target_pairs(
     dataset_dir: str = None,
     output_dir: str = None,
     singularity:bool = False,
+    max_memory_gb: int = None,
+    max_cpus: int = None,
+    cpus_per_job: int = 2,
+    mode: str = "matcher",
+    adopt_existing: bool = False,
     **_,
 ):
-    """Runs logmap for all pairs only containing a target resource"""
+    """
+    Runs logmap for all pairs only containing a target resource.
+    adopt_existing marks output from before completion markers existed as complete instead of re-running it
+    """
+    from mapnet.logmap.scheduler import run_logmap_jobs
+
     version_mappings = {
         normalize_prefix(prefix): resources[prefix] for prefix in resources
     }
     resources = version_mappings
-    if build:
-        logger.info(f"building image with tag {tag}")
-        build_image(tag=tag, singularity=singularity)
-    for logmap_arg in logmap_arg_factory(
-        analysis_name=analysis_name,
-        resources=resources,
-        meta=meta,
-        tag=tag,
-        dataset_dir=dataset_dir,
-        output_dir=output_dir,
-        singularity=singularity
-    ):
+    logmap_args = [
+        logmap_arg | {"adopt_existing": adopt_existing}
+        for logmap_arg in logmap_arg_factory(
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=tag,
+            dataset_dir=dataset_dir,
+            output_dir=output_dir,
+            singularity=singularity,
+            mode=mode,
+        )
         if (
             logmap_arg["source_def"]["prefix"] == target_resource_prefix
             or logmap_arg["target_def"]["prefix"] == target_resource_prefix
-        ):
-            os.makedirs(logmap_arg["output_path"], exist_ok=True)
-            run_logmap(**logmap_arg)
+        )
+    ]
+    if build:
+        logger.info(f"building image with tag {tag}")
+        build_image(
+            tag=tag,
+            singularity=singularity,
+            report_path=logmap_args[0]["report_path"] if logmap_args else None,
+        )
+    run_logmap_jobs(
+        logmap_args,
+        max_memory_gb=max_memory_gb,
+        max_cpus=max_cpus,
+        cpus_per_job=cpus_per_job,
+    )
 
 
 def walk_logmap_output_dir(
@@ -244,9 +261,10 @@ def walk_logmap_output_dir(
     analysis_name: str = None,
     output_dir: str = None,
     resources: dict = None,
+    mode: str = "matcher",
     **_,
 ):
-    """walk the output directory and get the paths to all matching files"""
+    """walk the output directory and get the paths to all matching files of a logmap mode"""
     if output_dir is not None:
         output_dir = output_dir
     elif "output_dir" in meta:
@@ -257,7 +275,9 @@ def walk_logmap_output_dir(
         if root.endswith("full_analysis"):
             continue
         else:
-            for mappings in filter(lambda x: x.endswith("mappings.tsv"), files):
+            for mappings in filter(
+                lambda x: x == LOGMAP_MODES[mode]["mappings_file"], files
+            ):
                 source, target = root.split("/")[-1].split("-")
                 source = normalize_prefix(source)
                 target = normalize_prefix(target)
@@ -290,6 +310,196 @@ def format_logmap_mappings(
     )
 
 
+def scan_logmap_mappings(mapping_paths: list):
+    """lazily scan a set of logmap mapping files into one frame with a fixed schema"""
+    return pl.concat(
+        [
+            pl.scan_csv(
+                mapping_path,
+                separator="\t",
+                has_header=False,
+                schema=LOGMAP_MAPPINGS_SCHEMA,
+            )
+            for mapping_path in mapping_paths
+        ]
+    )
+
+
+def parse_logmap_identifiers(mappings: pl.LazyFrame, keep_iris: bool = False):
+    """
+    parse the entity iris of scanned logmap mappings into curies, each unique iri is only parsed once.
+    If keep_iris, the raw logmap columns are kept next to the curies
+    """
+    iris = (
+        pl.concat(
+            [
+                mappings.select(pl.col("SrcEntity").alias("iri")),
+                mappings.select(pl.col("TgtEntity").alias("iri")),
+            ]
+        )
+        .unique()
+        .collect(engine="streaming")
+    )
+    curies = iris.with_columns(
+        pl.col("iri").map_elements(parse_identifier, return_dtype=pl.String).alias("curie")
+    ).lazy()
+    return (
+        mappings.join(
+            curies.rename({"iri": "SrcEntity", "curie": "source identifier"}),
+            on="SrcEntity",
+        )
+        .join(
+            curies.rename({"iri": "TgtEntity", "curie": "target identifier"}),
+            on="TgtEntity",
+        )
+        .select(
+            *(LOGMAP_MAPPINGS_SCHEMA.names() if keep_iris else []),
+            "source identifier",
+            "target identifier",
+            pl.col("Score").alias("confidence"),
+        )
+    )
+
+
+def combine_logmap_mappings(
+    mappings: pl.LazyFrame,
+    resources: dict,
+    additional_namespaces: dict = None,
+    matching_source: str = "logmap",
+):
+    """
+    combine parsed logmap mappings into one undirected biomappings style dataframe.
+    Mappings are deduplicated on integer keys keeping the max confidence, and names are resolved once for all pairs.
+    """
+    mappings = mappings.filter(
+        pl.col("source identifier").is_not_null()
+        & pl.col("target identifier").is_not_null()
+    )
+    ## intern the identifiers so deduplication only works on compact keys
+    identifiers = (
+        pl.concat(
+            [
+                mappings.select(pl.col("source identifier").alias("identifier")),
+                mappings.select(pl.col("target identifier").alias("identifier")),
+            ]
+        )
+        .unique()
+        .collect(engine="streaming")
+        .with_row_index("id")
+    )
+    keyed = mappings.join(
+        identifiers.lazy().rename({"identifier": "source identifier", "id": "source id"}),
+        on="source identifier",
+    ).join(
+        identifiers.lazy().rename({"identifier": "target identifier", "id": "target id"}),
+        on="target identifier",
+    )
+    keyed = keyed.select("source id", "target id", "confidence")
+    ## make undirected and keep the max score for each pair of entities
+    keyed = (
+        pl.concat(
+            [
+                keyed,
+                keyed.select(
+                    pl.col("target id").alias("source id"),
+                    pl.col("source id").alias("target id"),
+                    "confidence",
+                ),
+            ]
+        )
+        .group_by("source id", "target id")
+        .agg(pl.col("confidence").max())
+    )
+    ## resolve names for each identifier once
+    name_maps = get_name_maps(
+        resources=resources, additional_namespaces=additional_namespaces
+    )
+    identifiers = identifiers.with_columns(
+        pl.col("identifier")
+        .map_elements(
+            lambda x: get_name_from_curie(x, name_maps=name_maps),
+            return_dtype=pl.String,
+        )
+        .alias("name"),
+        pl.col("identifier").str.split(":").list.get(0).alias("prefix"),
+    ).lazy()
+    return (
+        keyed.join(
+            identifiers.rename(lambda x: f"source {x}"),
+            on="source id",
+        )
+        .join(
+            identifiers.rename(lambda x: f"target {x}"),
+            on="target id",
+        )
+        .with_columns(
+            pl.lit("skos:exactMatch").alias("relation"),
+            pl.lit("semapv:SemanticSimilarityThresholdMatching").alias("type"),
+            pl.lit(matching_source).alias("source"),
+        )
+        .select(
+            [
+                "source prefix",
+                "source identifier",
+                "source name",
+                "relation",
+                "target prefix",
+                "target identifier",
+                "target name",
+                "type",
+                "confidence",
+                "source",
+            ]
+        )
+        .collect(engine="streaming")
+    )
+
+
+def update_logmap_fragments(mapping_files: list, output_dir: str, fragment_dir: str):
+    """
+    parse the logmap output of each pair into a parquet fragment, only re-parsing pairs whose
+    mapping file changed (by size or modification time) since the last merge.
+    A manifest of the inputs each fragment was made from is kept in the fragment directory.
+    """
+    os.makedirs(fragment_dir, exist_ok=True)
+    manifest_path = os.path.join(fragment_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+    new_manifest = {}
+    fragment_paths = []
+    for source_prefix, target_prefix, mapping_path in mapping_files:
+        key = os.path.relpath(mapping_path, output_dir)
+        stat = os.stat(mapping_path)
+        entry = {
+            "path": mapping_path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "fragment": os.path.join(
+                fragment_dir, key.replace(os.sep, "__") + ".parquet"
+            ),
+        }
+        if manifest.get(key) == entry and os.path.exists(entry["fragment"]):
+            logger.info(f"{mapping_path} unchanged, reusing {entry['fragment']}")
+        else:
+            logger.info(f"parsing {source_prefix}, {target_prefix}, {mapping_path}")
+            parse_logmap_identifiers(scan_logmap_mappings([mapping_path])).collect(
+                engine="streaming"
+            ).write_parquet(entry["fragment"])
+        new_manifest[key] = entry
+        fragment_paths.append(entry["fragment"])
+    ## remove fragments of pairs that no longer have output
+    for key in manifest.keys() - new_manifest.keys():
+        if os.path.exists(manifest[key]["fragment"]):
+            os.remove(manifest[key]["fragment"])
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(new_manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return fragment_paths
+
+
 def merge_logmap_mappings(
     meta: dict,
     analysis_name: str,
@@ -297,10 +507,14 @@ def merge_logmap_mappings(
     resources: dict = None,
     additional_namespaces: dict = None,
     write_dir: str = None,
+    incremental: bool = True,
+    mode: str = "matcher",
     **_,
 ):
     """
-    read in and merge the logmap matching files into one tsv file
+    read in and merge the logmap matching files into one tsv file.
+    If incremental, parsed pairs are cached as parquet fragments and only pairs whose output changed are re-parsed.
+    mode selects the output of full logmap ("matcher") or of the logmap-lite screening runs ("lite").
     """
     if output_dir is not None:
         output_dir = output_dir
@@ -313,36 +527,31 @@ def merge_logmap_mappings(
         "full_analysis",
     )
     os.makedirs(write_dir, exist_ok=True)
-    write_path = os.path.join(write_dir, "full_mappings.tsv")
+    write_name = (
+        "full_mappings.tsv" if mode == "matcher" else f"full_{mode}_mappings.tsv"
+    )
+    write_path = os.path.join(write_dir, write_name)
 
-    mapping_df = None
-    for source_prefix, target_prefix, mapping_path in walk_logmap_output_dir(
-        output_dir=output_dir, resources=resources
-    ):
-        logger.info(f'{source_prefix}, {target_prefix}, {mapping_path}')
-        logger.info("-" * 40)
-        if mapping_df is None:
-            mapping_df = format_logmap_mappings(
-                source_prefix=source_prefix,
-                target_prefix=target_prefix,
-                mapping_path=mapping_path,
-                resources=resources,
-                additional_namespaces=additional_namespaces,
-            )
-        else:
-            mapping_df = mapping_df.vstack(
-                format_logmap_mappings(
-                    source_prefix=source_prefix,
-                    target_prefix=target_prefix,
-                    mapping_path=mapping_path,
-                    resources=resources,
-                    additional_namespaces=additional_namespaces,
-                )
-            )
-    mapping_df = mapping_df.unique()
-    ## remove rows that only differ by score, take the max ###
-    cols = mapping_df.columns
-    cols.remove("confidence")
-    mapping_df = mapping_df.group_by(cols).max()
+    mapping_files = list(
+        walk_logmap_output_dir(output_dir=output_dir, resources=resources, mode=mode)
+    )
+    if incremental:
+        fragment_paths = update_logmap_fragments(
+            mapping_files=mapping_files,
+            output_dir=output_dir,
+            ## one fragment cache per mode, the manifest of one mode would otherwise remove the fragments of the other
+            fragment_dir=os.path.join(write_dir, "fragments", mode),
+        )
+        mappings = pl.scan_parquet(fragment_paths)
+    else:
+        mappings = parse_logmap_identifiers(
+            scan_logmap_mappings([mapping_path for _, _, mapping_path in mapping_files])
+        )
+    mapping_df = combine_logmap_mappings(
+        mappings=mappings,
+        resources=resources,
+        additional_namespaces=additional_namespaces,
+        matching_source="logmap" if mode == "matcher" else f"logmap-{mode}",
+    )
     mapping_df.write_csv(write_path, separator="\t")
     return mapping_df
@@ -0,0 +1,464 @@
+"""
+A work queue on a shared file system for running logmap pairs with workers on many nodes.
+A coordinator writes one json file per job, and workers claim jobs by atomically creating a lock file
+holding a lease with a token unique to the claim. The lock file is never rewritten, while a job runs its worker
+renews the lease in a heartbeat file named after the token. Leases of crashed workers expire and their jobs are
+reclaimed. Locks are only removed after renaming them away and checking that the renamed lock still holds the
+expected token, a lock that turns out to belong to a newer claim is put back.
+
+Jobs carry a key over their arguments and the content of their inputs, and done and failed records only count for
+the key they were run with, so resubmitting after an input or argument changed re-arms the job.
+
+queue_dir/
+    jobs/<job_id>.json                keyword arguments for run_logmap and the key of the job
+    locks/<job_id>.lock               lease of the worker running the job
+    locks/<job_id>.<token>.heartbeat  renewed expiry of that lease
+    done/<job_id>.json                record of a finished job
+    failed/<job_id>.json              record of a failed job
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shlex
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from bioregistry import normalize_prefix
+
+from mapnet.logmap.jobs import format_heap, get_job_key, make_logmap_job, parse_heap_gb
+from mapnet.logmap.scheduler import OVERHEAD_GB, estimate_heap_gb, get_pair_size_mb
+from mapnet.logmap.utils import logmap_arg_factory, run_logmap
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DIRS = ["jobs", "locks", "done", "failed"]
+
+
+def write_json_atomic(pth: str, obj: dict):
+    """write a json file so readers on other nodes never see a partial file"""
+    tmp_path = f"{pth}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, pth)
+
+
+def read_json(pth: str):
+    """read a json file, returns None if it was removed or is still being written"""
+    try:
+        with open(pth, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_queue_job_key(logmap_arg: dict):
+    """returns a key for a queued job from its arguments and the content of its inputs (see get_job_key)"""
+    key = {
+        "job": get_job_key(make_logmap_job(**logmap_arg)),
+        "logmap_arg": logmap_arg,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def has_record(queue_dir: str, state: str, job_id: str, key: str):
+    """check if a job has a done or failed record for its current key"""
+    record = read_json(os.path.join(queue_dir, state, f"{job_id}.json"))
+    return record is not None and record.get("key") == key
+
+
+def submit_logmap_jobs(
+    queue_dir: str, logmap_args: list, resubmit_failed: bool = False
+):
+    """
+    write logmap jobs into a queue directory. Jobs that are already queued with the same key are left as is,
+    jobs whose arguments or inputs changed are rewritten and run again.
+    args:
+        resubmit_failed: run jobs that failed for their current key again
+    returns the ids of the submitted jobs
+    """
+    for sub_dir in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+    job_ids = []
+    for logmap_arg in logmap_args:
+        job_id = os.path.basename(os.path.normpath(logmap_arg["output_path"]))
+        if logmap_arg.get("mode", "matcher") != "matcher":
+            job_id = f"{job_id}.{logmap_arg['mode']}"
+        job_path = os.path.join(queue_dir, "jobs", f"{job_id}.json")
+        key = get_queue_job_key(logmap_arg)
+        job = read_json(job_path)
+        if job is None or job.get("key") != key:
+            if job is not None:
+                logger.info(f"arguments or inputs of {job_id} changed, queueing it again")
+            ## the size is used by workers to claim the largest jobs first
+            size_mb = get_pair_size_mb(logmap_arg)
+            logmap_arg = {"heap": f"{estimate_heap_gb(size_mb)}g"} | logmap_arg
+            write_json_atomic(
+                job_path, {"size_mb": size_mb, "key": key, "logmap_arg": logmap_arg}
+            )
+        for state in ["done", "failed"]:
+            record_path = os.path.join(queue_dir, state, f"{job_id}.json")
+            ## records of earlier versions of the job are removed, failed records also when resubmitting
+            if os.path.exists(record_path) and (
+                not has_record(queue_dir, state, job_id, key)
+                or (state == "failed" and resubmit_failed)
+            ):
+                os.remove(record_path)
+        job_ids.append(job_id)
+    logger.info(f"{len(job_ids)} jobs in queue {queue_dir}")
+    return job_ids
+
+
+def submit_logmap_pairwise(
+    queue_dir: str,
+    analysis_name: str,
+    resources: dict,
+    meta: dict,
+    tag: str,
+    target_resource_prefix: str = None,
+    dataset_dir: str = None,
+    output_dir: str = None,
+    singularity: bool = False,
+    mode: str = "matcher",
+    resubmit_failed: bool = False,
+    **_,
+):
+    """
+    write a job for every pair of resources into a queue (or only pairs containing target_resource_prefix).
+    The jobs can then be run by workers, see write_array_job_script.
+    """
+    resources = {normalize_prefix(prefix): resources[prefix] for prefix in resources}
+    logmap_args = [
+        logmap_arg
+        for logmap_arg in logmap_arg_factory(
+            analysis_name=analysis_name,
+            resources=resources,
+            meta=meta,
+            tag=tag,
+            dataset_dir=dataset_dir,
+            output_dir=output_dir,
+            singularity=singularity,
+            mode=mode,
+        )
+        if target_resource_prefix is None
+        or target_resource_prefix
+        in [logmap_arg["source_def"]["prefix"], logmap_arg["target_def"]["prefix"]]
+    ]
+    return submit_logmap_jobs(
+        queue_dir=queue_dir, logmap_args=logmap_args, resubmit_failed=resubmit_failed
+    )
+
+
+def get_queue_status(queue_dir: str):
+    """returns the ids of jobs in each state of the queue, done and failed only count for the current key of a job"""
+    status = {"pending": [], "running": [], "done": [], "failed": []}
+    for job_file in sorted(os.listdir(os.path.join(queue_dir, "jobs"))):
+        if not job_file.endswith(".json"):
+            continue
+        job_id = job_file.removesuffix(".json")
+        job = read_json(os.path.join(queue_dir, "jobs", job_file))
+        key = job.get("key") if job is not None else None
+        if has_record(queue_dir, "done", job_id, key):
+            status["done"].append(job_id)
+        elif has_record(queue_dir, "failed", job_id, key):
+            status["failed"].append(job_id)
+        elif os.path.exists(os.path.join(queue_dir, "locks", f"{job_id}.lock")):
+            status["running"].append(job_id)
+        else:
+            status["pending"].append(job_id)
+    return status
+
+
+def make_lease(worker_id: str, lease_seconds: int):
+    """returns a new lease for a worker that expires after lease_seconds"""
+    return {
+        "worker_id": worker_id,
+        "token": uuid.uuid4().hex,
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "expires": time.time() + lease_seconds,
+    }
+
+
+def get_heartbeat_path(lock_path: str, token: str):
+    """returns the path of the file a lease is renewed in"""
+    return f"{lock_path.removesuffix('.lock')}.{token}.heartbeat"
+
+
+def get_lease_expiry(lock_path: str, lease: dict):
+    """returns when a lease expires, from its heartbeat if it was renewed"""
+    heartbeat = read_json(get_heartbeat_path(lock_path, lease["token"]))
+    return heartbeat["expires"] if heartbeat is not None else lease["expires"]
+
+
+def remove_heartbeat(lock_path: str, token: str):
+    """remove the heartbeat file of a lease if there is one"""
+    try:
+        os.remove(get_heartbeat_path(lock_path, token))
+    except FileNotFoundError:
+        pass
+
+
+def remove_lock(lock_path: str, token: str):
+    """
+    remove a lock only if it holds the lease with the given token, returns True if this call removed it.
+    The lock is renamed away first (only one worker can win the rename) and checked after the rename, so a lock
+    that was replaced by a newer claim in the meantime is put back instead of removed.
+    """
+    moved_path = f"{lock_path}.{uuid.uuid4().hex}.removing"
+    try:
+        os.rename(lock_path, moved_path)
+    except FileNotFoundError:
+        return False
+    lease = read_json(moved_path)
+    if lease is not None and lease["token"] == token:
+        os.remove(moved_path)
+        return True
+    ## link does not replace an existing file, so a lock created since the rename is never overwritten
+    try:
+        os.link(moved_path, lock_path)
+    except FileExistsError:
+        logger.warning(f"could not restore {lock_path}, it was claimed again")
+    os.remove(moved_path)
+    return False
+
+
+def reclaim_stale_lease(lock_path: str):
+    """remove a lock whose lease has expired, returns True if this call removed it"""
+    lease = read_json(lock_path)
+    if lease is None or get_lease_expiry(lock_path, lease) > time.time():
+        return False
+    if not remove_lock(lock_path, lease["token"]):
+        return False
+    remove_heartbeat(lock_path, lease["token"])
+    logger.warning(
+        f"reclaimed expired lease of worker {lease['worker_id']} on {lease['host']} for {lock_path}"
+    )
+    return True
+
+
+def create_lock(lock_path: str, lease: dict):
+    """atomically create a lock holding a lease, returns False if the lock already exists"""
+    tmp_path = f"{lock_path}.{lease['token']}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(lease, f)
+    try:
+        ## link fails if the lock exists, so only one worker can create it and it is never seen half written
+        os.link(tmp_path, lock_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+def claim_logmap_job(queue_dir: str, worker_id: str, lease_seconds: int = 600):
+    """
+    atomically claim the largest pending job, reclaiming jobs with an expired lease.
+    returns the job id, the job and the token of the lease, or None if there is nothing to claim
+    """
+    status = get_queue_status(queue_dir)
+    jobs = []
+    for job_id in status["pending"] + status["running"]:
+        job = read_json(os.path.join(queue_dir, "jobs", f"{job_id}.json"))
+        if job is not None:
+            jobs.append((job_id, job))
+    for job_id, job in sorted(jobs, key=lambda x: x[1]["size_mb"], reverse=True):
+        if has_record(queue_dir, "done", job_id, job.get("key")):
+            continue
+        lock_path = os.path.join(queue_dir, "locks", f"{job_id}.lock")
+        if os.path.exists(lock_path) and not reclaim_stale_lease(lock_path):
+            continue
+        lease = make_lease(worker_id, lease_seconds)
+        if not create_lock(lock_path, lease):
+            continue
+        logger.info(f"worker {worker_id} claimed {job_id}")
+        return job_id, job, lease["token"]
+    return None
+
+
+def renew_lease_factory(lock_path: str, token: str, lease_seconds: int):
+    """
+    returns a thread that renews a lease until its stop event is set.
+    Only the heartbeat file of the lease is written, so the thread can never replace the lock of another worker
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_seconds / 3):
+            lease = read_json(lock_path)
+            if lease is None or lease["token"] != token:
+                logger.warning(f"lost lease {token} on {lock_path}")
+                return
+            write_json_atomic(
+                get_heartbeat_path(lock_path, token),
+                {"expires": time.time() + lease_seconds},
+            )
+
+    return threading.Thread(target=renew, daemon=True), stop
+
+
+def run_logmap_worker(
+    queue_dir: str,
+    worker_id: str = None,
+    lease_seconds: int = 600,
+    poll_seconds: int = 30,
+    exit_when_empty: bool = True,
+    memory_gb: int = None,
+):
+    """
+    claim and run jobs from a queue until no job is left.
+    If exit_when_empty is False the worker keeps polling for new jobs.
+    args:
+        memory_gb: memory of the worker, heaps (including retries after running out of memory) are capped to it
+    """
+    max_heap_gb = memory_gb - OVERHEAD_GB if memory_gb is not None else None
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    while True:
+        claimed = claim_logmap_job(
+            queue_dir=queue_dir, worker_id=worker_id, lease_seconds=lease_seconds
+        )
+        if claimed is None:
+            status = get_queue_status(queue_dir)
+            if exit_when_empty and not status["running"]:
+                logger.info(f"worker {worker_id} found no jobs, exiting")
+                return
+            ## jobs held by other workers may still be reclaimed if those workers die
+            time.sleep(poll_seconds)
+            continue
+        job_id, job, token = claimed
+        logmap_arg = job["logmap_arg"]
+        if max_heap_gb is not None:
+            heap_gb = min(parse_heap_gb(logmap_arg.get("heap", "32g")), max_heap_gb)
+            logmap_arg = logmap_arg | {
+                "heap": format_heap(heap_gb),
+                "max_heap_gb": max_heap_gb,
+            }
+        lock_path = os.path.join(queue_dir, "locks", f"{job_id}.lock")
+        renew_thread, stop = renew_lease_factory(lock_path, token, lease_seconds)
+        renew_thread.start()
+        record = {
+            "worker_id": worker_id,
+            "host": socket.gethostname(),
+            "key": job.get("key"),
+            "start": time.time(),
+        }
+        try:
+            run_logmap(**logmap_arg)
+            record["end"] = time.time()
+            write_json_atomic(os.path.join(queue_dir, "done", f"{job_id}.json"), record)
+        except Exception:
+            logger.exception(f"worker {worker_id} failed on {job_id}")
+            record["end"] = time.time()
+            record["error"] = traceback.format_exc()
+            write_json_atomic(
+                os.path.join(queue_dir, "failed", f"{job_id}.json"), record
+            )
+        finally:
+            stop.set()
+            renew_thread.join()
+            ## the lock may have been reclaimed by another worker, only remove it if it is still ours
+            if not remove_lock(lock_path, token):
+                logger.warning(f"worker {worker_id} no longer held the lock of {job_id}")
+            remove_heartbeat(lock_path, token)
+
+
+def run_local_workers(queue_dir: str, n_workers: int, **worker_args):
+    """run several workers as local processes, useful for testing the queue on one machine"""
+    processes = [
+        multiprocessing.Process(
+            target=run_logmap_worker,
+            kwargs={"queue_dir": queue_dir, "worker_id": f"local-{i}"} | worker_args,
+        )
+        for i in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return get_queue_status(queue_dir)
+
+
+def write_array_job_script(
+    queue_dir: str,
+    script_path: str,
+    n_workers: int,
+    memory_gb: int = 64,
+    cpus: int = 4,
+    time_limit: str = "2-00:00:00",
+    lease_seconds: int = 600,
+    job_name: str = "logmap",
+    extra_directives: list = None,
+):
+    """write a slurm array job script that starts one queue worker per array task"""
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH --job-name={job_name}",
+        f"#SBATCH --array=1-{n_workers}",
+        f"#SBATCH --mem={memory_gb}G",
+        f"#SBATCH --cpus-per-task={cpus}",
+        f"#SBATCH --time={time_limit}",
+        f"#SBATCH --output={shlex.quote(os.path.join(queue_dir, 'logs', '%A_%a.out'))}",
+    ]
+    lines += [f"#SBATCH {directive}" for directive in extra_directives or []]
+    lines += [
+        "",
+        f"cd {shlex.quote(os.getcwd())}",
+        "python -m mapnet.logmap.work_queue \\",
+        f"    --queue-dir {shlex.quote(queue_dir)} \\",
+        '    --worker-id "${SLURM_ARRAY_JOB_ID}-${SLURM_ARRAY_TASK_ID}" \\',
+        f"    --lease-seconds {lease_seconds} \\",
+        f"    --memory-gb {memory_gb}",
+        "",
+    ]
+    os.makedirs(os.path.join(queue_dir, "logs"), exist_ok=True)
+    with open(script_path, "w") as f:
+        f.write("\n".join(lines))
+    return script_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-q",
+        "--queue-dir",
+        type=str,
+        required=True,
+        help="queue directory on shared storage written by submit_logmap_jobs",
+    )
+    parser.add_argument(
+        "-w",
+        "--worker-id",
+        type=str,
+        default=None,
+        help="name of the worker, defaults to host-pid",
+    )
+    parser.add_argument(
+        "-l",
+        "--lease-seconds",
+        type=int,
+        default=600,
+        help="seconds after which the job of a worker that stopped renewing its lease is reclaimed",
+    )
+    parser.add_argument(
+        "-p",
+        "--poll-seconds",
+        type=int,
+        default=30,
+        help="seconds to wait between checking for jobs held by other workers",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-gb",
+        type=int,
+        default=None,
+        help="memory of the worker in GB, logmap heaps are capped to it minus the jvm overhead",
+    )
+    args = parser.parse_args()
+    run_logmap_worker(**vars(args))
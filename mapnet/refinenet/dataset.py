@@ -1,7 +1,11 @@
 """methods for generating training and inference dataset for use in RefineNet model"""
 
 import argparse
+import multiprocessing
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 
 import polars as pl
 
@@ -9,9 +13,12 @@ from mapnet.refinenet.constants import (
     GENERATED_DATASET_SCHEMA,
     INFERENCE_DATASET_SCHEMA,
 )
+from mapnet.refinenet.relatives import (
+    get_relatives_table,
+    get_relatives_within_distance,
+    join_relatives,
+)
 from mapnet.utils import (
-    ancestors_within_distance,
-    descendants_within_distance,
     file_safety_check,
     get_name_from_curie,
     get_name_maps,
@@ -22,77 +29,56 @@ from mapnet.utils import (
     normalize_dataset_def,
     normalized_edit_similarity,
     sssom_to_biomappings,
-    top_k_named_relations,
 )
+import logging
 
+logger = logging.getLogger(__name__)
 
-def add_ancestors_and_descendants(
-    row,
+
+def get_relatives_tables(
+    dataset_def: dict,
+    network_graphs: dict,
     name_map_func,
-    source_graph,
-    target_graph,
-    max_distance,
-    max_relations,
+    max_distance: int,
+    max_relations: int = 3,
+):
+    """load (or build) the relatives table of every resource that has a graph"""
+    return {
+        prefix: get_relatives_table(
+            **dataset_def,
+            prefix=prefix,
+            graph=network_graphs[prefix],
+            name_map_func=name_map_func,
+            max_relations=max_relations,
+            max_distance=max_distance,
+        )
+        for prefix in network_graphs
+    }
+
+
+def add_ancestors_and_descendants(
+    df: pl.DataFrame,
+    relatives_tables: dict,
     bin_edit_similarity: bool = True,
     edit_cutoff: float = 0.00,
 ):
-    """adds ancestor and descendant names and identifiers to a row"""
-    (
-        row["source descendant identifiers"],
-        row["source descendant names"],
-    ) = top_k_named_relations(
-        source_graph,
-        row["source identifier"],
-        name_map_func,
-        k=max_relations,
-        descendants=False,
-        max_distance=max_distance,
-    )
-    (
-        row["target descendant identifiers"],
-        row["target descendant names"],
-    ) = top_k_named_relations(
-        target_graph,
-        row["target identifier"],
-        name_map_func,
-        k=max_relations,
-        descendants=False,
-        max_distance=max_distance,
-    )
-    (
-        row["source ancestor identifiers"],
-        row["source ancestor names"],
-    ) = top_k_named_relations(
-        source_graph,
-        row["source identifier"],
-        name_map_func,
-        k=max_relations,
-        descendants=True,
-        max_distance=max_distance,
-    )
-    (
-        row["target ancestor identifiers"],
-        row["target ancestor names"],
-    ) = top_k_named_relations(
-        target_graph,
-        row["target identifier"],
-        name_map_func,
-        k=max_relations,
-        descendants=True,
-        max_distance=max_distance,
+    """adds ancestor and descendant names and identifiers and the edit similarity to every row"""
+    df = join_relatives(df, relatives_tables).with_columns(
+        pl.struct("source name", "target name")
+        .map_elements(normalized_edit_similarity, return_dtype=pl.Float64)
+        .alias("edit_similarity")
     )
-    e_sim = normalized_edit_similarity(row)
-    if e_sim < edit_cutoff:
-        return None
+    df = df.filter(pl.col("edit_similarity") >= edit_cutoff)
     if bin_edit_similarity:
-        if e_sim < 0.33:
-            e_sim = "LOW"
-        elif e_sim < 0.66:
-            e_sim = "MEDIUM"
-        else:
-            e_sim = "HIGH"
-    row["edit_similarity"] = e_sim
-    return row
+        df = df.with_columns(
+            pl.when(pl.col("edit_similarity") < 0.33)
+            .then(pl.lit("LOW"))
+            .when(pl.col("edit_similarity") < 0.66)
+            .then(pl.lit("MEDIUM"))
+            .otherwise(pl.lit("HIGH"))
+            .alias("edit_similarity")
+        )
+    return df
 
 
 def process_known_maps(dataset_def):
@@ -134,156 +120,384 @@ def process_known_maps(dataset_def):
     )
 
 
+def pick_relatives(candidates: pl.DataFrame, rows: pl.Series, seed: int):
+    """pick one relative at random (seeded) for each of the given rows"""
+    return (
+        candidates.filter(pl.col("row").is_in(rows))
+        .with_columns(pl.struct("row", "relative").hash(seed).alias("key"))
+        .group_by("row")
+        .agg(pl.col("relative").sort_by("key").first())
+    )
+
+
 def synthetic_step(
-    dataset_def: dict, exact_maps: pl.DataFrame, network_graphs: dict, max_distance: int
+    dataset_def: dict,
+    exact_maps: pl.DataFrame,
+    network_graphs: dict,
+    max_distance: int,
+    seed: int = 0,
+    name_maps: dict = None,
 ):
-    """Generate a dataset of synthetic broad and narrow mappings from true exact mappings"""
+    """
+    Generate a dataset of synthetic broad and narrow mappings from true exact mappings.
+    The descendants and ancestors within max_distance of all target classes are found at once, then about a third
+    of the mappings become narrow matches (target replaced by a descendant) and a third broad matches (target replaced
+    by an ancestor). Mappings and relatives are picked at random with the given seed, mappings without a usable
+    relative stay exact matches.
+    """
     ## get mappings from id to name for each ontology
-    name_maps = get_name_maps(**dataset_def)
+    name_maps = get_name_maps(**dataset_def) if name_maps is None else name_maps
     name_map_func = lambda x: get_name_from_curie(x, name_maps).lower()
-    class_counts = {"exact": 0, "broad": 0, "narrow": 0}
-    known_maps = exact_maps.sample(fraction=1.0, shuffle=True)
-    generated_maps = []
-    ## use exact mappings to generate a synthetic dataset with broad and narrow mappings
-    for row in known_maps.iter_rows(named=True):
-        mapped = False
-        target_class = min(class_counts, key=class_counts.get)
-        generated_map = row.copy()
-        ## make sure this mapping is from an ontology we have graphs for
-        if (
-            row["source prefix"] not in network_graphs
-            or row["target prefix"] not in network_graphs
-        ):
-            continue
-        target_graph = network_graphs[row["target prefix"]]
-        source_graph = network_graphs[row["source prefix"]]
-        ## make sure the node is in the graph before proceeding
-        if generated_map["target identifier"] not in target_graph.nodes:
-            continue
-        ## try to make a narrow match first
-        if target_class == "narrow":
-            candidates = ancestors_within_distance(
-                target_graph,
-                generated_map["target identifier"],
-                max_distance=max_distance,
+    ## only keep mappings from ontologies we have graphs for, with the target class in its graph
+    nodes = pl.concat(
+        [
+            pl.DataFrame(
+                {"target prefix": prefix, "target identifier": list(graph.nodes)},
+                schema={"target prefix": pl.String, "target identifier": pl.String},
             )
-            candidates = list(filter(lambda x: x in target_graph.nodes, candidates))
-            if len(candidates) > 0:
-                generated_map["target identifier"] = candidates[0]
-                generated_map["target name"] = name_map_func(candidates[0])
-                generated_map["class"] = 2
-                class_counts["narrow"] += 1
-                mapped = True
-        ## otherwise try to make a broad match
-        elif (target_class == "broad") and (not mapped):
-            candidates = descendants_within_distance(
-                target_graph,
-                generated_map["target identifier"],
-                max_distance=max_distance,
+            for prefix, graph in network_graphs.items()
+        ]
+    )
+    known_maps = (
+        exact_maps.filter(pl.col("source prefix").is_in(list(network_graphs)))
+        .join(nodes, on=["target prefix", "target identifier"], how="semi")
+        ## sort first so the shuffle only depends on the seed
+        .sort("source identifier", "target identifier")
+        .sample(fraction=1.0, shuffle=True, seed=seed)
+        .with_row_index("row")
+    )
+    ## candidate descendants (narrow) and ancestors (broad) of every target class
+    candidates = {}
+    for kind, descendants in [("narrow", True), ("broad", False)]:
+        relatives = []
+        for prefix, graph in network_graphs.items():
+            targets = known_maps.filter(pl.col("target prefix") == prefix)
+            if targets.is_empty():
+                continue
+            relatives.append(
+                targets.select("row", pl.col("target identifier").alias("root")).join(
+                    get_relatives_within_distance(
+                        graph,
+                        targets["target identifier"].unique().sort().to_list(),
+                        max_distance=max_distance,
+                        descendants=descendants,
+                    ),
+                    on="root",
+                )
             )
-            candidates = list(filter(lambda x: x in target_graph.nodes, candidates))
-            if len(candidates) > 0:
-                generated_map["target identifier"] = candidates[0]
-                generated_map["target name"] = name_map_func(candidates[0])
-                generated_map["class"] = 1
-                class_counts["broad"] += 1
-                mapped = True
-        ## if none of the above are met it will just use the original (exact match)
-        if not mapped:
-            generated_map["class"] = 0
-            class_counts["exact"] += 1
-            mapped = True
-        ## add ancestor and descendant information to the row directly
-        generated_map = add_ancestors_and_descendants(
-            row=generated_map,
-            name_map_func=name_map_func,
-            source_graph=source_graph,
-            target_graph=target_graph,
-            max_distance=max_distance,
-            max_relations=3,
-            bin_edit_similarity=True,
-            edit_cutoff=0.00,  ## not using distance cutoff
+        candidates[kind] = (
+            pl.concat(relatives).select("row", "relative")
+            if relatives
+            else pl.DataFrame(schema={"row": pl.UInt32, "relative": pl.String})
         )
-        generated_maps.append(generated_map)
+    ## balance the classes, rows are already in random order
+    quota = len(known_maps) // 3
+    eligible = known_maps.select(
+        "row",
+        pl.col("row").is_in(candidates["narrow"]["row"]).alias("narrow"),
+        pl.col("row").is_in(candidates["broad"]["row"]).alias("broad"),
+    )
+    ## narrow rows are taken from rows that can not be broad first so as many rows as possible stay available for broad
+    narrow_rows = eligible.filter(pl.col("narrow")).sort("broad", "row").head(quota)["row"]
+    broad_rows = (
+        eligible.filter(pl.col("broad") & ~pl.col("row").is_in(narrow_rows))
+        .head(quota)["row"]
+    )
+    picked = pl.concat(
+        [
+            pick_relatives(candidates["narrow"], narrow_rows, seed).with_columns(
+                pl.lit(2, dtype=pl.Int64).alias("class")
+            ),
+            pick_relatives(candidates["broad"], broad_rows, seed).with_columns(
+                pl.lit(1, dtype=pl.Int64).alias("class")
+            ),
+        ]
+    )
+    names = {x: name_map_func(x) for x in picked["relative"].unique().to_list()}
+    generated_maps = (
+        known_maps.join(picked, on="row", how="left")
+        .with_columns(
+            pl.coalesce("relative", "target identifier").alias("target identifier"),
+            pl.coalesce(
+                pl.col("relative").replace_strict(
+                    names, default=None, return_dtype=pl.String
+                ),
+                "target name",
+            ).alias("target name"),
+            pl.col("class").fill_null(0),
+        )
+        .sort("row")
+        .drop("row", "relative")
+    )
+    logger.info(
+        f"generated {dict(generated_maps.group_by('class').len().sort('class').iter_rows())} mappings by class"
+    )
     return generated_maps
 
 
-def real_step(
-    minority_maps: list,
+def real_step(minority_maps: list):
+    """add real minority classes to the training data"""
+    return pl.concat(
+        [
+            known_maps.with_columns(pl.lit(i + 1, dtype=pl.Int64).alias("class"))
+            for i, known_maps in enumerate(minority_maps)
+        ]
+    )
+
+
+def format_dataset(
+    maps: pl.DataFrame, relatives_tables: dict, schema: pl.Schema, edit_cutoff: float
+):
+    """add relatives and edit similarity to mappings and select the columns of a refinenet dataset"""
+    return (
+        add_ancestors_and_descendants(
+            maps,
+            relatives_tables=relatives_tables,
+            bin_edit_similarity=True,
+            edit_cutoff=edit_cutoff,
+        )
+        .select(list(schema))
+        .cast(schema)
+        .unique(maintain_order=True)
+        .with_columns(
+            pl.col("source name").str.to_lowercase(),
+            pl.col("target name").str.to_lowercase(),
+        )
+    )
+
+
+## state of a worker process, set by init_dataset_worker
+_worker = {}
+
+
+def init_dataset_worker(dataset_def: dict, max_distance: int, cache_size: int = 8):
+    """
+    set up a worker process, graphs, names and relatives tables are loaded from their on disk caches when a shard
+    first needs them and kept for the next shards
+    """
+
+    @lru_cache(maxsize=cache_size)
+    def get_resource(prefix: str):
+        graph = get_network_graph(**dataset_def, prefix=prefix)
+        name_maps = get_name_maps(resources={prefix: dataset_def["resources"][prefix]})
+        relatives = get_relatives_table(
+            **dataset_def,
+            prefix=prefix,
+            graph=graph,
+            name_map_func=lambda x: get_name_from_curie(x, name_maps).lower(),
+            max_distance=max_distance,
+        )
+        return graph, name_maps, relatives
+
+    _worker.update(
+        dataset_def=dataset_def, max_distance=max_distance, get_resource=get_resource
+    )
+
+
+def build_dataset_shard(
+    source_prefix: str,
+    target_prefix: str,
+    fragment_path: str,
+    maps: pl.DataFrame,
+    minority_maps: list = None,
+    edit_cutoff: float = 0.00,
+    seed: int = 0,
+):
+    """
+    build the rows of one (source prefix, target prefix) shard in a process set up by init_dataset_worker and
+    write them as a parquet fragment. If minority_maps is given maps are exact mappings used to generate a synthetic
+    training shard, otherwise maps are formatted for inference
+    """
+    network_graphs, name_maps, relatives_tables = {}, {}, {}
+    for prefix in {source_prefix, target_prefix}:
+        graph, prefix_name_maps, relatives = _worker["get_resource"](prefix)
+        network_graphs[prefix] = graph
+        name_maps |= prefix_name_maps
+        relatives_tables[prefix] = relatives
+    if minority_maps is not None:
+        maps = pl.concat(
+            [
+                synthetic_step(
+                    dataset_def=_worker["dataset_def"],
+                    exact_maps=maps,
+                    network_graphs=network_graphs,
+                    max_distance=_worker["max_distance"],
+                    seed=seed,
+                    name_maps=name_maps,
+                ),
+                real_step(minority_maps=minority_maps),
+            ],
+            how="diagonal_relaxed",
+        )
+        schema = GENERATED_DATASET_SCHEMA
+    else:
+        schema = INFERENCE_DATASET_SCHEMA
+    df = format_dataset(maps, relatives_tables, schema=schema, edit_cutoff=edit_cutoff)
+    df.write_parquet(f"{fragment_path}.tmp")
+    os.replace(f"{fragment_path}.tmp", fragment_path)
+    logger.info(f"wrote {len(df)} {source_prefix}-{target_prefix} rows")
+    return fragment_path
+
+
+def get_shards(dataset_def: dict, maps: pl.DataFrame, minority_maps: list = None):
+    """split mappings (and minority class mappings) by source and target prefix, largest shards first"""
+    keys = ["source prefix", "target prefix"]
+    frames = [maps] + (minority_maps or [])
+    partitions = [x.partition_by(keys, as_dict=True) for x in frames]
+    shard_keys = {
+        key
+        for partition in partitions
+        for key in partition
+        if all(prefix in dataset_def["resources"] for prefix in key)
+    }
+    shards = [
+        dict(
+            source_prefix=source_prefix,
+            target_prefix=target_prefix,
+            maps=partitions[0].get((source_prefix, target_prefix), maps.clear()),
+            minority_maps=(
+                None
+                if minority_maps is None
+                else [
+                    partition.get((source_prefix, target_prefix), frame.clear())
+                    for partition, frame in zip(partitions[1:], minority_maps)
+                ]
+            ),
+        )
+        for source_prefix, target_prefix in sorted(shard_keys)
+    ]
+    return sorted(
+        shards,
+        key=lambda x: -len(x["maps"]) - sum(len(y) for y in x["minority_maps"] or []),
+    )
+
+
+def run_dataset_shards(
     dataset_def: dict,
-    network_graphs: dict,
+    shards: list,
+    output_path: str,
+    schema: pl.Schema,
     max_distance: int,
+    n_workers: int,
+    edit_cutoff: float = 0.00,
+    seed: int = 0,
 ):
-    """add real minority classes to the training data"""
-    generated_maps = []
+    """
+    build every shard in a pool of n_workers processes and combine the fragments into output_path.
+    The graphs and relatives tables are built once up front so workers only read them from the on disk caches
+    """
+    network_graphs = {
+        x: get_network_graph(**dataset_def, prefix=x) for x in dataset_def["resources"]
+    }
     name_maps = get_name_maps(**dataset_def)
-    name_map_func = lambda x: get_name_from_curie(x, name_maps).lower()
-    for i, known_maps in enumerate(minority_maps):
-        for row in known_maps.iter_rows(named=True):
-            if (
-                row["source prefix"] not in network_graphs
-                or row["target prefix"] not in network_graphs
-            ):
-                continue
-            target_graph = network_graphs[row["target prefix"]]
-            source_graph = network_graphs[row["source prefix"]]
-
-            generated_map = row.copy()
-            generated_map = add_ancestors_and_descendants(
-                row=generated_map,
-                name_map_func=name_map_func,
-                source_graph=source_graph,
-                target_graph=target_graph,
-                max_distance=max_distance,
-                max_relations=3,
-                bin_edit_similarity=True,
-                edit_cutoff=0.00,  ## not using distance cutoff
+    get_relatives_tables(
+        dataset_def=dataset_def,
+        network_graphs=network_graphs,
+        name_map_func=lambda x: get_name_from_curie(x, name_maps).lower(),
+        max_distance=max_distance,
+    )
+    del network_graphs, name_maps
+    fragment_dir = f"{os.path.splitext(output_path)[0]}_fragments"
+    if os.path.exists(fragment_dir):
+        shutil.rmtree(fragment_dir)
+    os.makedirs(fragment_dir)
+    logger.info(f"building {len(shards)} shards with {n_workers} workers")
+    ## polars is not fork safe so workers are spawned
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=partial(
+            init_dataset_worker, dataset_def=dataset_def, max_distance=max_distance
+        ),
+    ) as executor:
+        futures = [
+            executor.submit(
+                build_dataset_shard,
+                fragment_path=os.path.join(
+                    fragment_dir,
+                    f"{shard['source_prefix']}-{shard['target_prefix']}.parquet",
+                ),
+                edit_cutoff=edit_cutoff,
+                seed=seed,
+                **shard,
             )
-            generated_map["class"] = i + 1
-            ## add  and ancestors for source to row
-            generated_maps.append(generated_map)
-    return generated_maps
+            for shard in shards
+        ]
+        ## raise errors from failed shards
+        fragment_paths = [future.result() for future in futures]
+    if fragment_paths:
+        pl.scan_parquet(sorted(fragment_paths)).unique(maintain_order=True).sink_parquet(
+            output_path
+        )
+    else:
+        pl.DataFrame(schema=schema).write_parquet(output_path)
+    shutil.rmtree(fragment_dir)
 
 
-def make_synthetic_dataset(dataset_def: dict, max_distance: int, output_path: str):
+def make_synthetic_dataset(
+    dataset_def: dict,
+    max_distance: int,
+    output_path: str,
+    seed: int = 0,
+    n_workers: int = 1,
+):
     """generate a synthetic training dataset for Refinenet models.
     Loads in known mappings both directly from the source ontologies and Semra.
     Takes broad and narrow maps from those sources directly, and uses exact mappings
     to generate synthetic broad and narrow matchings.
     Note: Tries to make classes as balanced as possible, but often there are more exact mappings.
+    With more than one worker the mappings are sharded by source and target prefix (classes are balanced per shard).
     """
     ## load raw mappings from provided by ontologies and Semra
     exact_maps, broad_maps, narrow_maps = process_known_maps(dataset_def=dataset_def)
+    ## define the output path and confirm with the user it is ok to overwrite an existing one
+    output_path = "generated_maps.parquet" if output_path == "" else output_path
+    file_safety_check(output_path)
+    if n_workers > 1:
+        run_dataset_shards(
+            dataset_def=dataset_def,
+            shards=get_shards(dataset_def, exact_maps, [broad_maps, narrow_maps]),
+            output_path=output_path,
+            schema=GENERATED_DATASET_SCHEMA,
+            max_distance=max_distance,
+            n_workers=n_workers,
+            seed=seed,
+        )
+        return
     ## load in obo graphs for each ontology as a dict
     network_graphs = {
         x: get_network_graph(**dataset_def, prefix=x) for x in dataset_def["resources"]
     }
+    name_maps = get_name_maps(**dataset_def)
+    name_map_func = lambda x: get_name_from_curie(x, name_maps).lower()
+    ## named relatives of every class, built once per resource version
+    relatives_tables = get_relatives_tables(
+        dataset_def=dataset_def,
+        network_graphs=network_graphs,
+        name_map_func=name_map_func,
+        max_distance=max_distance,
+    )
     ## add synthetic broad and narrow mappings
     generated_maps = synthetic_step(
         dataset_def=dataset_def,
         exact_maps=exact_maps,
         network_graphs=network_graphs,
         max_distance=max_distance,
+        seed=seed,
+        name_maps=name_maps,
     )
     ## add any real examples of the minority classes to the training data to improve signal
-    generated_maps += real_step(
-        minority_maps=[broad_maps, narrow_maps],
-        dataset_def=dataset_def,
-        network_graphs=network_graphs,
-        max_distance=max_distance,
+    generated_maps = pl.concat(
+        [generated_maps, real_step(minority_maps=[broad_maps, narrow_maps])],
+        how="diagonal_relaxed",
     )
-    ## read the maps into a polars datafarme
-    generated_maps_df = (
-        pl.from_records(generated_maps, schema=GENERATED_DATASET_SCHEMA)
-        .unique()
-        .with_columns(
-            pl.col("source name").str.to_lowercase(),
-            pl.col("target name").str.to_lowercase(),
-        )
+    ## add ancestor and descendant information to every row
+    generated_maps_df = format_dataset(
+        generated_maps,
+        relatives_tables=relatives_tables,
+        schema=GENERATED_DATASET_SCHEMA,
+        edit_cutoff=0.00,  ## not using distance cutoff
     )
-    ## define the output path and confirm with the user it is ok to overwrite an existing one
-    output_path = "generated_maps.parquet" if output_path == "" else output_path
-    file_safety_check(output_path)
     ## write output (to parquet file since contains nested data-types)
     generated_maps_df.write_parquet(output_path)
 
@@ -294,12 +508,26 @@ def make_inference_dataset(
     edit_cutoff: float,
     max_distance: int,
     output_path: str,
+    n_workers: int = 1,
 ):
     ## read in base of inference dataset
     known_maps = pl.read_csv(
         mappings_path,
         separator="\t",
     )
+    output_path = "logmap_maps.parquet" if output_path is None else output_path
+    file_safety_check(output_path)
+    if n_workers > 1:
+        run_dataset_shards(
+            dataset_def=dataset_def,
+            shards=get_shards(dataset_def, known_maps),
+            output_path=output_path,
+            schema=INFERENCE_DATASET_SCHEMA,
+            max_distance=max_distance,
+            n_workers=n_workers,
+            edit_cutoff=edit_cutoff,
+        )
+        return
     ## load dictionary of obo graphs
     network_graphs = {
         x: get_network_graph(**dataset_def, prefix=x) for x in dataset_def["resources"]
@@ -309,40 +537,19 @@ def make_inference_dataset(
         **dataset_def,
     )
     name_map_func = lambda x: get_name_from_curie(x, name_maps).lower()
-    generated_maps = []
+    relatives_tables = get_relatives_tables(
+        dataset_def=dataset_def,
+        network_graphs=network_graphs,
+        name_map_func=name_map_func,
+        max_distance=max_distance,
+    )
     ## format the dataset
-    for row in known_maps.iter_rows(named=True):
-        if (
-            row["source prefix"] not in network_graphs
-            or row["target prefix"] not in network_graphs
-        ):
-            continue
-
-        target_graph = network_graphs[row["target prefix"]]
-        source_graph = network_graphs[row["source prefix"]]
-
-        generated_map = row.copy()
-        generated_map = add_ancestors_and_descendants(
-            row=generated_map,
-            name_map_func=name_map_func,
-            source_graph=source_graph,
-            target_graph=target_graph,
-            max_distance=max_distance,
-            max_relations=3,
-            bin_edit_similarity=True,
-            edit_cutoff=edit_cutoff,  ## not using distance cutoff
-        )
-        generated_maps.append(generated_map)
-    generated_maps_df = (
-        pl.from_records(generated_maps, schema=INFERENCE_DATASET_SCHEMA)
-        .unique()
-        .with_columns(
-            pl.col("source name").str.to_lowercase(),
-            pl.col("target name").str.to_lowercase(),
-        )
+    generated_maps_df = format_dataset(
+        known_maps,
+        relatives_tables=relatives_tables,
+        schema=INFERENCE_DATASET_SCHEMA,
+        edit_cutoff=edit_cutoff,
     )
-    output_path = "logmap_maps.parquet" if output_path is None else output_path
-    file_safety_check(output_path)
     ## write output (to parquet file since contains nested data-types)
     generated_maps_df.write_parquet(output_path)
 
@@ -354,6 +561,8 @@ def main(
     synthetic: bool,
     mappings_path: str,
     edit_cutoff: float,
+    seed: int,
+    n_workers: int,
 ):
     """dispatch methods to either generate a dataset for training or inference"""
     config = load_config_from_json(config_path=config_path)
@@ -364,6 +573,8 @@ def main(
             dataset_def=dataset_def,
             max_distance=max_distance,
             output_path=output_path,
+            seed=seed,
+            n_workers=n_workers,
         )
     else:
         make_inference_dataset(
@@ -372,6 +583,7 @@ def main(
             edit_cutoff=edit_cutoff,
             max_distance=max_distance,
             output_path=output_path,
+            n_workers=n_workers,
         )
 
 
@@ -418,5 +630,18 @@ if __name__ == "__main__":
         default=0.00,
         help="min edit similarity to use for mappings. (only if synthetic is false) defaults to zero ie know mappings will be exuded",
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="random seed used to generate the synthetic dataset (only if synthetic is true)",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=1,
+        help="number of worker processes, with more than one the mappings are sharded by source and target prefix",
+    )
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,267 @@
+"""
+Entity embedding index for dense candidate retrieval.
+The name of every class of each resource version is encoded once with a bi-encoder (SapBERT by default) and stored
+in a memory mapped float16 matrix with an id table:
+    <index_dir>/<model_name>/<prefix>_<version>.f16          normalized embeddings, one row per class
+    <index_dir>/<model_name>/<prefix>_<version>.parquet      row, identifier and name of each class
+Top k queries across resources are blocked matrix multiplies over the memory mapped matrices.
+"""
+
+import glob
+import os
+
+import numpy as np
+import polars as pl
+import torch
+from bioregistry import normalize_prefix
+from pyobo import get_id_name_mapping
+from tqdm import tqdm
+from transformers import AutoModel, AutoTokenizer
+
+from mapnet.refinenet.constants import MODELS
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.path.join("output", "embeddings")
+
+
+def get_embedding_paths(prefix: str, version: str, model_name: str, index_dir: str = INDEX_DIR):
+    """returns the paths of the embedding matrix and id table of a resource version"""
+    stem = os.path.join(index_dir, model_name, f"{prefix}_{version}")
+    return f"{stem}.f16", f"{stem}.parquet"
+
+
+def load_embeddings(prefix: str, version: str, model_name: str, index_dir: str = INDEX_DIR):
+    """returns the id table and memory mapped embeddings of a resource version"""
+    matrix_path, ids_path = get_embedding_paths(prefix, version, model_name, index_dir)
+    ids = pl.read_parquet(ids_path)
+    matrix = np.memmap(matrix_path, dtype=np.float16, mode="r").reshape(len(ids), -1)
+    return ids, matrix
+
+
+def get_previous_embeddings(
+    prefix: str, version: str, model_name: str, index_dir: str = INDEX_DIR
+):
+    """returns the embeddings of other versions of a resource keyed by name, used to avoid re-encoding unchanged names"""
+    previous = {}
+    for ids_path in glob.glob(os.path.join(index_dir, model_name, f"{prefix}_*.parquet")):
+        other_version = os.path.basename(ids_path).removeprefix(f"{prefix}_").removesuffix(
+            ".parquet"
+        )
+        if other_version == version:
+            continue
+        ids, matrix = load_embeddings(prefix, other_version, model_name, index_dir)
+        for row, name in ids.select("row", "name").iter_rows():
+            previous[name] = (matrix, row)
+    return previous
+
+
+@torch.no_grad()
+def encode_names(names: list, model, tokenizer, batch_size: int = 256, max_length: int = 32):
+    """encode names with the [CLS] embedding of a bi-encoder, normalized to unit length"""
+    vectors = []
+    for i in range(0, len(names), batch_size):
+        inputs = tokenizer(
+            names[i : i + batch_size],
+            padding=True,
+            truncation=True,
+            max_length=max_length,
+            return_tensors="pt",
+        )
+        cls = model(**inputs).last_hidden_state[:, 0]
+        vectors.append(torch.nn.functional.normalize(cls, dim=-1).numpy())
+    return np.concatenate(vectors)
+
+
+def build_embedding_index(
+    resources: dict,
+    model_name: str = "SapBERT",
+    index_dir: str = INDEX_DIR,
+    batch_size: int = 256,
+    chunk_size: int = 8192,
+    n_threads: int = None,
+):
+    """
+    encode the names of every class of each resource, skipping resource versions that are already indexed.
+    Names that were already encoded for another version of the same resource are copied instead of re-encoded.
+    args:
+        model_name: key of the model in MODELS
+        chunk_size: number of names encoded between writes to the memory mapped matrix
+    """
+    os.makedirs(os.path.join(index_dir, model_name), exist_ok=True)
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    model, tokenizer = None, None
+    for prefix in resources:
+        prefix_n = normalize_prefix(prefix)
+        version = resources[prefix]["version"]
+        matrix_path, ids_path = get_embedding_paths(prefix_n, version, model_name, index_dir)
+        if os.path.exists(ids_path):
+            logger.info(f"found {prefix_n} {version} embeddings")
+            continue
+        if model is None:
+            logger.info(f"loading {MODELS[model_name]}")
+            tokenizer = AutoTokenizer.from_pretrained(MODELS[model_name])
+            model = AutoModel.from_pretrained(MODELS[model_name]).eval()
+        name_map = get_id_name_mapping(prefix=prefix_n, version=version)
+        ids = pl.DataFrame(
+            {
+                "identifier": [f"{prefix_n}:{x}" for x in name_map],
+                "name": list(name_map.values()),
+            }
+        ).with_row_index("row")
+        if len(ids) == 0:
+            logger.warning(f"no names found for {prefix_n} {version}, skipping")
+            continue
+        previous = get_previous_embeddings(prefix_n, version, model_name, index_dir)
+        logger.info(
+            f"encoding {len(ids)} {prefix_n} {version} names, {sum(x in previous for x in ids['name'])} reused"
+        )
+        matrix = np.memmap(
+            f"{matrix_path}.tmp",
+            dtype=np.float16,
+            mode="w+",
+            shape=(len(ids), model.config.hidden_size),
+        )
+        names = ids["name"].to_list()
+        for i in tqdm(range(0, len(names), chunk_size), desc=f"{prefix_n} embeddings"):
+            chunk = names[i : i + chunk_size]
+            new = [j for j, name in enumerate(chunk) if name not in previous]
+            for j, name in enumerate(chunk):
+                if name in previous:
+                    other, row = previous[name]
+                    matrix[i + j] = other[row]
+            if new:
+                matrix[[i + j for j in new]] = encode_names(
+                    [chunk[j] for j in new], model, tokenizer, batch_size=batch_size
+                ).astype(np.float16)
+        matrix.flush()
+        del matrix
+        ## the id table marks the index as complete so it is written last
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+        ids.write_parquet(ids_path)
+
+
+def blocked_top_k(
+    source: np.ndarray, target: np.ndarray, k: int = 10, block_size: int = 4096
+):
+    """
+    returns the indices and cosine similarities of the k most similar target rows for every source row.
+    Both matrices are read block by block so memory stays bounded by block_size squared.
+    """
+    k = min(k, len(target))
+    top_indices = np.zeros((len(source), k), dtype=np.int64)
+    top_scores = np.zeros((len(source), k), dtype=np.float32)
+    for i in range(0, len(source), block_size):
+        source_block = np.asarray(source[i : i + block_size], dtype=np.float32)
+        best_indices = np.zeros((len(source_block), 0), dtype=np.int64)
+        best_scores = np.zeros((len(source_block), 0), dtype=np.float32)
+        for j in range(0, len(target), block_size):
+            target_block = np.asarray(target[j : j + block_size], dtype=np.float32)
+            scores = source_block @ target_block.T
+            ## merge the best of this block with the best so far
+            scores = np.concatenate([best_scores, scores], axis=1)
+            indices = np.concatenate(
+                [
+                    best_indices,
+                    np.broadcast_to(
+                        np.arange(j, j + len(target_block)),
+                        (len(source_block), len(target_block)),
+                    ),
+                ],
+                axis=1,
+            )
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                keep = np.argsort(-scores, axis=1)
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_indices = np.take_along_axis(indices, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        top_scores[i : i + block_size] = np.take_along_axis(best_scores, order, axis=1)
+        top_indices[i : i + block_size] = np.take_along_axis(best_indices, order, axis=1)
+    return top_indices, top_scores
+
+
+def get_embedding_candidates(
+    source_prefix: str,
+    target_prefix: str,
+    resources: dict,
+    model_name: str = "SapBERT",
+    index_dir: str = INDEX_DIR,
+    k: int = 10,
+    min_similarity: float = 0.0,
+    block_size: int = 4096,
+    write_path: str = None,
+):
+    """
+    returns the k nearest target classes of every source class by cosine similarity of their embeddings,
+    as mappings in biomappings format. Resources are indexed first if needed.
+    """
+    resources = {normalize_prefix(x): resources[x] for x in resources}
+    source_prefix, target_prefix = normalize_prefix(source_prefix), normalize_prefix(target_prefix)
+    build_embedding_index(
+        {x: resources[x] for x in [source_prefix, target_prefix]},
+        model_name=model_name,
+        index_dir=index_dir,
+    )
+    source_ids, source_matrix = load_embeddings(
+        source_prefix, resources[source_prefix]["version"], model_name, index_dir
+    )
+    target_ids, target_matrix = load_embeddings(
+        target_prefix, resources[target_prefix]["version"], model_name, index_dir
+    )
+    indices, scores = blocked_top_k(source_matrix, target_matrix, k=k, block_size=block_size)
+    df = (
+        pl.DataFrame(
+            {
+                "source row": np.repeat(np.arange(len(source_ids)), indices.shape[1]),
+                "target row": indices.ravel(),
+                "confidence": scores.ravel(),
+            }
+        )
+        .filter(pl.col("confidence") >= min_similarity)
+        .join(
+            source_ids.select(
+                pl.col("row").cast(pl.Int64).alias("source row"),
+                pl.col("identifier").alias("source identifier"),
+                pl.col("name").alias("source name"),
+            ),
+            on="source row",
+        )
+        .join(
+            target_ids.select(
+                pl.col("row").cast(pl.Int64).alias("target row"),
+                pl.col("identifier").alias("target identifier"),
+                pl.col("name").alias("target name"),
+            ),
+            on="target row",
+        )
+        .with_columns(
+            pl.lit(source_prefix).alias("source prefix"),
+            pl.lit(target_prefix).alias("target prefix"),
+            pl.lit("skos:exactMatch").alias("relation"),
+            pl.lit("semapv:SemanticSimilarityThresholdMatching").alias("type"),
+            pl.lit(f"mapnet-{model_name.lower()}").alias("source"),
+        )
+        .select(
+            [
+                "source prefix",
+                "source identifier",
+                "source name",
+                "relation",
+                "target prefix",
+                "target identifier",
+                "target name",
+                "type",
+                "confidence",
+                "source",
+            ]
+        )
+        .sort(["source identifier", "confidence"], descending=[False, True])
+    )
+    if write_path is not None:
+        os.makedirs(os.path.dirname(write_path) or ".", exist_ok=True)
+        df.write_csv(write_path, separator="\t")
+    return df
@@ -0,0 +1,251 @@
+"""
+Per-entity tables of named relatives for building RefineNet datasets.
+For every class of a resource version the first max_relations named ancestors and descendants (in breadth first
+order, within max_distance) are computed once with a level by level traversal over all classes and cached as parquet
+next to the graph pickle:
+    <dataset_dir>/<prefix>/<version>[/<subset_dir>]/<prefix>.named_relatives_<max_relations>_<max_distance>.parquet
+Datasets then get their relatives features with a join instead of a traversal per row.
+"""
+
+import os
+
+import polars as pl
+import logging
+
+logger = logging.getLogger(__name__)
+
+RELATIVES_SCHEMA = pl.Schema(
+    [
+        ("identifier", pl.String),
+        ("ancestor identifiers", pl.List(pl.String)),
+        ("ancestor names", pl.List(pl.String)),
+        ("descendant identifiers", pl.List(pl.String)),
+        ("descendant names", pl.List(pl.String)),
+    ]
+)
+
+
+def get_relatives_table_path(
+    resources: dict, meta: dict, prefix: str, max_relations: int, max_distance: int
+):
+    """returns the path of the relatives table of a resource version"""
+    resource_dir = os.path.join(
+        meta["dataset_dir"], prefix, resources[prefix]["version"]
+    )
+    if resources[prefix]["subset"]:
+        resource_dir = os.path.join(resource_dir, meta["subset_dir"])
+    return os.path.join(
+        resource_dir, f"{prefix}.named_relatives_{max_relations}_{max_distance}.parquet"
+    )
+
+
+def get_adjacency(graph, reverse: bool = False):
+    """
+    edges of a graph as a df, position keeps the order networkx iterates the neighbors of a node in.
+    pyobo graphs have edges from child to parent, so reverse gives the children of a node
+    """
+    neighbors = graph.pred if reverse else graph.succ
+    return pl.DataFrame(
+        [
+            (node, neighbor, i)
+            for node in graph.nodes
+            for i, neighbor in enumerate(neighbors[node])
+        ],
+        schema={"node": pl.String, "neighbor": pl.String, "position": pl.Int64},
+        orient="row",
+    )
+
+
+def get_relative_ranks(adjacency: pl.DataFrame, roots: list, max_distance: int):
+    """
+    breadth first traversal from every root at once, one join per level.
+    rank is the order a relative is reached in, the same as nx.bfs_edges from that root
+    (parents in the order they were reached, then neighbors in adjacency order)
+    """
+    visited = pl.DataFrame(
+        {"root": roots, "node": roots, "rank": [0] * len(roots)},
+        schema={"root": pl.String, "node": pl.String, "rank": pl.Int64},
+    )
+    frontier = visited
+    for _ in range(max_distance):
+        found = (
+            frontier.join(adjacency, on="node")
+            .sort("root", "rank", "position")
+            .select("root", pl.col("neighbor").alias("node"), "rank", "position")
+            .unique(["root", "node"], keep="first", maintain_order=True)
+            .join(visited.select("root", "node"), on=["root", "node"], how="anti")
+            .join(
+                visited.group_by("root").agg(pl.col("rank").max().alias("offset")),
+                on="root",
+            )
+            .sort("root", "rank", "position")
+            .select(
+                "root",
+                "node",
+                (pl.col("offset") + pl.int_range(1, pl.len() + 1).over("root")).alias(
+                    "rank"
+                ),
+            )
+        )
+        if found.is_empty():
+            break
+        visited = pl.concat([visited, found])
+        frontier = found
+    return visited.filter(pl.col("rank") > 0)
+
+
+def get_relatives_within_distance(
+    graph,
+    roots: list,
+    max_distance: int,
+    descendants: bool = True,
+    batch_size: int = 10000,
+):
+    """all descendants (or ancestors) within max_distance of every root of a pyobo graph, as root and relative pairs"""
+    adjacency = get_adjacency(graph, reverse=descendants)
+    relatives = [
+        get_relative_ranks(adjacency, roots[i : i + batch_size], max_distance)
+        for i in range(0, len(roots), batch_size)
+    ]
+    if not relatives:
+        relatives = [get_relative_ranks(adjacency, [], max_distance)]
+    return pl.concat(relatives).select("root", pl.col("node").alias("relative"))
+
+
+def get_top_k_relatives(
+    adjacency: pl.DataFrame,
+    names: pl.DataFrame,
+    roots: list,
+    max_relations: int,
+    max_distance: int,
+):
+    """first max_relations named relatives of every root, as lists of identifiers and names"""
+    return (
+        get_relative_ranks(adjacency, roots, max_distance)
+        .join(names, on="node")
+        .sort("root", "rank")
+        .filter(pl.int_range(pl.len()).over("root") < max_relations)
+        .group_by("root", maintain_order=True)
+        .agg(pl.col("node").alias("identifiers"), pl.col("name").alias("names"))
+    )
+
+
+def build_relatives_table(
+    graph,
+    name_map_func,
+    max_relations: int = 3,
+    max_distance: int = 3,
+    batch_size: int = 10000,
+):
+    """
+    build the relatives table of a graph, gives the same relatives as top_k_named_relations for every class.
+    args:
+        name_map_func: maps a curie to its name, classes named NO_NAME_FOUND (in any case) are skipped
+        batch_size: number of classes traversed together, bounds the memory used by the traversal
+    """
+    nodes = list(graph.nodes)
+    names = pl.DataFrame(
+        {"node": nodes, "name": [name_map_func(x) for x in nodes]},
+        schema={"node": pl.String, "name": pl.String},
+    ).filter(pl.col("name").str.to_uppercase() != "NO_NAME_FOUND")
+    table = pl.DataFrame({"identifier": nodes}, schema={"identifier": pl.String})
+    ## pyobo graphs have edges from child to parent
+    for direction, reverse in [("descendant", True), ("ancestor", False)]:
+        adjacency = get_adjacency(graph, reverse=reverse)
+        relatives = pl.concat(
+            [
+                get_top_k_relatives(
+                    adjacency,
+                    names,
+                    nodes[i : i + batch_size],
+                    max_relations=max_relations,
+                    max_distance=max_distance,
+                )
+                for i in range(0, len(nodes), batch_size)
+            ]
+        )
+        table = table.join(
+            relatives.select(
+                pl.col("root").alias("identifier"),
+                pl.col("identifiers").alias(f"{direction} identifiers"),
+                pl.col("names").alias(f"{direction} names"),
+            ),
+            on="identifier",
+            how="left",
+        )
+    return table.with_columns(
+        pl.col(x).fill_null(pl.lit([], dtype=pl.List(pl.String)))
+        for x in RELATIVES_SCHEMA
+        if x != "identifier"
+    ).select(list(RELATIVES_SCHEMA))
+
+
+def get_relatives_table(
+    resources: dict,
+    meta: dict,
+    prefix: str,
+    graph,
+    name_map_func,
+    max_relations: int = 3,
+    max_distance: int = 3,
+    **_,
+):
+    """load the relatives table of a resource version, building and caching it if needed"""
+    table_path = get_relatives_table_path(
+        resources, meta, prefix, max_relations=max_relations, max_distance=max_distance
+    )
+    if os.path.exists(table_path):
+        logger.info(f"Found {prefix} relatives, at {table_path}")
+        return pl.read_parquet(table_path)
+    logger.info(f"building {prefix} relatives for {graph.number_of_nodes()} classes")
+    table = build_relatives_table(
+        graph,
+        name_map_func,
+        max_relations=max_relations,
+        max_distance=max_distance,
+    )
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+    table.write_parquet(table_path)
+    logger.info(f"Writing {prefix} relatives, to {table_path}")
+    return table
+
+
+def join_relatives(df: pl.DataFrame, relatives_tables: dict):
+    """
+    add the relatives of the source and target classes of every mapping, rows from resources without a table are
+    dropped and classes missing from their graph get empty lists.
+    The "descendant" and "ancestor" columns hold the descendants and ancestors of a class, as in the table
+    """
+    relatives = pl.concat(
+        [
+            table.with_columns(pl.lit(prefix).alias("prefix"))
+            for prefix, table in relatives_tables.items()
+        ]
+    )
+    df = df.filter(
+        pl.col("source prefix").is_in(list(relatives_tables))
+        & pl.col("target prefix").is_in(list(relatives_tables))
+    )
+    columns = []
+    for side in ["source", "target"]:
+        df = df.join(
+            relatives.select(
+                pl.col("prefix").alias(f"{side} prefix"),
+                pl.col("identifier").alias(f"{side} identifier"),
+                pl.col("descendant identifiers").alias(f"{side} descendant identifiers"),
+                pl.col("descendant names").alias(f"{side} descendant names"),
+                pl.col("ancestor identifiers").alias(f"{side} ancestor identifiers"),
+                pl.col("ancestor names").alias(f"{side} ancestor names"),
+            ),
+            on=[f"{side} prefix", f"{side} identifier"],
+            how="left",
+        )
+        columns += [
+            f"{side} descendant identifiers",
+            f"{side} descendant names",
+            f"{side} ancestor identifiers",
+            f"{side} ancestor names",
+        ]
+    return df.with_columns(
+        pl.col(x).fill_null(pl.lit([], dtype=pl.List(pl.String))) for x in columns
+    )
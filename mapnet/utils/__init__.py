@@ -1,4 +1,10 @@
 from .utils import *
+from .accounting import *
+from .closure import *
+from .conflicts import *
 from .filtering import *
+from .lexical import *
+from .minhash import *
 from .obo import *
+from .propagation import *
 from .robot import *
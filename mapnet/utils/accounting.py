@@ -0,0 +1,237 @@
+"""
+Resource accounting for external jobs (logmap, robot and container builds).
+"""
+
+import datetime
+import fcntl
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import polars as pl
+import logging
+
+logger = logging.getLogger(__name__)
+
+## jobs can be run from several threads at once (see mapnet.logmap.scheduler), and from several processes sharing a
+## report (see mapnet.logmap.work_queue) so appends also take a file lock
+_report_lock = threading.Lock()
+
+
+def get_path_size_mb(pth: str):
+    """returns the size of a file, or of all files in a directory, in MB. Missing paths have size 0"""
+    if os.path.isdir(pth):
+        size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(pth)
+            for f in files
+        )
+    elif os.path.exists(pth):
+        size = os.path.getsize(pth)
+    else:
+        size = 0
+    return size / 1e6
+
+
+def count_lines(pth: str):
+    """count the lines of a file, returns None if it does not exist"""
+    if not os.path.exists(pth):
+        return None
+    with open(pth, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def write_job_record(report_path: str, record: dict):
+    """append a job record to a json lines report"""
+    os.makedirs(os.path.dirname(report_path) or "./", exist_ok=True)
+    with _report_lock:
+        with open(report_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_container_cgroup_dir(cid: str):
+    """returns the cgroup (v2) directory of a running docker container, None if it is not running on this host"""
+    try:
+        pid = subprocess.run(
+            ["docker", "inspect", "-f", "{{.State.Pid}}", cid],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        with open(f"/proc/{pid}/cgroup", "r") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    cgroup_dir = os.path.join("/sys/fs/cgroup", line.strip()[3:].lstrip("/"))
+                    return cgroup_dir if os.path.isdir(cgroup_dir) else None
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return None
+
+
+def read_cgroup_usage(cgroup_dir: str):
+    """returns the cpu time and the peak memory of a cgroup so far, None once the cgroup is gone"""
+    try:
+        with open(os.path.join(cgroup_dir, "cpu.stat"), "r") as f:
+            cpu = dict(line.split() for line in f)
+        ## memory.peak needs a recent kernel, the current usage is sampled instead otherwise
+        memory_path = os.path.join(cgroup_dir, "memory.peak")
+        if not os.path.exists(memory_path):
+            memory_path = os.path.join(cgroup_dir, "memory.current")
+        with open(memory_path, "r") as f:
+            memory = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return {
+        "user_time_s": int(cpu["user_usec"]) / 1e6,
+        "system_time_s": int(cpu["system_usec"]) / 1e6,
+        "max_rss_mb": memory / 2**20,
+    }
+
+
+def sample_container_usage(
+    cidfile: str, stop: threading.Event, usage: dict, interval_s: float = 1.0
+):
+    """
+    sample the cgroup of the container whose id docker writes to cidfile until stop is set.
+    usage is updated in place with the last cpu times and the largest memory seen, the cgroup is removed with the
+    container so the last interval_s of a run is not counted
+    """
+    cgroup_dir = None
+    while not stop.wait(interval_s):
+        if cgroup_dir is None:
+            if not os.path.exists(cidfile):
+                continue
+            with open(cidfile, "r") as f:
+                cid = f.read().strip()
+            cgroup_dir = get_container_cgroup_dir(cid) if cid else None
+            if cgroup_dir is None:
+                continue
+        sample = read_cgroup_usage(cgroup_dir)
+        if sample is None:
+            continue
+        usage["user_time_s"] = sample["user_time_s"]
+        usage["system_time_s"] = sample["system_time_s"]
+        usage["max_rss_mb"] = max(usage.get("max_rss_mb", 0), sample["max_rss_mb"])
+
+
+def run_accounted(
+    cmd: list,
+    job_name: str,
+    report_path: str = None,
+    inputs: list = None,
+    outputs: list = None,
+    mappings_path: str = None,
+    log_path: str = None,
+    **extra,
+):
+    """
+    run an external command like subprocess.check_call, recording its wall time, cpu time and peak rss.
+    The usage is taken from wait4 on the child, so it covers the process and the descendants it waited for.
+    The container of a docker run command runs under the docker daemon instead, so its usage is sampled from the
+    container cgroup while it runs (peak memory includes the page cache) and the record is marked measured "container".
+    Other docker commands, or containers that can not be sampled (e.g. a remote daemon), are marked measured "client"
+    and their cpu time and peak rss are left empty.
+    args:
+        cmd : command to run
+        job_name : name of the job in the report
+        report_path : json lines file to append the record to, if None the record is only logged
+        inputs : input files or directories, their sizes are recorded
+        outputs : output files or directories, their sizes are recorded after the job
+        mappings_path : file of mappings written by the job, the number of lines is recorded
+        log_path : file to write the stdout and stderr of the job to, defaults to the terminal
+        extra : any other fields to add to the record
+    """
+    inputs = inputs or []
+    outputs = outputs or []
+    logger.info(f"running {cmd}")
+    run_cmd = cmd
+    container_usage = {}
+    if cmd[:2] == ["docker", "run"]:
+        ## docker writes the id of the container to the cidfile, which is used to find its cgroup
+        cid_dir = tempfile.mkdtemp()
+        run_cmd = [*cmd[:2], "--cidfile", os.path.join(cid_dir, "cid"), *cmd[2:]]
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=sample_container_usage,
+            args=(os.path.join(cid_dir, "cid"), stop, container_usage),
+            daemon=True,
+        )
+    start = time.time()
+    log_file = open(log_path, "w") if log_path else None
+    try:
+        proc = subprocess.Popen(
+            run_cmd,
+            stdout=log_file,
+            stderr=subprocess.STDOUT if log_file else None,
+        )
+        if run_cmd is not cmd:
+            sampler.start()
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        if log_file:
+            log_file.close()
+        if run_cmd is not cmd:
+            stop.set()
+            if sampler.is_alive():
+                sampler.join()
+            shutil.rmtree(cid_dir, ignore_errors=True)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if cmd[0] != "docker":
+        measured = "process"
+        ## ru_maxrss is reported in KB on linux
+        usage = {
+            "user_time_s": usage.ru_utime,
+            "system_time_s": usage.ru_stime,
+            "max_rss_mb": usage.ru_maxrss / 1024,
+        }
+    elif container_usage:
+        measured, usage = "container", container_usage
+    else:
+        measured, usage = "client", {}
+    record = {
+        "job": job_name,
+        "cmd": shlex.join(cmd),
+        "start": datetime.datetime.fromtimestamp(start).isoformat(),
+        "wall_time_s": time.time() - start,
+        "measured": measured,
+        "user_time_s": usage.get("user_time_s"),
+        "system_time_s": usage.get("system_time_s"),
+        "max_rss_mb": usage.get("max_rss_mb"),
+        "return_code": proc.returncode,
+        "inputs": inputs,
+        "input_size_mb": sum(get_path_size_mb(x) for x in inputs),
+        "outputs": outputs,
+        "output_size_mb": sum(get_path_size_mb(x) for x in outputs),
+        "n_mappings": count_lines(mappings_path) if mappings_path else None,
+    } | extra
+    logger.info(
+        f"{job_name} finished with code {record['return_code']} in {record['wall_time_s']:.1f}s"
+        + (
+            f", peak rss {record['max_rss_mb']:.0f}MB"
+            if record["max_rss_mb"] is not None
+            else ""
+        )
+    )
+    if report_path is not None:
+        write_job_record(report_path=report_path, record=record)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return proc.returncode
+
+
+def load_job_report(report_path: str, parquet_path: str = None):
+    """load a json lines job report as a dataframe, optionally also saving it as parquet"""
+    df = pl.read_ndjson(report_path)
+    if parquet_path is not None:
+        df.write_parquet(parquet_path)
+    return df
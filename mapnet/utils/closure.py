@@ -0,0 +1,142 @@
+"""
+Equivalence closure over mappings from all sources (known mappings, biomappings, semra and predictions).
+Entities are interned to integers and the connected components of the exact match edges are found with a
+vectorized union-find, so that transitively implied mappings (A = B from logmap and B = C from biomappings)
+can be recognized with a join.
+"""
+
+import numpy as np
+import polars as pl
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXACT_RELATIONS = ["skos:exactMatch", "owl:equivalentClass", "oboInOwl:hasDbXref"]
+
+
+def union_find(n_entities: int, source_ids: np.ndarray, target_ids: np.ndarray):
+    """
+    vectorized union-find, returns the root of the component of every entity (the smallest id in the component).
+    Every round hooks the larger root of each unmerged edge onto the smaller one, then compresses
+    all paths by pointer jumping so that every entity points directly to its root.
+    """
+    parent = np.arange(n_entities, dtype=np.int64)
+    n_rounds = 0
+    while True:
+        source_roots, target_roots = parent[source_ids], parent[target_ids]
+        unmerged = source_roots != target_roots
+        if not unmerged.any():
+            break
+        source_roots, target_roots = source_roots[unmerged], target_roots[unmerged]
+        ## the larger root can appear in several edges, keep the smallest root it is hooked onto
+        np.minimum.at(
+            parent,
+            np.maximum(source_roots, target_roots),
+            np.minimum(source_roots, target_roots),
+        )
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        n_rounds += 1
+    logger.debug(f"union-find converged after {n_rounds} rounds")
+    return parent
+
+
+def get_exact_edges(mapping_dfs: list, relations: list = EXACT_RELATIONS):
+    """
+    stack the identifier pairs of exact match mappings from several mapping dfs in biomappings format.
+    every df needs a relation column (e.g. sssom_to_biomappings with keep_relation), otherwise broad and narrow
+    mappings would be unioned into the same equivalence class
+    """
+    edges = []
+    for df in mapping_dfs:
+        if df is None:
+            continue
+        if "relation" not in df.columns:
+            raise ValueError(
+                "mapping dfs need a relation column to find their exact match mappings"
+            )
+        df = df.filter(pl.col("relation").is_in(relations))
+        edges.append(
+            df.select(
+                pl.col("source identifier").cast(pl.String),
+                pl.col("target identifier").cast(pl.String),
+            )
+        )
+    return pl.concat(edges).drop_nulls().unique()
+
+
+def get_equivalence_components(
+    mapping_dfs: list, relations: list = EXACT_RELATIONS
+):
+    """
+    returns the equivalence class of every entity that appears in an exact match mapping,
+    as a df with columns identifier, component
+    args:
+        mapping_dfs: list of mapping dfs in biomappings format, e.g. known mappings, biomappings and semra
+        relations: relations that are treated as equivalence
+    """
+    edges = get_exact_edges(mapping_dfs, relations=relations)
+    entities = (
+        pl.concat([edges["source identifier"], edges["target identifier"]])
+        .unique()
+        .to_frame("identifier")
+        .with_row_index("id")
+    )
+    edges = edges.join(
+        entities.rename({"identifier": "source identifier", "id": "source id"}),
+        on="source identifier",
+    ).join(
+        entities.rename({"identifier": "target identifier", "id": "target id"}),
+        on="target identifier",
+    )
+    roots = union_find(
+        len(entities),
+        edges["source id"].to_numpy().astype(np.int64),
+        edges["target id"].to_numpy().astype(np.int64),
+    )
+    components = entities.with_columns(pl.Series("component", roots)).select(
+        "identifier", "component"
+    )
+    logger.info(
+        f"found {components['component'].n_unique()} equivalence classes over {len(components)} entities"
+    )
+    return components
+
+
+def add_equivalence(
+    mappings_df: pl.DataFrame,
+    components: pl.DataFrame,
+    source_column: str = "source identifier",
+    target_column: str = "target identifier",
+):
+    """add an equivalent column, True if the source and target of a mapping are already transitively equivalent"""
+    return (
+        mappings_df.join(
+            components.rename({"identifier": source_column, "component": "_source_component"}),
+            on=source_column,
+            how="left",
+        )
+        .join(
+            components.rename({"identifier": target_column, "component": "_target_component"}),
+            on=target_column,
+            how="left",
+        )
+        .with_columns(
+            pl.col("_source_component")
+            .eq(pl.col("_target_component"))
+            .fill_null(False)
+            .alias("equivalent")
+        )
+        .drop("_source_component", "_target_component")
+    )
+
+
+def split_implied_mappings(mappings_df: pl.DataFrame, components: pl.DataFrame):
+    """split mappings into those already implied by the equivalence closure and the rest"""
+    mappings_df = add_equivalence(mappings_df, components)
+    implied = mappings_df.filter(pl.col("equivalent")).drop("equivalent")
+    rest = mappings_df.filter(~pl.col("equivalent")).drop("equivalent")
+    return implied, rest
@@ -0,0 +1,265 @@
+"""
+Conflict detection for merged mapping landscapes (e.g. the output of merge_logmap_mappings).
+Three kinds of conflicts are found with group-bys and joins:
+    one_to_many: a class with exact matches to several classes of the same ontology
+    same_prefix: an equivalence class (of the closure of the mappings) that contains two classes from the same ontology
+    hierarchy: mappings that contradict the is_a hierarchies of the ontologies they map between, either crossing
+        (a is_a b while the class b is mapped to is_a the class a is mapped to) or a class mapped to both a class
+        and one of its ancestors
+"""
+
+import os
+
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.utils.closure import get_equivalence_components
+from mapnet.utils.obo import get_is_a_edges, get_network_graph
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONFLICT_KINDS = ["one_to_many", "same_prefix", "hierarchy"]
+
+
+def get_one_to_many_conflicts(mapping_df: pl.DataFrame):
+    """returns the mappings of classes mapped to more than one class of the same target ontology"""
+    return mapping_df.filter(
+        pl.col("target identifier").n_unique().over("source identifier", "target prefix")
+        > 1
+    ).with_columns(pl.lit("one_to_many").alias("conflict"))
+
+
+def add_components(mapping_df: pl.DataFrame, components: pl.DataFrame):
+    """add the equivalence class of each mapping (both ends share it as it is an exact match)"""
+    return mapping_df.join(
+        components.rename({"identifier": "source identifier"}),
+        on="source identifier",
+        how="left",
+    )
+
+
+def get_same_prefix_conflicts(mapping_df: pl.DataFrame, components: pl.DataFrame):
+    """returns the mappings in equivalence classes that contain more than one class of an ontology"""
+    conflicting = (
+        components.with_columns(
+            pl.col("identifier").str.split(":").list.first().alias("prefix")
+        )
+        .filter(pl.col("identifier").n_unique().over("component", "prefix") > 1)
+        .select("component")
+        .unique()
+    )
+    return (
+        add_components(mapping_df, components)
+        .join(conflicting, on="component", how="semi")
+        .with_columns(pl.lit("same_prefix").alias("conflict"))
+    )
+
+
+def get_hierarchy_edges(resources: dict, meta: dict, prefixes: list = None):
+    """returns the direct is_a edges of each resource as a df with columns child, parent"""
+    prefixes = prefixes or list(resources)
+    edges = []
+    for prefix in prefixes:
+        graph = get_network_graph(resources=resources, meta=meta, prefix=prefix)
+        edges.append(
+            pl.DataFrame(
+                get_is_a_edges(graph),
+                schema={"child": pl.String, "parent": pl.String},
+                orient="row",
+            )
+        )
+    return pl.concat(edges)
+
+
+def get_ancestor_pairs(hierarchy_edges: pl.DataFrame, classes: pl.Series):
+    """
+    returns the (transitive) is_a ancestors of classes as a df with columns child, ancestor.
+    The ancestors are extended by one level per join until no new ones are found
+    """
+    edges = hierarchy_edges.unique()
+    frontier = edges.filter(pl.col("child").is_in(classes.implode())).rename(
+        {"parent": "ancestor"}
+    )
+    ancestors = frontier
+    while not frontier.is_empty():
+        frontier = (
+            frontier.join(edges, left_on="ancestor", right_on="child")
+            .select("child", pl.col("parent").alias("ancestor"))
+            .unique()
+            .join(ancestors, on=["child", "ancestor"], how="anti")
+        )
+        ancestors = pl.concat([ancestors, frontier])
+    return ancestors
+
+
+def get_hierarchy_conflicts(mapping_df: pl.DataFrame, hierarchy_edges: pl.DataFrame):
+    """
+    returns the mappings that contradict the is_a hierarchies of the ontologies they map between:
+    crossing mappings (a is_a b while the class b is mapped to is_a the class a is mapped to) and
+    the mappings of a class to both a class and one of its ancestors
+    """
+    keys = ["source identifier", "target identifier"]
+    mappings = mapping_df.select(*keys, "target prefix").unique()
+    ancestors = get_ancestor_pairs(
+        hierarchy_edges,
+        pl.concat([mappings["source identifier"], mappings["target identifier"]]).unique(),
+    )
+    crossing = (
+        ancestors.join(mappings, left_on="child", right_on="source identifier")
+        .rename({"target identifier": "child target"})
+        .join(
+            mappings,
+            left_on=["ancestor", "target prefix"],
+            right_on=["source identifier", "target prefix"],
+        )
+        .rename({"target identifier": "ancestor target"})
+        .join(
+            ancestors,
+            left_on=["ancestor target", "child target"],
+            right_on=["child", "ancestor"],
+            how="semi",
+        )
+    )
+    to_ancestor = mappings.join(
+        mappings, on=["source identifier", "target prefix"], suffix=" ancestor"
+    ).join(
+        ancestors,
+        left_on=["target identifier", "target identifier ancestor"],
+        right_on=["child", "ancestor"],
+        how="semi",
+    )
+    conflicting = pl.concat(
+        [
+            crossing.select(
+                pl.col("child").alias("source identifier"),
+                pl.col("child target").alias("target identifier"),
+            ),
+            crossing.select(
+                pl.col("ancestor").alias("source identifier"),
+                pl.col("ancestor target").alias("target identifier"),
+            ),
+            to_ancestor.select(keys),
+            to_ancestor.select(
+                "source identifier",
+                pl.col("target identifier ancestor").alias("target identifier"),
+            ),
+        ]
+    )
+    ## mappings are undirected, flag both directions
+    conflicting = pl.concat(
+        [
+            conflicting,
+            conflicting.select(
+                pl.col("target identifier").alias("source identifier"),
+                pl.col("source identifier").alias("target identifier"),
+            ),
+        ]
+    ).unique()
+    return mapping_df.join(conflicting, on=keys, how="semi").with_columns(
+        pl.lit("hierarchy").alias("conflict")
+    )
+
+
+def summarize_conflicts(conflicts: pl.DataFrame):
+    """count the mappings with each kind of conflict per prefix pair"""
+    return (
+        conflicts.group_by("conflict", "source prefix", "target prefix")
+        .agg(pl.len().alias("n_mappings"))
+        .sort("conflict", "n_mappings", descending=[False, True])
+    )
+
+
+def detect_conflicts(
+    mapping_df: pl.DataFrame,
+    resources: dict = None,
+    meta: dict = None,
+    kinds: list = CONFLICT_KINDS,
+    write_dir: str = None,
+):
+    """
+    find conflicts in a merged set of mappings.
+    The hierarchy check needs resources and meta to load the graph of each ontology.
+    args:
+        mapping_df: undirected mappings in biomappings format
+        kinds: kinds of conflicts to check for, see CONFLICT_KINDS
+        write_dir: if given conflicts.tsv and conflict_summary.tsv are written here
+    returns the conflicting mappings (with a conflict column) and a summary per prefix pair
+    """
+    found = []
+    if "one_to_many" in kinds:
+        found.append(get_one_to_many_conflicts(mapping_df))
+    if "same_prefix" in kinds:
+        components = get_equivalence_components([mapping_df])
+        found.append(get_same_prefix_conflicts(mapping_df, components).drop("component"))
+    if "hierarchy" in kinds:
+        if resources is None or meta is None:
+            raise ValueError("resources and meta are needed to check hierarchy conflicts")
+        resources = {normalize_prefix(x): resources[x] for x in resources}
+        prefixes = [
+            x
+            for x in pl.concat(
+                [mapping_df["source prefix"], mapping_df["target prefix"]]
+            )
+            .unique()
+            .to_list()
+            if x in resources
+        ]
+        hierarchy_edges = get_hierarchy_edges(
+            resources=resources, meta=meta, prefixes=prefixes
+        )
+        found.append(get_hierarchy_conflicts(mapping_df, hierarchy_edges))
+    conflicts = pl.concat(found, how="vertical_relaxed")
+    summary = summarize_conflicts(conflicts)
+    logger.info(
+        f"found {conflicts.select('source identifier', 'target identifier').n_unique()} conflicting mappings"
+    )
+    if write_dir is not None:
+        os.makedirs(write_dir, exist_ok=True)
+        conflicts.write_csv(os.path.join(write_dir, "conflicts.tsv"), separator="\t")
+        summary.write_csv(
+            os.path.join(write_dir, "conflict_summary.tsv"), separator="\t"
+        )
+    return conflicts, summary
+
+
+def prune_conflicts(
+    mapping_df: pl.DataFrame, conflicts: pl.DataFrame, kinds: list = CONFLICT_KINDS
+):
+    """
+    remove conflicting mappings.
+    For one_to_many conflicts only the most confident mapping(s) to each target ontology are kept, and a mapping
+    has to be kept from both ends to survive. Mappings with same_prefix or hierarchy conflicts are removed altogether.
+    """
+    keys = ["source identifier", "target identifier"]
+    if "one_to_many" in kinds and "confidence" in mapping_df.columns:
+        best = mapping_df.filter(
+            pl.col("confidence")
+            == pl.col("confidence").max().over("source identifier", "target prefix")
+        ).select(keys)
+        ## keep a mapping only if it is the best in both directions
+        best = best.join(
+            best.rename(
+                {
+                    "source identifier": "target identifier",
+                    "target identifier": "source identifier",
+                }
+            ),
+            on=keys,
+            how="semi",
+        )
+        mapping_df = mapping_df.join(best, on=keys, how="semi")
+    elif "one_to_many" in kinds:
+        mapping_df = mapping_df.join(
+            conflicts.filter(pl.col("conflict") == "one_to_many").select(keys),
+            on=keys,
+            how="anti",
+        )
+    component_kinds = [x for x in kinds if x != "one_to_many"]
+    mapping_df = mapping_df.join(
+        conflicts.filter(pl.col("conflict").is_in(component_kinds)).select(keys),
+        on=keys,
+        how="anti",
+    )
+    logger.info(f"{len(mapping_df)} mappings left after pruning {kinds} conflicts")
+    return mapping_df
@@ -4,6 +4,7 @@ from typing import Callable
 from itertools import combinations, combinations_with_replacement
 from mapnet.utils.utils import make_undirected, sssom_to_biomappings
 from mapnet.utils.obo import load_known_mappings_df
+from mapnet.utils.closure import get_equivalence_components, split_implied_mappings
 import os
 import subprocess
 import logging
@@ -11,9 +12,15 @@ logger = logging.getLogger(__name__)
 
 
 def load_biomappings_df(
-    target_prefix: str, source_prefix: str, undirected: bool = True
+    target_prefix: str,
+    source_prefix: str,
+    undirected: bool = True,
+    keep_relation: bool = False,
 ):
-    """return a polars data frame with the mappings from biomapping for two given ontologies."""
+    """
+    return a polars data frame with the mappings from biomapping for two given ontologies.
+    if keep_relation the predicate of every mapping is kept as the relation column
+    """
 
     
     df = (
@@ -21,7 +28,7 @@ def load_biomappings_df(
                 biomappings.load_mappings(), strict=False, infer_schema_length=None
             )
         )
-    df = sssom_to_biomappings(df)
+    df = sssom_to_biomappings(df, keep_relation=keep_relation)
     df = (
         df
             .filter(pl.col("source prefix").eq(source_prefix.lower()))
@@ -47,6 +54,7 @@ def load_biomappings_df(
                 "target name",
                 "target prefix",
             ]
+            + (["relation"] if keep_relation else [])
         )
     )
     if undirected:
@@ -55,15 +63,21 @@ def load_biomappings_df(
         return df
 
 
-def batch_load_biomappings_df(matched_resources: dict, **_):
+def batch_load_biomappings_df(
+    matched_resources: dict, keep_relation: bool = False, **_
+):
     full_df = None
     logger.info(matched_resources)
     for source_prefix, target_prefix in combinations(matched_resources, r=2):
         df = load_biomappings_df(
-            target_prefix=target_prefix, source_prefix=source_prefix
+            target_prefix=target_prefix,
+            source_prefix=source_prefix,
+            keep_relation=keep_relation,
         )
         reverse_maps = load_biomappings_df(
-            target_prefix=source_prefix, source_prefix=target_prefix
+            target_prefix=source_prefix,
+            source_prefix=target_prefix,
+            keep_relation=keep_relation,
         )
         if full_df is None:
             full_df = df.vstack(reverse_maps)
@@ -86,9 +100,11 @@ def load_semera_landscape_df(
     resources: dict,
     additional_namespaces: dict,
     sssom: bool = False,
+    keep_relation: bool = False,
 ):
     """
-    load in the mappings df for a semra landscape
+    load in the mappings df for a semra landscape,
+    if keep_relation the biomappings format df keeps the predicate of every mapping as the relation column
     """
     df_path = os.path.join(
         os.getcwd(), "resources", f"semra_{landscape_name}_landscape_mappings.tsv"
@@ -103,7 +119,10 @@ def load_semera_landscape_df(
         return df
     else:
         return sssom_to_biomappings(
-            df, resources=resources, additional_namespaces=additional_namespaces
+            df,
+            resources=resources,
+            additional_namespaces=additional_namespaces,
+            keep_relation=keep_relation,
         )
 
 
@@ -227,9 +246,14 @@ def get_novel_mappings(
     check_biomappings: bool = True,
     check_known_mappings: bool = True,
     check_semra: bool = True,
+    check_closure: bool = False,
     **_,
 ):
-    """filter out mappings that are already in biomappings and or known mappings from a tsv file"""
+    """
+    filter out mappings that are already in biomappings and or known mappings from a tsv file.
+    If check_closure, novel mappings whose classes are already transitively equivalent through the
+    exact match evidence are moved to implied_mappings.tsv
+    """
     if output_dir is not None:
         output_dir = output_dir
     elif "output_dir" in meta:
@@ -243,7 +267,10 @@ def get_novel_mappings(
     evidence = None
     matched_resources = predicted_mappings["source prefix"].unique()
     if check_biomappings:
-        evidence = batch_load_biomappings_df(matched_resources=matched_resources)
+        ## the closure needs the relation of every mapping to only follow exact matches
+        evidence = batch_load_biomappings_df(
+            matched_resources=matched_resources, keep_relation=check_closure
+        )
     if check_known_mappings:
         known_mappings = make_undirected(
             load_known_mappings_df(
@@ -251,6 +278,7 @@ def get_novel_mappings(
                 meta=meta,
                 additional_namespaces=additional_namespaces,
                 sssom=False,
+                keep_relation=check_closure,
             )
         )
         evidence = (
@@ -262,6 +290,7 @@ def get_novel_mappings(
             additional_namespaces=additional_namespaces,
             resources=resources,
             sssom=False,
+            keep_relation=check_closure,
         )
         predicted_mappings = repair_names_with_semra(
             predicted_mappings=predicted_mappings, semra_landscape_df=semra_landscape_df
@@ -279,6 +308,13 @@ def get_novel_mappings(
     right, wrong, novel = get_right_wrong_mappings(
         predictions_df=predicted_mappings, ground_truth_df=evidence
     )
+    if check_closure:
+        components = get_equivalence_components(
+            [evidence, semra_landscape_df if check_semra else None]
+        )
+        implied, novel = split_implied_mappings(novel, components)
+        logger.info(f"{len(implied)} novel mappings are implied by the equivalence closure")
+        implied.write_csv(os.path.join(output_dir, "implied_mappings.tsv"), separator="\t")
     right.write_csv(os.path.join(output_dir, "right_mappings.tsv"), separator="\t")
     wrong.write_csv(os.path.join(output_dir, "wrong_mappings.tsv"), separator="\t")
     novel.write_csv(os.path.join(output_dir, "novel_mappings.tsv"), separator="\t")
@@ -0,0 +1,170 @@
+"""
+Exact and normalized label matching across all resources of a landscape.
+Labels and synonyms are normalized into keys (case folding, punctuation and token order) and candidate
+mappings for every prefix pair come from one hash join on the key.
+"""
+
+import os
+
+import polars as pl
+from bioregistry import normalize_prefix
+from pyobo import get_id_name_mapping, get_id_synonyms_mapping
+import logging
+
+logger = logging.getLogger(__name__)
+
+LABEL_TABLE_SCHEMA = pl.Schema(
+    [
+        ("identifier", pl.String),
+        ("prefix", pl.String),
+        ("label", pl.String),
+        ("label type", pl.String),
+    ]
+)
+## confidence of a match by the type of the two labels that matched
+LABEL_TYPE_CONFIDENCE = {
+    ("name", "name"): 1.0,
+    ("name", "synonym"): 0.95,
+    ("synonym", "name"): 0.95,
+    ("synonym", "synonym"): 0.9,
+}
+
+
+def normalize_label(label: pl.Expr):
+    """normalize a label into a matching key: case folded, punctuation removed and tokens sorted"""
+    return (
+        label.str.to_lowercase()
+        .str.replace_all(r"[^\p{L}\p{N}]+", " ")
+        .str.strip_chars()
+        .str.split(" ")
+        .list.sort()
+        .list.join(" ")
+    )
+
+
+def get_label_table(
+    resources: dict, additional_namespaces: dict = None, synonyms: bool = True
+):
+    """returns the names (and synonyms) of every class of a set of resources"""
+    if additional_namespaces is not None:
+        resources = resources | additional_namespaces
+    rows = []
+    for prefix in resources:
+        prefix_n = normalize_prefix(prefix)
+        version = resources[prefix]["version"]
+        for identifier, name in get_id_name_mapping(
+            prefix=prefix_n, version=version
+        ).items():
+            rows.append((f"{prefix_n}:{identifier}", prefix_n, name, "name"))
+        if synonyms:
+            for identifier, labels in get_id_synonyms_mapping(
+                prefix=prefix_n, version=version
+            ).items():
+                rows += [
+                    (f"{prefix_n}:{identifier}", prefix_n, label, "synonym")
+                    for label in labels
+                ]
+    return pl.DataFrame(rows, schema=LABEL_TABLE_SCHEMA, orient="row")
+
+
+def get_lexical_mappings(
+    resources: dict,
+    additional_namespaces: dict = None,
+    synonyms: bool = True,
+    max_classes_per_key: int = 3,
+    undirected: bool = False,
+    matching_source: str = "mapnet-lexical",
+    write_path: str = None,
+):
+    """
+    find mappings between classes of different resources that share a normalized label.
+    args:
+        synonyms: also match on synonyms (with a lower confidence, see LABEL_TYPE_CONFIDENCE)
+        max_classes_per_key: ignore keys shared by more classes of one resource, these are ambiguous
+        undirected: include both directions of each mapping, otherwise every mapping is given once
+        write_path: if given the mappings are written to this tsv file
+    returns a df in the same format as format_mappings
+    """
+    labels = (
+        get_label_table(
+            resources=resources,
+            additional_namespaces=additional_namespaces,
+            synonyms=synonyms,
+        )
+        .with_columns(normalize_label(pl.col("label")).alias("key"))
+        .filter(pl.col("key") != "")
+        .unique(["identifier", "label type", "key"])
+    )
+    labels = labels.filter(
+        pl.col("identifier").n_unique().over("key", "prefix") <= max_classes_per_key
+    )
+    logger.info(f"matching {len(labels)} labels")
+    confidence = pl.DataFrame(
+        [(s, t, c) for (s, t), c in LABEL_TYPE_CONFIDENCE.items()],
+        schema=["source label type", "target label type", "confidence"],
+        orient="row",
+    )
+    source = labels.select(
+        pl.col("identifier").alias("source identifier"),
+        pl.col("prefix").alias("source prefix"),
+        pl.col("label type").alias("source label type"),
+        "key",
+    )
+    target = source.rename(
+        {
+            "source identifier": "target identifier",
+            "source prefix": "target prefix",
+            "source label type": "target label type",
+        }
+    )
+    names = labels.filter(pl.col("label type") == "name").select(
+        "identifier", pl.col("label").alias("name")
+    ).unique("identifier")
+    df = (
+        source.join(target, on="key")
+        .filter(
+            (pl.col("source prefix") != pl.col("target prefix"))
+            if undirected
+            else (pl.col("source prefix") < pl.col("target prefix"))
+        )
+        .join(confidence, on=["source label type", "target label type"])
+        .group_by("source prefix", "source identifier", "target prefix", "target identifier")
+        .agg(pl.col("confidence").max())
+        .join(
+            names.rename({"identifier": "source identifier", "name": "source name"}),
+            on="source identifier",
+            how="left",
+        )
+        .join(
+            names.rename({"identifier": "target identifier", "name": "target name"}),
+            on="target identifier",
+            how="left",
+        )
+        .with_columns(
+            pl.col("source name").fill_null("NO_NAME_FOUND"),
+            pl.col("target name").fill_null("NO_NAME_FOUND"),
+            pl.lit("skos:exactMatch").alias("relation"),
+            pl.lit("semapv:LexicalMatching").alias("type"),
+            pl.lit(matching_source).alias("source"),
+        )
+        .select(
+            [
+                "source prefix",
+                "source identifier",
+                "source name",
+                "relation",
+                "target prefix",
+                "target identifier",
+                "target name",
+                "type",
+                "confidence",
+                "source",
+            ]
+        )
+        .sort("source identifier", "target identifier")
+    )
+    logger.info(f"found {len(df)} lexical mappings")
+    if write_path is not None:
+        os.makedirs(os.path.dirname(write_path) or ".", exist_ok=True)
+        df.write_csv(write_path, separator="\t")
+    return df
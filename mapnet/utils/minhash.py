@@ -0,0 +1,344 @@
+"""
+MinHash LSH index over the labels of an ontology for fuzzy candidate generation.
+Labels are split into character n-grams and summarized by a MinHash signature, signatures are cut into bands
+and labels that share a band bucket with a label of the partner ontology become candidates. This finds
+near duplicate labels such as "carcinoma of lung" and "lung carcinoma" without comparing all pairs of labels.
+
+An index is written once per resource version:
+    <dataset_dir>/<prefix>/<version>/minhash_<num_perm>_<n_bands>_<n-gram size>grams_<synonyms|names>/
+        labels.parquet    identifier, label and label type of every indexed label
+        signatures.npy    minhash signature of every label (row aligned with labels.parquet)
+        bands.parquet     band bucket of every label
+"""
+
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.utils.lexical import get_label_table, normalize_label
+from mapnet.utils.utils import normalized_edit_similarity
+import logging
+
+logger = logging.getLogger(__name__)
+
+## universal hashing modulo a mersenne prime, a * x stays below 2**62 so it fits in uint64
+MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+NGRAM_SIZE = 3
+
+
+def get_ngram_hashes(label: str, n: int = NGRAM_SIZE):
+    """returns the hashes of the character n-grams of a (normalized) label"""
+    label = f" {label} "
+    return {
+        zlib.crc32(label[i : i + n].encode()) % int(MERSENNE_PRIME)
+        for i in range(max(1, len(label) - n + 1))
+    }
+
+
+def get_permutations(num_perm: int, seed: int = 0):
+    """returns the coefficients of num_perm random hash functions"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_chunk(ngram_lists: list, a: np.ndarray, b: np.ndarray):
+    """compute the minhash signatures of a chunk of labels"""
+    lengths = np.array([len(x) for x in ngram_lists])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    ngrams = np.fromiter(
+        (x for ngram_list in ngram_lists for x in ngram_list),
+        dtype=np.uint64,
+        count=lengths.sum(),
+    )
+    ## in place so that a single num_perm x n-grams array is alive at a time
+    hashes = a[:, None] * ngrams[None, :]
+    hashes += b[:, None]
+    hashes %= MERSENNE_PRIME
+    return np.minimum.reduceat(hashes, offsets, axis=1).T.astype(np.uint32)
+
+
+def get_signatures(
+    labels: list,
+    num_perm: int = 128,
+    seed: int = 0,
+    max_memory_mb: int = 1024,
+    n_jobs: int = None,
+):
+    """
+    compute the minhash signatures of a list of labels.
+    Labels are hashed in chunks on several threads (numpy releases the gil). Every chunk hashes a
+    num_perm x n-grams uint64 array, chunks are cut so that the n_jobs chunks hashed at once stay within
+    max_memory_mb (a single label with more n-grams than a chunk allows gets a chunk of its own)
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    a, b = get_permutations(num_perm, seed=seed)
+    ngram_lists = [sorted(get_ngram_hashes(label)) for label in labels]
+    max_ngrams = max(1, max_memory_mb * 2**20 // (n_jobs * num_perm * 8))
+    chunks = []
+    start, n_ngrams = 0, 0
+    for i, ngram_list in enumerate(ngram_lists):
+        if n_ngrams + len(ngram_list) > max_ngrams and i > start:
+            chunks.append(ngram_lists[start:i])
+            start, n_ngrams = i, 0
+        n_ngrams += len(ngram_list)
+    if start < len(ngram_lists):
+        chunks.append(ngram_lists[start:])
+    if not chunks:
+        return np.zeros((0, num_perm), dtype=np.uint32)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        signatures = list(executor.map(lambda x: minhash_chunk(x, a, b), chunks))
+    return np.vstack(signatures)
+
+
+def get_band_buckets(signatures: np.ndarray, n_bands: int):
+    """hash each band of the signatures into a bucket, returns an array of shape (n_labels, n_bands)"""
+    rows = signatures.shape[1] // n_bands
+    bands = signatures[:, : rows * n_bands].reshape(len(signatures), n_bands, rows)
+    weights = get_permutations(rows, seed=n_bands)[0]
+    ## wrapping uint64 arithmetic is fine for a bucket hash
+    return (bands.astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+
+
+def get_minhash_dir(
+    prefix: str,
+    resources: dict,
+    meta: dict,
+    num_perm: int,
+    n_bands: int,
+    synonyms: bool = True,
+):
+    """returns the directory of the minhash index of a resource, named after every setting the index depends on"""
+    resource_dir = os.path.join(
+        meta.get("dataset_dir", "resources"), prefix, resources[prefix]["version"]
+    )
+    labels = "synonyms" if synonyms else "names"
+    return os.path.join(
+        resource_dir, f"minhash_{num_perm}_{n_bands}_{NGRAM_SIZE}grams_{labels}"
+    )
+
+
+def build_minhash_index(
+    prefix: str,
+    resources: dict,
+    meta: dict,
+    num_perm: int = 128,
+    n_bands: int = 32,
+    synonyms: bool = True,
+    n_jobs: int = None,
+    max_memory_mb: int = 1024,
+    overwrite: bool = False,
+):
+    """
+    build (or load) the minhash index of a resource.
+    returns the labels, signatures and band buckets of the index
+    """
+    prefix = normalize_prefix(prefix)
+    resources = {normalize_prefix(x): resources[x] for x in resources}
+    index_dir = get_minhash_dir(
+        prefix, resources, meta, num_perm, n_bands, synonyms=synonyms
+    )
+    paths = {
+        x: os.path.join(index_dir, x)
+        for x in ["labels.parquet", "signatures.npy", "bands.parquet"]
+    }
+    if all(os.path.exists(x) for x in paths.values()) and not overwrite:
+        logger.info(f"found {prefix} minhash index at {index_dir}")
+        return (
+            pl.read_parquet(paths["labels.parquet"]),
+            np.load(paths["signatures.npy"], mmap_mode="r"),
+            pl.read_parquet(paths["bands.parquet"]),
+        )
+    labels = (
+        get_label_table(resources={prefix: resources[prefix]}, synonyms=synonyms)
+        .with_columns(normalize_label(pl.col("label")).alias("key"))
+        .filter(pl.col("key") != "")
+        .unique(["identifier", "key"], maintain_order=True)
+        .drop("key")
+        .with_row_index("row")
+    )
+    logger.info(f"building minhash index of {len(labels)} {prefix} labels")
+    signatures = get_signatures(
+        labels.select(normalize_label(pl.col("label")))["label"].to_list(),
+        num_perm=num_perm,
+        max_memory_mb=max_memory_mb,
+        n_jobs=n_jobs,
+    )
+    buckets = get_band_buckets(signatures, n_bands=n_bands)
+    bands = pl.DataFrame(
+        {
+            "row": np.repeat(labels["row"].to_numpy(), n_bands),
+            "band": np.tile(np.arange(n_bands, dtype=np.uint16), len(labels)),
+            "bucket": buckets.ravel(),
+        }
+    )
+    os.makedirs(index_dir, exist_ok=True)
+    labels.write_parquet(paths["labels.parquet"])
+    np.save(paths["signatures.npy"], signatures)
+    bands.write_parquet(paths["bands.parquet"])
+    return labels, signatures, bands
+
+
+def get_candidate_rows(
+    source_bands: pl.DataFrame, target_bands: pl.DataFrame, max_bucket_size: int = 100
+):
+    """returns the (source row, target row) pairs that share at least one band bucket"""
+    target_bands = target_bands.filter(
+        pl.len().over("band", "bucket") <= max_bucket_size
+    )
+    return (
+        source_bands.lazy()
+        .join(target_bands.lazy(), on=["band", "bucket"], suffix=" target")
+        .select(pl.col("row").alias("source row"), pl.col("row target").alias("target row"))
+        .unique()
+        .collect(engine="streaming")
+    )
+
+
+def estimate_jaccard(
+    source_signatures: np.ndarray,
+    target_signatures: np.ndarray,
+    source_rows: np.ndarray,
+    target_rows: np.ndarray,
+    chunk_size: int = 100000,
+):
+    """estimate the jaccard similarity of candidate pairs from the fraction of equal minhash values"""
+    similarity = np.empty(len(source_rows), dtype=np.float32)
+    for i in range(0, len(source_rows), chunk_size):
+        s = np.asarray(source_signatures[source_rows[i : i + chunk_size]])
+        t = np.asarray(target_signatures[target_rows[i : i + chunk_size]])
+        similarity[i : i + chunk_size] = (s == t).mean(axis=1)
+    return similarity
+
+
+def get_minhash_candidates(
+    source_prefix: str,
+    target_prefix: str,
+    resources: dict,
+    meta: dict,
+    k: int = 10,
+    min_similarity: float = 0.3,
+    num_perm: int = 128,
+    n_bands: int = 32,
+    max_bucket_size: int = 100,
+    synonyms: bool = True,
+    n_jobs: int = None,
+    max_memory_mb: int = 1024,
+    write_path: str = None,
+):
+    """
+    returns the top k fuzzy candidates in the target resource for each class of the source resource.
+    Candidates are scored by the estimated jaccard similarity of their closest labels, and the normalized
+    edit similarity of their names is added for downstream filtering (e.g. refinenet inference).
+    args:
+        k: number of candidates to keep for each source class
+        min_similarity: minimum estimated jaccard similarity of a candidate
+        num_perm, n_bands: size of the signatures and number of lsh bands, with r = num_perm / n_bands rows
+            per band pairs with a jaccard similarity s are candidates with probability 1 - (1 - s^r)^n_bands
+        max_bucket_size: ignore buckets shared by more target labels, these come from very common n-grams
+        max_memory_mb: memory budget of hashing the labels of an index, see get_signatures
+    """
+    index_args = dict(
+        resources=resources,
+        meta=meta,
+        num_perm=num_perm,
+        n_bands=n_bands,
+        synonyms=synonyms,
+        n_jobs=n_jobs,
+        max_memory_mb=max_memory_mb,
+    )
+    source_labels, source_signatures, source_bands = build_minhash_index(
+        source_prefix, **index_args
+    )
+    target_labels, target_signatures, target_bands = build_minhash_index(
+        target_prefix, **index_args
+    )
+    candidates = get_candidate_rows(
+        source_bands, target_bands, max_bucket_size=max_bucket_size
+    )
+    logger.info(
+        f"{len(candidates)} candidate label pairs for {source_prefix} and {target_prefix}"
+    )
+    candidates = candidates.with_columns(
+        pl.Series(
+            "confidence",
+            estimate_jaccard(
+                source_signatures,
+                target_signatures,
+                candidates["source row"].to_numpy(),
+                candidates["target row"].to_numpy(),
+            ),
+        )
+    ).filter(pl.col("confidence") >= min_similarity)
+
+    def get_names(labels: pl.DataFrame, side: str):
+        return (
+            labels.sort(pl.col("label type") != "name")
+            .unique("identifier", keep="first")
+            .select(
+                pl.col("identifier").alias(f"{side} identifier"),
+                pl.col("label").alias(f"{side} name"),
+            )
+        )
+
+    df = (
+        candidates.join(
+            source_labels.select(
+                pl.col("row").alias("source row"),
+                pl.col("identifier").alias("source identifier"),
+            ),
+            on="source row",
+        )
+        .join(
+            target_labels.select(
+                pl.col("row").alias("target row"),
+                pl.col("identifier").alias("target identifier"),
+            ),
+            on="target row",
+        )
+        .group_by("source identifier", "target identifier")
+        .agg(pl.col("confidence").max())
+        .filter(
+            pl.col("confidence").rank("ordinal", descending=True).over("source identifier")
+            <= k
+        )
+        .join(get_names(source_labels, "source"), on="source identifier", how="left")
+        .join(get_names(target_labels, "target"), on="target identifier", how="left")
+        .with_columns(
+            pl.col("source identifier").str.split(":").list.first().alias("source prefix"),
+            pl.col("target identifier").str.split(":").list.first().alias("target prefix"),
+            pl.lit("skos:exactMatch").alias("relation"),
+            pl.lit("semapv:LexicalSimilarityThresholdMatching").alias("type"),
+            pl.lit("mapnet-minhash").alias("source"),
+        )
+        .with_columns(
+            edit_similarity=pl.struct(["source name", "target name"]).map_elements(
+                normalized_edit_similarity, return_dtype=pl.Float32
+            )
+        )
+        .select(
+            [
+                "source prefix",
+                "source identifier",
+                "source name",
+                "relation",
+                "target prefix",
+                "target identifier",
+                "target name",
+                "type",
+                "confidence",
+                "source",
+                "edit_similarity",
+            ]
+        )
+        .sort(["source identifier", "confidence"], descending=[False, True])
+    )
+    if write_path is not None:
+        os.makedirs(os.path.dirname(write_path) or ".", exist_ok=True)
+        df.write_csv(write_path, separator="\t")
+    return df
@@ -151,6 +151,46 @@ def get_network_graph(resources: dict, meta: dict, prefix: str, **_):
     return full_graph
 
 
+## predicate of subclass edges in pyobo graphs, as the obo name and as the curie pyobo standardizes it to
+IS_A_PREDICATES = {"is_a", "rdfs:subClassOf"}
+
+
+def get_is_a_edges(graph: nx.MultiDiGraph):
+    """
+    returns the (child, parent) pairs of the is_a edges of a pyobo network graph.
+    pyobo graphs have an edge from child to parent for every relation (is_a, part_of, definition source, ...)
+    keyed by its predicate
+    """
+    if not graph.is_multigraph():
+        return list(graph.edges())
+    return [
+        (child, parent)
+        for child, parent, key in graph.edges(keys=True)
+        if key in IS_A_PREDICATES
+    ]
+
+
+def get_hierarchy_graph(graph: nx.MultiDiGraph):
+    """
+    returns the is_a hierarchy of a pyobo network graph as a DiGraph with edges from parent to child.
+    Nodes that are only the object of other relations (e.g. definition sources) are dropped.
+    """
+    hierarchy = nx.DiGraph()
+    hierarchy.add_nodes_from(child for child, _ in graph.edges())
+    hierarchy.add_edges_from((parent, child) for child, parent in get_is_a_edges(graph))
+    return hierarchy
+
+
+def get_prefix_classes(graph: nx.DiGraph, prefix: str):
+    """
+    returns the nodes of a graph that are classes of prefix,
+    graphs also have the classes of other ontologies they import or refer to
+    """
+    node_prefixes = {node.split(":", 1)[0] for node in graph.nodes}
+    prefixes = {x for x in node_prefixes if bioregistry.normalize_prefix(x) == prefix}
+    return {node for node in graph.nodes if node.split(":", 1)[0] in prefixes}
+
+
 def subset_from_obo(subset_def: dict):
     """saves an OBO subset of a graph given a base prefix and version as well as terms to base subset on"""
     for prefix in subset_def:
@@ -176,8 +216,12 @@ def format_known_mappings(
     resources: dict,
     additional_namespaces: dict = None,
     sssom: bool = True,
+    keep_relation: bool = False,
 ):
-    """helper method for formatting a dataframe with known_mappings"""
+    """
+    helper method for formatting a dataframe with known_mappings,
+    if keep_relation the biomappings format df keeps the predicate of every mapping as the relation column
+    """
     if additional_namespaces:
         normalized_resource_names = [
             bioregistry.normalize_prefix(x) for x in resources | additional_namespaces
@@ -209,7 +253,10 @@ def format_known_mappings(
             return df
         else:
             return sssom_to_biomappings(
-                df, resources=resources, additional_namespaces=additional_namespaces
+                df,
+                resources=resources,
+                additional_namespaces=additional_namespaces,
+                keep_relation=keep_relation,
             )
 
 
@@ -218,6 +265,7 @@ def load_known_mappings_df(
     meta: dict,
     additional_namespaces: dict = None,
     sssom: bool = True,
+    keep_relation: bool = False,
     **_,
 ):
     """
@@ -241,6 +289,7 @@ def load_known_mappings_df(
             resources=resources,
             additional_namespaces=additional_namespaces,
             sssom=sssom,
+            keep_relation=keep_relation,
         )
         if mappings_df is None:
             continue
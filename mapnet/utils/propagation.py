@@ -0,0 +1,220 @@
+"""
+Hierarchy guided candidate generation.
+Starting from high confidence anchor mappings (known xrefs, biomappings and exact label matches), the candidates
+of an unmatched class are restricted to the partner side neighborhood of its mapped ancestors and descendants.
+The candidate pairs can then be scored by the expensive matchers (edit similarity, refinenet, bertmap).
+"""
+
+import os
+
+import polars as pl
+from bioregistry import normalize_prefix
+
+from mapnet.utils.filtering import load_biomappings_df
+from mapnet.utils.lexical import get_lexical_mappings
+from mapnet.utils.obo import (
+    get_hierarchy_graph,
+    get_network_graph,
+    get_prefix_classes,
+    load_known_mappings_df,
+)
+from mapnet.utils.utils import (
+    ancestors_within_distance,
+    descendants_within_distance,
+    make_undirected,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_anchor_mappings(
+    source_prefix: str,
+    target_prefix: str,
+    resources: dict,
+    meta: dict,
+    additional_namespaces: dict = None,
+    use_known_mappings: bool = True,
+    use_biomappings: bool = True,
+    use_lexical: bool = True,
+):
+    """returns high confidence mappings from the source to the target resource, used as anchors"""
+    pair_resources = {
+        prefix: resources[prefix] for prefix in [source_prefix, target_prefix]
+    }
+    anchors = []
+    if use_known_mappings:
+        known_mappings = load_known_mappings_df(
+            resources=pair_resources,
+            meta=meta,
+            additional_namespaces=additional_namespaces,
+            sssom=False,
+        )
+        if known_mappings is not None:
+            anchors.append(make_undirected(known_mappings))
+    if use_biomappings:
+        anchors.append(
+            load_biomappings_df(target_prefix=target_prefix, source_prefix=source_prefix)
+        )
+        anchors.append(
+            load_biomappings_df(target_prefix=source_prefix, source_prefix=target_prefix)
+        )
+    if use_lexical:
+        anchors.append(
+            get_lexical_mappings(
+                resources=pair_resources, synonyms=False, undirected=True
+            )
+        )
+    return (
+        pl.concat(
+            [x.select("source identifier", "target identifier") for x in anchors]
+        )
+        .filter(
+            pl.col("source identifier").str.starts_with(f"{source_prefix}:")
+            & pl.col("target identifier").str.starts_with(f"{target_prefix}:")
+        )
+        .unique()
+    )
+
+
+def propagate_candidates(
+    source_graph,
+    target_graph,
+    anchors: pl.DataFrame,
+    source_classes: set = None,
+    target_classes: set = None,
+    max_distance: int = 2,
+    radius: int = 2,
+    exclude_anchored_targets: bool = True,
+):
+    """
+    find candidate targets for the unanchored classes of the source graph.
+    Mapped ancestors (within max_distance) propose the descendants of their targets within radius, mapped descendants
+    propose the ancestors of their targets. When a class has both, only targets proposed by both are kept.
+    args:
+        source_graph, target_graph: is_a hierarchies with edges from parent to child, see get_hierarchy_graph
+        source_classes, target_classes: the classes that can be sources and candidates, all nodes by default
+    returns a df of candidate pairs with the kind of evidence they came from
+    """
+    source_classes = set(source_graph.nodes) if source_classes is None else source_classes
+    target_classes = set(target_graph.nodes) if target_classes is None else target_classes
+    anchor_map = {}
+    for source, target in anchors.iter_rows():
+        anchor_map.setdefault(source, set()).add(target)
+    anchored_targets = set(anchors["target identifier"].to_list())
+    rows = []
+    for node in sorted(source_classes):
+        if node in anchor_map or node not in source_graph:
+            continue
+        down = set()
+        for ancestor in ancestors_within_distance(source_graph, node, max_distance):
+            for target in anchor_map.get(ancestor, []):
+                if target in target_graph:
+                    down |= descendants_within_distance(target_graph, target, radius)
+        up = set()
+        for descendant in descendants_within_distance(source_graph, node, max_distance):
+            for target in anchor_map.get(descendant, []):
+                if target in target_graph:
+                    up |= ancestors_within_distance(target_graph, target, radius)
+        if down and up and down & up:
+            region, evidence = down & up, "both"
+        elif down or up:
+            region, evidence = down | up, "ancestor" if down else "descendant"
+        else:
+            continue
+        region &= target_classes
+        if exclude_anchored_targets:
+            region -= anchored_targets
+        rows += [(node, target, evidence) for target in region]
+    return pl.DataFrame(
+        rows,
+        schema={
+            "source identifier": pl.String,
+            "target identifier": pl.String,
+            "evidence": pl.String,
+        },
+        orient="row",
+    )
+
+
+def get_propagated_candidates(
+    source_prefix: str,
+    target_prefix: str,
+    resources: dict,
+    meta: dict,
+    additional_namespaces: dict = None,
+    max_distance: int = 2,
+    radius: int = 2,
+    exclude_anchored_targets: bool = True,
+    write_dir: str = None,
+    **anchor_args,
+):
+    """
+    returns the anchors and the hierarchy guided candidate pairs from the source to the target resource,
+    and a coverage report of how many source classes are anchored, have candidates or were left without any.
+    If write_dir is given the candidates and the coverage report are written there
+    """
+    resources = {normalize_prefix(x): resources[x] for x in resources}
+    source_prefix, target_prefix = normalize_prefix(source_prefix), normalize_prefix(
+        target_prefix
+    )
+    anchors = get_anchor_mappings(
+        source_prefix=source_prefix,
+        target_prefix=target_prefix,
+        resources=resources,
+        meta=meta,
+        additional_namespaces=additional_namespaces,
+        **anchor_args,
+    )
+    ## pyobo graphs go from child to parent over every relation, the hierarchy keeps is_a going down
+    source_graph = get_hierarchy_graph(
+        get_network_graph(resources=resources, meta=meta, prefix=source_prefix)
+    )
+    target_graph = get_hierarchy_graph(
+        get_network_graph(resources=resources, meta=meta, prefix=target_prefix)
+    )
+    ## the hierarchies are walked through imported classes but only classes of the pair are matched
+    source_classes = get_prefix_classes(source_graph, source_prefix)
+    target_classes = get_prefix_classes(target_graph, target_prefix)
+    candidates = propagate_candidates(
+        source_graph=source_graph,
+        target_graph=target_graph,
+        anchors=anchors,
+        source_classes=source_classes,
+        target_classes=target_classes,
+        max_distance=max_distance,
+        radius=radius,
+        exclude_anchored_targets=exclude_anchored_targets,
+    )
+    n_source, n_target = len(source_classes), len(target_classes)
+    n_anchored = anchors.filter(
+        pl.col("source identifier").is_in(list(source_classes))
+    )["source identifier"].n_unique()
+    n_with_candidates = candidates["source identifier"].n_unique()
+    coverage = pl.DataFrame(
+        {
+            "source prefix": [source_prefix],
+            "target prefix": [target_prefix],
+            "source classes": [n_source],
+            "anchored": [n_anchored],
+            "with candidates": [n_with_candidates],
+            "without candidates": [n_source - n_anchored - n_with_candidates],
+            "candidate pairs": [len(candidates)],
+            "all pairs": [n_source * n_target],
+        }
+    )
+    logger.info(
+        f"{source_prefix} -> {target_prefix}: {n_anchored} anchored, {n_with_candidates} with candidates, "
+        f"{len(candidates)} candidate pairs out of {n_source * n_target}"
+    )
+    if write_dir is not None:
+        os.makedirs(write_dir, exist_ok=True)
+        candidates.write_csv(
+            os.path.join(write_dir, f"{source_prefix}-{target_prefix}_candidates.tsv"),
+            separator="\t",
+        )
+        coverage.write_csv(
+            os.path.join(write_dir, f"{source_prefix}-{target_prefix}_coverage.tsv"),
+            separator="\t",
+        )
+    return anchors, candidates, coverage
@@ -4,6 +4,7 @@ helper methods for using Robot when parsing and filtering ontologies
 
 from bioontologies.robot import get_robot_jar_path
 from subprocess import check_call
+from mapnet.utils.accounting import run_accounted
 from shlex import quote
 import os
 from bioregistry import get_iri, normalize_prefix
@@ -18,7 +19,9 @@ prefix_map = {
 SKIP_CHECK = ["EFO"]
 
 
-def convert_onto_format(input_file: str, desired_format: str, output_path: str = None):
+def convert_onto_format(
+    input_file: str, desired_format: str, output_path: str = None, report_path: str = None
+):
     """use robot to convert an ontology from one format to another"""
     desired_format = (
         desired_format if desired_format.startswith(".") else "." + desired_format
@@ -40,8 +43,13 @@ def convert_onto_format(input_file: str, desired_format: str, output_path: str =
         "false",
         "-vvv",
     ]
-    logger.info(f'running {cmd}')
-    return check_call(cmd)
+    return run_accounted(
+        cmd,
+        job_name="robot:convert",
+        report_path=report_path,
+        inputs=[input_file],
+        outputs=[output_path],
+    )
 
 
 def get_directional_onto_subset(
@@ -51,6 +59,7 @@ def get_directional_onto_subset(
     ancestors: bool = False,
     output_path: str = None,
     verbose: bool = False,
+    report_path: str = None,
 ):
     """returns a subset with all descendant (or ancestors if ancestor=True) terms of a list of terms in a given ontology"""
     subset = "descendants" if not ancestors else "ancestors"
@@ -75,11 +84,21 @@ def get_directional_onto_subset(
         cmd += [subset_arg, get_iri(prefix, term, prefix_map=prefix_map)]
     if verbose:
         cmd += ["-vvv"]
-    logger.info(f'running {cmd}')
-    check_call(cmd)
+    run_accounted(
+        cmd,
+        job_name=f"robot:extract_{subset}:{prefix}",
+        report_path=report_path,
+        inputs=[onto_path],
+        outputs=[output_path],
+    )
 
 
-def merge_ontos(output_path: str, input_ontos: list, delete_inputs: bool = False):
+def merge_ontos(
+    output_path: str,
+    input_ontos: list,
+    delete_inputs: bool = False,
+    report_path: str = None,
+):
     """merges a set of ontologies into one combined file"""
     cmd = [
     "java",
@@ -90,13 +109,18 @@ def merge_ontos(output_path: str, input_ontos: list, delete_inputs: bool = False
     for onto in input_ontos:
         cmd += ["--input", onto]
     cmd += ["--output", output_path]
-    logger.info(f'running {cmd}')
+    run_accounted(
+        cmd,
+        job_name="robot:merge",
+        report_path=report_path,
+        inputs=list(input_ontos),
+        outputs=[output_path],
+    )
     if delete_inputs:
         clean_cmd = ["rm"] + [onto for onto in input_ontos]
-        check_call(cmd)
         logger.info(f'running {clean_cmd}')
         return check_call(clean_cmd)
-    return check_call(cmd)
+    return 0
 
 
 def get_onto_subset_from_file(
@@ -106,29 +130,35 @@ def get_onto_subset_from_file(
     method: str = "full",
     output_path: str = None,
     verbose: bool = False,
+    report_path: str = None,
 ):
     """returns a subset with all descendant (or ancestors if ancestor=True) terms of a list of terms in a given ontology from an obo file"""
     assert method in ["ancestor", "descendant", "full"]
     if method == "ancestor":
         return get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_path,
             subset_identifiers=subset_identifiers,
             ancestors=True,
+            output_path=output_path,
         )
     elif method == "descendant":
         return get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_path,
             subset_identifiers=subset_identifiers,
             ancestors=False,
+            output_path=output_path,
         )
     else:
         ## get the subsets in both directions and merge them
         get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_path,
             subset_identifiers=subset_identifiers,
@@ -136,6 +166,7 @@ def get_onto_subset_from_file(
         )
         get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_path,
             subset_identifiers=subset_identifiers,
@@ -169,17 +200,27 @@ def get_onto_subset_from_file(
             ),
         ]
         merge_ontos(
-            output_path=input_ontos[2], input_ontos=input_ontos[:2], delete_inputs=True
+            output_path=input_ontos[2],
+            input_ontos=input_ontos[:2],
+            delete_inputs=True,
+            report_path=report_path,
         )
         convert_onto_format(
-            input_file=input_ontos[2], output_path=output_path, desired_format=".obo"
+            input_file=input_ontos[2],
+            output_path=output_path,
+            desired_format=".obo",
+            report_path=report_path,
         )
         cmd = ["rm", quote(input_ontos[2])]
         return check_call(cmd)
 
 
 def get_onto_subset(
-    prefix: str, dataset_def: dict, method: str = "full", verbose: bool = True
+    prefix: str,
+    dataset_def: dict,
+    method: str = "full",
+    verbose: bool = True,
+    report_path: str = None,
 ):
     """returns a subset with all descendant (or ancestors if ancestor=True) terms of a list of terms in a given ontology"""
     assert method in ["ancestor", "descendant", "full"]
@@ -208,6 +249,7 @@ def get_onto_subset(
     if method == "ancestor":
         return get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_paths[0],
             subset_identifiers=subset_identifiers,
@@ -217,6 +259,7 @@ def get_onto_subset(
     elif method == "descendant":
         return get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_paths[0],
             subset_identifiers=subset_identifiers,
@@ -227,6 +270,7 @@ def get_onto_subset(
         ## get the subets in both directions and merge them
         get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_paths[0],
             subset_identifiers=subset_identifiers,
@@ -235,6 +279,7 @@ def get_onto_subset(
         )
         get_directional_onto_subset(
             verbose=verbose,
+            report_path=report_path,
             prefix=prefix,
             onto_path=onto_paths[0],
             subset_identifiers=subset_identifiers,
@@ -242,16 +287,27 @@ def get_onto_subset(
             output_path=onto_paths[2],
         )
         merge_ontos(
-            output_path=onto_paths[3], input_ontos=onto_paths[1:3], delete_inputs=True
+            output_path=onto_paths[3],
+            input_ontos=onto_paths[1:3],
+            delete_inputs=True,
+            report_path=report_path,
         )
         convert_onto_format(
-            input_file=onto_paths[3], output_path=onto_paths[4], desired_format=".obo"
+            input_file=onto_paths[3],
+            output_path=onto_paths[4],
+            desired_format=".obo",
+            report_path=report_path,
         )
         cmd = ["rm", quote(onto_paths[3])]
         return check_call(cmd)
 
 
-def get_onto_subsets(dataset_def: dict, method: str = "full", verbose: bool = False):
+def get_onto_subsets(
+    dataset_def: dict,
+    method: str = "full",
+    verbose: bool = False,
+    report_path: str = None,
+):
     """returns a subset with all descendant (or ancestors if ancestor=True) terms of a list of terms for a set of ontologies"""
     assert method in ["ancestor", "descendant", "full"]
     version_mappings = {
@@ -263,5 +319,9 @@ def get_onto_subsets(dataset_def: dict, method: str = "full", verbose: bool = Fa
         if dataset_def["resources"][prefix]["subset"]:
             logger.info(f"sub-setting {prefix}")
             get_onto_subset(
-                prefix=prefix, dataset_def=dataset_def, method=method, verbose=verbose
+                prefix=prefix,
+                dataset_def=dataset_def,
+                method=method,
+                verbose=verbose,
+                report_path=report_path,
             )
@@ -210,10 +210,14 @@ def get_landscape_mappings(landscape_name: str):
 
 
 def sssom_to_biomappings(
-    df, resources: dict = None, additional_namespaces: dict = None
+    df,
+    resources: dict = None,
+    additional_namespaces: dict = None,
+    keep_relation: bool = False,
 ):
     """
-    convert sssom formated df to a df in biomappings format
+    convert sssom formated df to a df in biomappings format,
+    if keep_relation the predicate_id is kept as the relation column
     """
     df = df.with_columns(
         pl.col("subject_id").str.split(":").list.get(0).alias("source prefix"),
@@ -239,6 +243,7 @@ def sssom_to_biomappings(
             "object_id": "target identifier",
             "object_label": "target name",
         }
+        | ({"predicate_id": "relation"} if keep_relation else {})
     ).select(
         [
             "source identifier",
@@ -248,6 +253,7 @@ def sssom_to_biomappings(
             "target name",
             "target prefix",
         ]
+        + (["relation"] if keep_relation else [])
     )
 
 
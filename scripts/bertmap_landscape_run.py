@@ -0,0 +1,58 @@
+"""
+Run BERTMap inference for every pair of the disease landscape with one model load.
+"""
+
+import argparse
+import logging
+
+from mapnet.bertmap import run_bertmap_pairwise
+from mapnet.utils import load_config_from_json
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--config-path",
+        type=str,
+        default="mapnet/utils/configs/disease_landscape.json",
+        help="json config with the dataset definition of the landscape",
+    )
+    parser.add_argument(
+        "-c",
+        "--checkpoint-path",
+        type=str,
+        default=None,
+        help="fine-tuned bert to use, defaults to the model in ./bertmap",
+    )
+    parser.add_argument(
+        "-t",
+        "--target-resource-prefix",
+        type=str,
+        default=None,
+        help="only match pairs containing this resource",
+    )
+    parser.add_argument(
+        "-w",
+        "--n-workers",
+        type=int,
+        default=1,
+        help="number of worker processes, each loads the model once",
+    )
+    parser.add_argument(
+        "--min-score",
+        type=float,
+        default=0.9,
+        help="minimum score of a kept mapping",
+    )
+    args = parser.parse_args()
+    dataset_def = load_config_from_json(config_path=args.config_path)["dataset_def"]
+    run_bertmap_pairwise(
+        resources=dataset_def["resources"],
+        meta=dataset_def["meta"],
+        checkpoint_path=args.checkpoint_path,
+        target_resource_prefix=args.target_resource_prefix,
+        n_workers=args.n_workers,
+        min_score=args.min_score,
+    )